@@ -0,0 +1,295 @@
+"""
+Benchmarks of the narration pipeline. Every stage of `gpt.explain`, `plots.waterfall` and `plots.bar` is timed
+separately, and the whole calls are timed against an in-process fake chat completions server, so no API key or network
+access is needed. The results are written as JSON, and can be compared with the results of another commit:
+
+    python -m benchmarks.bench_narration --output after.json --compare before.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import matplotlib
+
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import shap
+import sklearn.linear_model
+from src.contextualshap import gpt, plots
+from src.contextualshap.common import _serialize
+from src.contextualshap.encoding import ImageEncoding
+from src.contextualshap.session import Session
+
+_explanation_content = json.dumps({'explanation': 'explanation'})
+
+
+def _features_content(feature_names):
+    return json.dumps({'summary': 'summary', 'features': [
+        {'feature_name': f, 'description': f'The {f} of the houses', 'explanation': 'explanation'}
+        for f in feature_names]})
+
+
+def _content(request):
+    # An explanation of every feature the response schema allows, so no missing feature is requested again
+    schema = request.get('response_format', {}).get('json_schema', {}).get('schema', {})
+    if 'features' not in schema.get('properties', {}):
+        return _explanation_content
+    return _features_content(schema['properties']['features']['items']['properties']['feature_name'].get('enum', []))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        content = _content(request)
+        body = json.dumps({'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': 0,
+                           'model': request['model'],
+                           'choices': [{'index': 0, 'finish_reason': 'stop',
+                                        'message': {'role': 'assistant', 'content': content}}],
+                           'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServer:
+    """A chat completions server answering every request at once, running on a thread of the benchmark process."""
+
+    def __init__(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.base_url = f'http://127.0.0.1:{self._server.server_address[1]}/v1'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _dataset(n_samples, n_features):
+    try:
+        x, y = shap.datasets.california(n_points=1000)
+    except Exception:
+        # The same shape as the test dataset when it cannot be downloaded
+        rng = np.random.default_rng(0)
+        x = pd.DataFrame(rng.normal(size=(1000, 8)), columns=['MedInc', 'HouseAge', 'AveRooms', 'AveBedrms',
+                                                              'Population', 'AveOccup', 'Latitude', 'Longitude'])
+        y = x.to_numpy() @ rng.normal(size=8)
+
+    # Wider datasets repeat the columns with a suffix
+    copies = -(-n_features // x.shape[1])
+    x = pd.concat([x.add_suffix('' if k == 0 else f'_{k}') for k in range(copies)], axis=1).iloc[:, :n_features]
+
+    model = sklearn.linear_model.LinearRegression()
+    model.fit(x, y)
+    # The linear explainer gives the same SHAP values as the explainer of the tests, much faster for wide datasets
+    explainer = shap.explainers.Linear(model, shap.utils.sample(x, 100))
+    return explainer(x.iloc[:n_samples])
+
+
+def _time(fn, rounds):
+    fn()
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.fmean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0, 'rounds': rounds}
+
+
+def _aliases(feature_names):
+    return {f: f.upper() for f in feature_names[::2]}
+
+
+def _descriptions(feature_names):
+    return {f: f'The {f} of the houses' for f in feature_names}
+
+
+def _explain_cases(session, shap_values, rounds):
+    aliases, descriptions = _aliases(shap_values.feature_names), _descriptions(shap_values.feature_names)
+    messages = gpt._messages(shap_values, aliases, descriptions, None, 'en', 'general')
+    content = _features_content(shap_values.feature_names)
+    return {
+        'explain.table': _time(lambda: _serialize(gpt._shap_columns(shap_values)), rounds),
+        'explain.prompt': _time(lambda: gpt._messages(shap_values, aliases, descriptions, None, 'en', 'general'),
+                                rounds),
+        'explain.serialize': _time(lambda: json.dumps({'model': 'gpt-4o', 'messages': messages}), rounds),
+        'explain.parse': _time(lambda: gpt._result(content), rounds),
+        'explain.end_to_end': _time(lambda: session.explain(shap_values, aliases, descriptions), rounds),
+    }
+
+
+def _plot_cases(name, session, draw, alias, prompt, call, rounds):
+    encoding = ImageEncoding()
+
+    def draw_and_close():
+        draw()
+        plt.close()
+
+    draw()
+    figure = plt.gcf()
+    saved = encoding._save(figure)
+    image = encoding._image(*saved)
+    plt.close()
+    messages = prompt(image)
+
+    def end_to_end():
+        call()
+        plt.close()
+
+    return {
+        f'{name}.alias': _time(alias, rounds),
+        f'{name}.draw': _time(draw_and_close, rounds),
+        f'{name}.savefig': _time(lambda: encoding._save(figure), rounds),
+        f'{name}.encode': _time(lambda: encoding._image(*saved), rounds),
+        f'{name}.prompt': _time(lambda: prompt(image), rounds),
+        f'{name}.serialize': _time(lambda: json.dumps({'model': 'gpt-4o', 'messages': messages}), rounds),
+        f'{name}.parse': _time(lambda: plots._explanation(_explanation_content), rounds),
+        f'{name}.end_to_end': _time(end_to_end, rounds),
+    }
+
+
+def _waterfall_cases(session, explanation, rounds):
+    aliases, descriptions = _aliases(explanation.feature_names), _descriptions(explanation.feature_names)
+    return _plot_cases(
+        'waterfall', session,
+        lambda: shap.plots.waterfall(plots._waterfall_alias(explanation, aliases), show=False),
+        lambda: plots._waterfall_alias(explanation, aliases),
+        lambda image: plots._waterfall_messages(image, explanation, aliases, descriptions),
+        lambda: session.waterfall(explanation, aliases, descriptions, show=False),
+        rounds)
+
+
+def _bar_cases(session, cohorts, rounds):
+    feature_names = list(cohorts.values())[0].feature_names
+    aliases, descriptions = _aliases(feature_names), _descriptions(feature_names)
+    shap_values = cohorts if len(cohorts) > 1 else list(cohorts.values())[0]
+    return _plot_cases(
+        'bar', session,
+        lambda: shap.plots.bar(plots._bar_alias(shap_values, aliases)[0], show=False),
+        lambda: plots._bar_alias(shap_values, aliases),
+        lambda image: plots._bar_messages(image, feature_names, aliases, descriptions),
+        lambda: session.bar(shap_values, aliases, descriptions, show=False),
+        rounds)
+
+
+def _cohorts(shap_values, n_cohorts):
+    return {f'cohort {k}': shap_values[k::n_cohorts] for k in range(n_cohorts)}
+
+
+def run(samples=(1, 10, 100), features=(8, 32, 128), cohorts=(1, 2, 4), rounds=5):
+    """
+    Runs the benchmarks for every combination of the sweeps.
+
+    :param samples: the numbers of samples explained by `explain` and `bar`.
+    :param features: the numbers of features of the dataset.
+    :param cohorts: the numbers of cohorts of the bar plots.
+    :param rounds: the number of timed runs of every benchmark.
+    :return: a list of results, each a dictionary with the `benchmark` name, its `params` and its timings in seconds
+    """
+    results = []
+    server = FakeServer()
+    try:
+        with Session(openai_api_key='benchmark', base_url=server.base_url, max_retries=0) as session:
+            for n_features in features:
+                shap_values = _dataset(max(samples), n_features)
+                for name, timing in _waterfall_cases(session, shap_values[0], rounds).items():
+                    results.append({'benchmark': name, 'params': {'features': n_features}, **timing})
+                for n_samples in samples:
+                    for name, timing in _explain_cases(session, shap_values[:n_samples], rounds).items():
+                        results.append({'benchmark': name, 'params': {'samples': n_samples, 'features': n_features},
+                                        **timing})
+                    for n_cohorts in cohorts:
+                        if n_cohorts > n_samples:
+                            continue
+                        bar_cohorts = _cohorts(shap_values[:n_samples], n_cohorts)
+                        for name, timing in _bar_cases(session, bar_cohorts, rounds).items():
+                            results.append({'benchmark': name, 'params': {'samples': n_samples,
+                                                                          'features': n_features,
+                                                                          'cohorts': n_cohorts}, **timing})
+    finally:
+        server.close()
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _key(result):
+    return result['benchmark'], tuple(sorted(result['params'].items()))
+
+
+def compare(results, baseline, threshold=1.25):
+    """
+    Compares the median timings of two runs.
+
+    :param results: the results of `run`.
+    :param baseline: the results of another run.
+    :param threshold: the ratio of the medians above which a benchmark is reported as a regression.
+    :return: a list of (benchmark, params, ratio) of the regressions
+    """
+    base = {_key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        other = base.get(_key(result))
+        if other is None or other['median'] == 0:
+            continue
+        ratio = result['median'] / other['median']
+        if ratio > threshold:
+            regressions.append((result['benchmark'], result['params'], ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--samples', default='1,10,100', help='comma-separated numbers of samples')
+    parser.add_argument('--features', default='8,32,128', help='comma-separated numbers of features')
+    parser.add_argument('--cohorts', default='1,2,4', help='comma-separated numbers of bar plot cohorts')
+    parser.add_argument('--rounds', type=int, default=5, help='timed runs of every benchmark')
+    parser.add_argument('--output', help='the JSON file the results are written to')
+    parser.add_argument('--compare', help='the JSON file of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, help='the slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    def ints(text):
+        return [int(x) for x in text.split(',')]
+
+    results = run(ints(args.samples), ints(args.features), ints(args.cohorts), args.rounds)
+    for result in results:
+        params = ' '.join(f'{k}={v}' for k, v in result['params'].items())
+        print(f"{result['benchmark']:<22} {params:<34} median {result['median'] * 1000:10.3f} ms")
+
+    if args.output is not None:
+        report = {'commit': _commit(), 'python': platform.python_version(), 'shap': shap.__version__,
+                  'matplotlib': matplotlib.__version__, 'results': results}
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for benchmark, params, ratio in regressions:
+            print(f'regression: {benchmark} {params} is {ratio:.2f}x slower')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
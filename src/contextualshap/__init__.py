@@ -0,0 +1,21 @@
+import importlib
+
+# The public API and the submodules are imported on first access, so importing the package does not load shap,
+# pandas, matplotlib or openai
+_attributes = {'Session': 'session', 'get_session': 'session'}
+_submodules = ['backends', 'batch', 'cache', 'cluster', 'encoding', 'gpt', 'instrument', 'plots', 'prompts', 'ratelimit',
+               'server', 'session', 'store', 'translate']
+
+__all__ = ['Session', 'get_session']
+
+
+def __getattr__(name):
+    if name in _attributes:
+        return getattr(importlib.import_module(f'.{_attributes[name]}', __name__), name)
+    if name in _submodules:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_attributes) + _submodules)
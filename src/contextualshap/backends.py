@@ -0,0 +1,295 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import weakref
+
+# The openai package is imported on first use, see `_openai`, so these names can be replaced before that
+OpenAI = None
+AsyncOpenAI = None
+
+
+def _openai(name):
+    client_class = globals()[name]
+    if client_class is None:
+        import openai
+        client_class = globals()[name] = getattr(openai, name)
+    return client_class
+
+
+class ChatResult:
+    """
+    The result of a chat completion: its `content` string and its `usage`, a dictionary with the `prompt_tokens`,
+    `completion_tokens` and `cached_tokens` of the request (None when the backend does not report them).
+    """
+
+    def __init__(self, content, usage=None):
+        self.content = content
+        self.usage = {'prompt_tokens': None, 'completion_tokens': None, 'cached_tokens': None} if usage is None \
+            else usage
+
+    def __repr__(self):
+        return f"ChatResult(content={self.content!r}, usage={self.usage!r})"
+
+
+class Backend:
+    """
+    The interface of the language models narrating the SHAP values. The messages are OpenAI chat messages, whose content
+    is either a string or a list of `text` and `image_url` parts. `schema` is a JSON schema of the expected response,
+    a hint the backend may use to constrain or generate its output.
+
+    A backend only has to implement `complete`. The asynchronous methods run it in a thread, and the streaming methods
+    yield the whole content at once, unless they are overridden.
+    """
+
+    def complete(self, gpt_model, messages, schema=None):
+        """
+        :param gpt_model: the model of the request.
+        :param messages: the chat messages.
+        :param schema: an optional JSON schema of the response.
+        :return: a ChatResult
+        """
+        raise NotImplementedError
+
+    async def acomplete(self, gpt_model, messages, schema=None):
+        """Asynchronous version of `complete`."""
+        return await asyncio.to_thread(self.complete, gpt_model, messages, schema)
+
+    def stream(self, gpt_model, messages, schema=None):
+        """
+        Streams a chat completion.
+
+        :return: an iterator of the content strings, joined together they are the content of the response
+        """
+        yield self.complete(gpt_model, messages, schema).content
+
+    async def astream(self, gpt_model, messages, schema=None):
+        """Asynchronous version of `stream`."""
+        yield (await self.acomplete(gpt_model, messages, schema)).content
+
+    def close(self):
+        """Releases the synchronous resources of the backend."""
+
+    async def aclose(self):
+        """Releases the asynchronous resources of the backend used by the running event loop."""
+
+
+def _usage(usage):
+    if usage is None:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {'prompt_tokens': usage.prompt_tokens, 'completion_tokens': usage.completion_tokens,
+            'cached_tokens': getattr(details, 'cached_tokens', None)}
+
+
+def _response_format(schema):
+    return {'type': 'json_schema', 'json_schema': {'name': 'narration', 'schema': schema, 'strict': True}}
+
+
+class OpenAIBackend(Backend):
+    """
+    The OpenAI chat completions API. The clients are created on first use and reused by every request, one
+    `AsyncOpenAI` client is kept per event loop because asynchronous connections cannot move between event loops.
+    """
+
+    def __init__(self, openai_api_key=None, client=None, async_client=None, structured_outputs=True,
+                 **client_kwargs):
+        """
+        :param openai_api_key: an OpenAI API key, None uses the OPENAI_API_KEY environment variable.
+        :param client: an optional existing `OpenAI` client.
+        :param async_client: an optional existing `AsyncOpenAI` client, used from any event loop.
+        :param structured_outputs: setting this to false does not send the schema of the response as a JSON schema
+            `response_format`, for models or servers without structured outputs.
+        :param client_kwargs: passed to the clients created by the backend, e.g. `base_url`, `timeout` or `max_retries`.
+        """
+        self.openai_api_key = openai_api_key
+        self.structured_outputs = structured_outputs
+        self.client_kwargs = client_kwargs
+        self._client = client
+        self._async_client = async_client
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The shared `OpenAI` client."""
+        with self._lock:
+            if self._client is None:
+                self._client = _openai('OpenAI')(api_key=self.openai_api_key, **self.client_kwargs)
+            return self._client
+
+    def async_client(self):
+        """The shared `AsyncOpenAI` client of the running event loop."""
+        if self._async_client is not None:
+            return self._async_client
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = _openai('AsyncOpenAI')(api_key=self.openai_api_key, **self.client_kwargs)
+                self._async_clients[loop] = client
+            return client
+
+    def _options(self, schema):
+        # Structured outputs constrain the response to the schema, so it cannot be wrapped in markdown or miss a field
+        if schema is None or not self.structured_outputs:
+            return {}
+        return {'response_format': _response_format(schema)}
+
+    def complete(self, gpt_model, messages, schema=None):
+        completion = self.client.chat.completions.create(
+            model=gpt_model,
+            messages=messages,
+            **self._options(schema)
+        )
+        return ChatResult(completion.choices[0].message.content, _usage(getattr(completion, 'usage', None)))
+
+    async def acomplete(self, gpt_model, messages, schema=None):
+        completion = await self.async_client().chat.completions.create(
+            model=gpt_model,
+            messages=messages,
+            **self._options(schema)
+        )
+        return ChatResult(completion.choices[0].message.content, _usage(getattr(completion, 'usage', None)))
+
+    def stream(self, gpt_model, messages, schema=None):
+        stream = self.client.chat.completions.create(
+            model=gpt_model,
+            messages=messages,
+            stream=True,
+            **self._options(schema)
+        )
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+    async def astream(self, gpt_model, messages, schema=None):
+        stream = await self.async_client().chat.completions.create(
+            model=gpt_model,
+            messages=messages,
+            stream=True,
+            **self._options(schema)
+        )
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+    def close(self):
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+    async def aclose(self):
+        with self._lock:
+            client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close()
+
+
+def as_backend(client):
+    """
+    Returns the backend of a client: a Backend is returned as is, and an `OpenAI` or `AsyncOpenAI` client is wrapped
+    into an OpenAIBackend.
+    """
+    if isinstance(client, Backend):
+        return client
+    if isinstance(client, _openai('AsyncOpenAI')):
+        return OpenAIBackend(async_client=client)
+    return OpenAIBackend(client=client)
+
+
+class StubError(RuntimeError):
+    """The failure simulated by a StubBackend, a transient server error."""
+
+    status_code = 503
+
+
+def _instance(schema, text, index=0):
+    # A minimal instance of a JSON schema, enough for the response schemas of the narrations
+    if schema is None:
+        return {'explanation': text}
+    if 'enum' in schema:
+        return schema['enum'][index % len(schema['enum'])]
+    kind = schema.get('type')
+    if kind == 'object':
+        return {name: _instance(s, text, index) for name, s in schema.get('properties', {}).items()}
+    if kind == 'array':
+        items = schema.get('items', {})
+        # An array of objects with an enum property has one item per value, e.g. one explanation per feature name
+        enums = [len(p['enum']) for p in items.get('properties', {}).values() if 'enum' in p]
+        return [_instance(items, text, i) for i in range(max(1, schema.get('minItems', 1), *enums))]
+    if kind in ('integer', 'number'):
+        return 0
+    if kind == 'boolean':
+        return False
+    return text
+
+
+class StubBackend(Backend):
+    """
+    A local backend answering every request with a JSON instance of its schema, after a simulated latency and with a
+    simulated failure rate. It does not use the network, so it measures the throughput and the tail latency of the
+    package itself, and it is deterministic for a given seed when it is used from one thread.
+
+    `calls` counts the requests and `messages` keeps the messages of the last request.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, text_length=200, chunk_size=16, seed=None):
+        """
+        :param latency: the seconds every request takes.
+        :param jitter: the maximum seconds randomly added to the latency.
+        :param failure_rate: the probability of a request raising a StubError.
+        :param text_length: the number of characters of every generated string.
+        :param chunk_size: the number of characters of every streamed chunk.
+        :param seed: an optional seed of the latency and failure random draws.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.text_length = text_length
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self.messages = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self, messages):
+        with self._lock:
+            self.calls += 1
+            self.messages = messages
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.failure_rate
+        return delay, failed
+
+    def _result(self, gpt_model, messages, schema, failed):
+        if failed:
+            raise StubError(f"Simulated failure of the {gpt_model} stub")
+        text = ('lorem ipsum ' * (self.text_length // 12 + 1))[:self.text_length]
+        content = json.dumps(_instance(schema, text))
+        prompt = json.dumps(messages)
+        return ChatResult(content, {'prompt_tokens': len(prompt) // 4 + 1, 'completion_tokens': len(content) // 4 + 1,
+                                    'cached_tokens': 0})
+
+    def complete(self, gpt_model, messages, schema=None):
+        delay, failed = self._draw(messages)
+        time.sleep(delay)
+        return self._result(gpt_model, messages, schema, failed)
+
+    async def acomplete(self, gpt_model, messages, schema=None):
+        delay, failed = self._draw(messages)
+        await asyncio.sleep(delay)
+        return self._result(gpt_model, messages, schema, failed)
+
+    def stream(self, gpt_model, messages, schema=None):
+        content = self.complete(gpt_model, messages, schema).content
+        for i in range(0, len(content), self.chunk_size):
+            yield content[i:i + self.chunk_size]
+
+    async def astream(self, gpt_model, messages, schema=None):
+        content = (await self.acomplete(gpt_model, messages, schema)).content
+        for i in range(0, len(content), self.chunk_size):
+            yield content[i:i + self.chunk_size]
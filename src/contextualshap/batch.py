@@ -0,0 +1,229 @@
+import json
+import time
+from . import gpt, plots
+from .session import get_session, _or
+from .cache import cache_key
+from .backends import _response_format
+from .common import _features_schema, _output_names, _parse, _validate, explanation_schema, features_schema
+
+endpoint = '/v1/chat/completions'
+# The parser of each kind of request, with the schema its invalid responses are repaired with
+_parsers = {'explain': (gpt._result, features_schema), 'waterfall': (plots._explanation, explanation_schema),
+            'bar': (plots._explanation, explanation_schema)}
+_finished = ['completed', 'failed', 'expired', 'cancelled']
+
+
+def _custom_id(kind, gpt_model, messages, language, reader):
+    # The ID is the content address of the request, so it is stable between runs and names the parser of the result
+    return f"{kind}-{cache_key(gpt_model, messages, language, reader)}"
+
+
+def _content(line):
+    if line.get('error') is not None:
+        raise RuntimeError(f"Batch request {line['custom_id']} failed: {line['error']}")
+    response = line['response']
+    if response['status_code'] != 200:
+        raise RuntimeError(f"Batch request {line['custom_id']} failed with status {response['status_code']}: "
+                           f"{response['body']}")
+    return response['body']['choices'][0]['message']['content']
+
+
+def ingest(path, cache=None):
+    """
+    Reads a Batch API output (or error) JSONL file into the normal results: summary and DataFrame for `explain`
+    requests, and explanation strings for `waterfall` and `bar` requests.
+
+    :param path: the JSONL file.
+    :param cache: an optional narration cache (see `contextualshap.cache`) to store the narrations in, so later
+        interactive calls with the same inputs are answered without calling the API.
+    :return: a dictionary mapping custom IDs to their result, or the exception raised while parsing that result. An
+        invalid response is repaired when its required members can be recovered, and only then stored in the cache.
+    """
+    results = {}
+    with open(path) as f:
+        for text in f:
+            if not text.strip():
+                continue
+            line = json.loads(text)
+            custom_id = line['custom_id']
+            kind, _, key = custom_id.partition('-')
+            try:
+                parse, schema = _parsers[kind]
+                results[custom_id], content = _parse(parse, _content(line), schema)
+                if cache is not None:
+                    cache.set(key, content)
+            except Exception as e:
+                results[custom_id] = e
+    return results
+
+
+class BatchJob:
+    """
+    A job narrating many inputs through the OpenAI Batch API, which trades latency (up to 24 hours) for throughput and
+    a lower price. Requests are added with `add_explain`, `add_waterfall` and `add_bar`, written to a JSONL file with
+    `write`, then submitted with `submit` and collected with `wait` and `ingest`, or all at once with `run`.
+
+    Custom IDs are the content address of the requests, so the same inputs always get the same ID and duplicated
+    requests are sent once. Every request carries the JSON schema of its response as a strict `response_format`, and
+    the schema of an explanation only allows its feature names. Invalid responses are repaired, but features missing
+    from an explanation are not requested again, since the batch has already finished. Parameters left to None fall
+    back to the defaults of the session.
+    """
+
+    def __init__(self, session=None):
+        """
+        :param session: the `contextualshap.session.Session` of the defaults and the OpenAI client, None uses the
+            session of the OPENAI_API_KEY environment variable.
+        """
+        self.session = get_session() if session is None else session
+        self.custom_ids = []
+        self._requests = {}
+
+    def __len__(self):
+        return len(self.custom_ids)
+
+    def _add(self, kind, messages, gpt_model, language, reader, schema):
+        custom_id = _custom_id(kind, gpt_model, messages, language, reader)
+        if custom_id not in self._requests:
+            body = {'model': gpt_model, 'messages': messages, 'response_format': _response_format(schema)}
+            self._requests[custom_id] = {'custom_id': custom_id, 'method': 'POST', 'url': endpoint, 'body': body}
+        self.custom_ids.append(custom_id)
+        return custom_id
+
+    def add_explain(self, shap_values, feature_aliases=None, feature_descriptions=None, gpt_model=None,
+                    additional_background=None, language=None, reader=None, table_format='markdown',
+                    precision=None):
+        """
+        Adds the request of `contextualshap.gpt.explain`, multi-output SHAP values are not supported.
+
+        :return: the custom ID of the request
+        """
+        # A multi-output narration is parsed with its output names, which a custom ID cannot carry to `ingest`
+        gpt._single_output(shap_values, 'Batch jobs')
+        options = self.session._options(feature_aliases, feature_descriptions, additional_background, gpt_model,
+                                        language, reader, None)
+        _validate(options['language'], options['reader'])
+        messages = gpt._messages(shap_values, options['feature_aliases'], options['feature_descriptions'],
+                                 options['additional_background'], options['language'], options['reader'],
+                                 table_format, precision)
+        return self._add('explain', messages, options['gpt_model'], options['language'], options['reader'],
+                         _features_schema(shap_values[0].feature_names))
+
+    def add_waterfall(self, explanation, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                      gpt_model=None, language=None, reader=None, mode='image', image_encoding=None, **kwargs):
+        """
+        Adds the request of `contextualshap.plots.waterfall`, the plot is rendered without being shown.
+
+        :return: the custom ID of the request
+        """
+        plots._single_output(_output_names(explanation, 1), 'Batch jobs')
+        options = self.session._options(feature_aliases, feature_descriptions, additional_background, gpt_model,
+                                        language, reader, None)
+        _validate(options['language'], options['reader'])
+        image = plots._render_waterfalls([explanation], options['feature_aliases'], mode,
+                                         _or(image_encoding, self.session.image_encoding), **kwargs)[0]
+        if isinstance(image, Exception):
+            raise image
+        messages = plots._waterfall_prompt(image, explanation, options['feature_aliases'],
+                                           options['feature_descriptions'], options['additional_background'],
+                                           options['language'], options['reader'], kwargs.get('max_display', 10))
+        return self._add('waterfall', messages, options['gpt_model'], options['language'], options['reader'],
+                         explanation_schema)
+
+    def add_bar(self, shap_values, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                gpt_model=None, language=None, reader=None, mode='image', image_encoding=None, **kwargs):
+        """
+        Adds the request of `contextualshap.plots.bar`, the plot is rendered without being shown.
+
+        :return: the custom ID of the request
+        """
+        plots._single_output(plots._bar_outputs(shap_values), 'Batch jobs')
+        options = self.session._options(feature_aliases, feature_descriptions, additional_background, gpt_model,
+                                        language, reader, None)
+        _validate(options['language'], options['reader'])
+        rendered = plots._render_bars([shap_values], options['feature_aliases'], mode,
+                                      _or(image_encoding, self.session.image_encoding), **kwargs)[0]
+        if isinstance(rendered, Exception):
+            raise rendered
+        image, original_feature_names, _ = rendered
+        messages = plots._bar_prompt(image, original_feature_names, shap_values, options['feature_aliases'],
+                                     options['feature_descriptions'], options['additional_background'],
+                                     options['language'], options['reader'], kwargs.get('max_display', 10))
+        return self._add('bar', messages, options['gpt_model'], options['language'], options['reader'],
+                         explanation_schema)
+
+    def write(self, path):
+        """
+        Writes the requests to a Batch API input JSONL file, one line per distinct request.
+
+        :param path: the JSONL file.
+        :return: the number of lines written
+        """
+        with open(path, 'w') as f:
+            for request in self._requests.values():
+                f.write(json.dumps(request))
+                f.write('\n')
+        return len(self._requests)
+
+    def submit(self, path, completion_window='24h'):
+        """
+        Uploads a JSONL file written by `write` and creates its batch.
+
+        :param path: the JSONL file.
+        :param completion_window: the time frame of the batch.
+        :return: the batch ID
+        """
+        client = self.session.client
+        with open(path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose='batch')
+        return client.batches.create(input_file_id=input_file.id, endpoint=endpoint,
+                                     completion_window=completion_window).id
+
+    def wait(self, batch_id, path, poll_interval=60, timeout=None):
+        """
+        Polls a batch until it finishes, then downloads its output and error files into one JSONL file.
+
+        :param batch_id: the batch ID returned by `submit`.
+        :param path: the JSONL file the results are written to.
+        :param poll_interval: the number of seconds between two polls.
+        :param timeout: an optional number of seconds after which a TimeoutError is raised.
+        :return: the final batch object
+        """
+        client = self.session.client
+        start = time.monotonic()
+        batch = client.batches.retrieve(batch_id)
+        while batch.status not in _finished:
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError(f"Batch {batch_id} is still {batch.status}")
+            time.sleep(poll_interval)
+            batch = client.batches.retrieve(batch_id)
+
+        with open(path, 'w') as f:
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is not None:
+                    f.write(client.files.content(file_id).text)
+        return batch
+
+    def ingest(self, path, cache=None):
+        """
+        Reads a results JSONL file, see `contextualshap.batch.ingest`.
+
+        :return: a list in the order the requests were added, each item is either the result or the exception raised
+            for that request
+        """
+        results = ingest(path, cache)
+        return [results.get(custom_id, LookupError(f"No result for batch request {custom_id}"))
+                for custom_id in self.custom_ids]
+
+    def run(self, input_path, output_path, poll_interval=60, timeout=None, cache=None):
+        """
+        Writes, submits and waits for the batch, then ingests its results.
+
+        :param input_path: the JSONL file the requests are written to.
+        :param output_path: the JSONL file the results are written to.
+        :return: a list in the order the requests were added, see `ingest`
+        """
+        self.write(input_path)
+        batch_id = self.submit(input_path)
+        self.wait(batch_id, output_path, poll_interval, timeout)
+        return self.ingest(output_path, cache)
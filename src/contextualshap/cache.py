@@ -0,0 +1,210 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(gpt_model, messages, language, reader):
+    """
+    Returns a content address for a narration request. The messages contain the final prompt and the base64 encoded
+    image, so two requests share a key only when they would send exactly the same bytes to the same model.
+
+    :param gpt_model: the GPT model of the request
+    :param messages: the chat messages of the request
+    :param language: the language of the response
+    :param reader: the reader level of comprehension
+    :return: a hex string
+    """
+    h = hashlib.sha256()
+    h.update(json.dumps([gpt_model, language, reader, messages], sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class MemoryCache:
+    """
+    An in-memory least recently used cache of narrations.
+
+    A cache is any object with a `get(key)` method returning the cached string or None, and a `set(key, value)` method.
+    `hits` and `misses` count the lookups of the cache.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None):
+        """
+        :param max_entries: the number of narrations kept, the least recently used one is evicted first
+        :param ttl: an optional number of seconds after which a narration expires
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, key, ttl=None):
+        # The value and creation time of a narration, expired after `ttl` seconds or the TTL of the cache
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and ttl is not None and time.time() - entry[1] > ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def get(self, key):
+        return self._entry(key)[0]
+
+    def set(self, key, value, created=None):
+        with self._lock:
+            self._entries[key] = (value, time.time() if created is None else created)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+    A persistent cache of narrations stored in a SQLite database, so it can be shared by processes and survives
+    restarts. See `MemoryCache` for the cache interface.
+    """
+
+    def __init__(self, path, max_entries=None, ttl=None):
+        """
+        :param path: the SQLite database file
+        :param max_entries: an optional number of narrations kept, the least recently used one is evicted first
+        :param ttl: an optional number of seconds after which a narration expires
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS narrations '
+                         '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS narrations_accessed ON narrations (accessed)')
+        self._db.commit()
+
+    def _entry(self, key):
+        # The value and creation time of a narration
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM narrations WHERE key = ?', (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM narrations WHERE key = ?', (key,))
+                self._db.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None, None
+
+            self._db.execute('UPDATE narrations SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+            return row
+
+    def get(self, key):
+        return self._entry(key)[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO narrations (key, value, created, accessed) VALUES (?, ?, ?, ?)',
+                             (key, value, now, now))
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        if self.ttl is not None:
+            self._db.execute('DELETE FROM narrations WHERE created < ?', (now - self.ttl,))
+        if self.max_entries is not None:
+            self._db.execute('DELETE FROM narrations WHERE key IN '
+                             '(SELECT key FROM narrations ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                             (self.max_entries,))
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM narrations')
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM narrations').fetchone()[0]
+
+
+def _entry(cache, key, ttl=None):
+    # The value and creation time of a narration, the time is None for the caches which do not keep it
+    if isinstance(cache, MemoryCache):
+        return cache._entry(key, ttl)
+    if isinstance(cache, SQLiteCache):
+        return cache._entry(key)
+    return cache.get(key), None
+
+
+def _set(cache, key, value, created):
+    if isinstance(cache, MemoryCache):
+        cache.set(key, value, created)
+    else:
+        cache.set(key, value)
+
+
+class TieredCache:
+    """
+    A cache looking up a fast tier (usually a `MemoryCache`) before a persistent tier (usually a `SQLiteCache`).
+    Narrations found in the persistent tier are copied to the fast tier with their creation time, and a `MemoryCache`
+    tier expires them with the TTL of the persistent tier, so both tiers stop serving a narration at the same time. See
+    `MemoryCache` for the cache interface, `hits` and `misses` count the lookups of both tiers together.
+    """
+
+    def __init__(self, memory, disk, ttl=None):
+        """
+        :param memory: the cache looked up first
+        :param disk: the cache looked up when the first one misses
+        :param ttl: an optional number of seconds after which a narration of the first cache expires, None uses the
+            TTL of the second cache
+        """
+        self.memory = memory
+        self.disk = disk
+        self.ttl = getattr(disk, 'ttl', None) if ttl is None else ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value, _ = _entry(self.memory, key, self.ttl)
+        if value is None:
+            value, created = _entry(self.disk, key)
+            if value is not None:
+                _set(self.memory, key, value, created)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        _set(self.memory, key, value, time.time())
+        self.disk.set(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
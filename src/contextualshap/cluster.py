@@ -0,0 +1,117 @@
+import numpy as np
+from .common import _LazyModule
+from .instrument import span
+
+shap = _LazyModule('shap')
+
+
+def _values(shap_values):
+    if isinstance(shap_values, shap.Explanation):
+        values = np.asarray(shap_values.values, dtype=float)
+    else:
+        values = np.stack([np.asarray(sv.values, dtype=float) for sv in shap_values])
+    if values.ndim != 2:
+        raise ValueError("Clustering is not supported for multi-output SHAP values")
+    return values
+
+
+def _distances(values, centers):
+    # Squared euclidean distances of every row to every center, without the (n, k, features) difference array
+    d = (values ** 2).sum(axis=1)[:, None] - 2 * values @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+    return np.maximum(d, 0)
+
+
+def _init(values, n_clusters, rng):
+    # k-means++: each new center is drawn with a probability proportional to its squared distance to the chosen ones
+    centers = [values[rng.integers(len(values))]]
+    closest = _distances(values, np.array(centers))[:, 0]
+    while len(centers) < n_clusters and closest.sum() > 0:
+        centers.append(values[rng.choice(len(values), p=closest / closest.sum())])
+        closest = np.minimum(closest, _distances(values, centers[-1][None, :])[:, 0])
+    return np.array(centers)
+
+
+def kmeans(values, n_clusters, seed=0, max_iter=100):
+    """
+    Groups the rows of a SHAP values array with k-means. The SHAP values of every feature share the unit of the model
+    output, so the rows are clustered as they are.
+
+    :param values: a 2D array of SHAP values, one row per sample.
+    :param n_clusters: the maximum number of clusters, fewer are returned when there are fewer distinct rows.
+    :param seed: the seed of the k-means++ initialization.
+    :param max_iter: the maximum number of k-means iterations.
+    :return: the cluster label of each row and the centers of the clusters
+    """
+    values = np.asarray(values, dtype=float)
+    centers = _init(values, min(n_clusters, len(values)), np.random.default_rng(seed))
+    labels = None
+    for _ in range(max_iter):
+        new_labels = _distances(values, centers).argmin(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        for k in range(len(centers)):
+            members = values[labels == k]
+            if len(members):
+                centers[k] = members.mean(axis=0)
+
+    # Clusters left empty by the last update are dropped and the labels renumbered
+    used, labels = np.unique(labels, return_inverse=True)
+    return labels, centers[used]
+
+
+def _similarity(values, representatives):
+    # Cosine similarity of each row to the representative of its cluster, identical rows (zero ones included) have a similarity of 1
+    norms = np.linalg.norm(values, axis=1) * np.linalg.norm(representatives, axis=1)
+    dots = (values * representatives).sum(axis=1)
+    similarity = np.clip(dots / np.where(norms > 0, norms, 1), -1, 1)
+    same = (values == representatives).all(axis=1)
+    return np.where(same, 1.0, similarity)
+
+
+class Clusters:
+    """
+    The samples of a batch grouped by their SHAP values, with one narration per cluster.
+
+    `labels` is the cluster of each sample, `representatives` the index of the sample closest to the center of each
+    cluster, `similarity` the cosine similarity of the SHAP values of each sample to those of its representative, from
+    -1 to 1, and `narrations` the narration of each representative, or the exception raised while narrating it.
+    Indexing a Clusters with a sample index returns the narration of its cluster and its similarity.
+    """
+
+    def __init__(self, labels, representatives, similarity, narrations=None):
+        self.labels = labels
+        self.representatives = representatives
+        self.similarity = similarity
+        self.narrations = narrations
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return self.narrations[self.labels[index]], float(self.similarity[index])
+
+    def __repr__(self):
+        return f"Clusters(samples={len(self.labels)}, clusters={len(self.representatives)})"
+
+
+def cluster(shap_values, n_clusters=8, seed=0, max_iter=100):
+    """
+    Groups samples with similar SHAP values and picks the sample closest to the center of each group, so a batch can be
+    narrated with one request per cluster instead of one per sample.
+
+    :param shap_values: the SHAP values of the samples, a `shap.Explanation` or a list of single-sample explanations.
+    :param n_clusters: the maximum number of clusters.
+    :param seed: the seed of the k-means++ initialization.
+    :param max_iter: the maximum number of k-means iterations.
+    :return: a Clusters without narrations
+    """
+    with span('cluster', samples=len(shap_values)) as s:
+        values = _values(shap_values)
+        labels, centers = kmeans(values, n_clusters, seed, max_iter)
+        distances = _distances(values, centers)
+        representatives = np.array([np.flatnonzero(labels == k)[distances[labels == k, k].argmin()]
+                                    for k in range(len(centers))])
+        similarity = _similarity(values, values[representatives[labels]])
+        s.set(clusters=len(centers))
+    return Clusters(labels, representatives, similarity)
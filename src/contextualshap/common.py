@@ -1,3 +1,28 @@
+import asyncio
+import csv
+import importlib
+import io
+import json
+import numpy as np
+from .cache import cache_key
+from .instrument import span
+
+
+class _LazyModule:
+    """A module imported on its first attribute access, so the heavy dependencies (shap, pandas, matplotlib) are only
+    loaded by the code paths which use them."""
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, name):
+        # The imported module is cached in sys.modules, later accesses cost a dictionary lookup
+        return getattr(importlib.import_module(self.__name), name)
+
+    def __repr__(self):
+        return f"<lazy module {self.__name!r}>"
+
+
 languages = {
     'aa': 'Afar',
     'ab': 'Abkhazian',
@@ -198,18 +223,511 @@ def _table(list_of_dicts):
 
     list_of_dicts -- Each dict is a row
     """
-    v = ""
     # Make a string of all the keys in the first dict with pipes before after and between each key
     head = f"| {" | ".join(map(str, list_of_dicts[0].keys()))} |"
     # Make a header separator line with dashes instead of key names
     sep = f"{"|-----" * len(list_of_dicts[0].keys())}|"
-    # Add the header row and separator to the table
-    v += head + "\n"
-    v += sep + "\n"
-
-    for row in list_of_dicts:
-        md_row = ""
-        for key, col in row.items():
-            md_row += f"| {str(col)} "
-        v += md_row + "|\n"
-    return v
\ No newline at end of file
+    rows = [f"| {" | ".join(map(str, row.values()))} |" for row in list_of_dicts]
+    return "\n".join([head, sep, *rows]) + "\n"
+
+
+table_formats = ['markdown', 'csv', 'json']
+
+
+def _column(values, precision=None):
+    """Converts a column of values to an array of strings.
+
+    values -- an array-like column
+    precision -- an optional number of significant digits of floating point values, None keeps every digit
+    """
+    values = np.asarray(values)
+    if precision is not None and values.dtype.kind == 'f':
+        return np.char.mod(f'%.{precision}g', values)
+    return values.astype(str)
+
+
+def _serialize(columns, table_format='markdown', precision=None):
+    """Converts columns of values to a markdown, CSV or compact JSON table without building a dict per cell.
+
+    columns -- a dict of column name to a 1-D array-like column, all columns have the same length
+    table_format -- one of `table_formats`
+    precision -- an optional number of significant digits of floating point values, None keeps every digit
+    """
+    names = list(columns)
+    cells = [_column(c, precision) for c in columns.values()]
+
+    if table_format == 'markdown':
+        # Same output as `_table`
+        head = f"| {" | ".join(names)} |"
+        sep = f"{"|-----" * len(names)}|"
+        row = f"| {" | ".join(["{}"] * len(names))} |"
+        return "\n".join([head, sep, *map(row.format, *cells)]) + "\n"
+
+    if table_format == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow(names)
+        writer.writerows(zip(*cells))
+        return buf.getvalue()
+
+    if table_format == 'json':
+        # Numbers are written as JSON numbers, everything else as JSON strings
+        for i, c in enumerate(columns.values()):
+            kind = np.asarray(c).dtype.kind
+            if kind == 'f':
+                cells[i] = np.where(np.isfinite(np.asarray(c)), cells[i], 'null')
+            elif kind == 'b':
+                cells[i] = np.char.lower(cells[i])
+            elif kind not in 'iu':
+                cells[i] = [json.dumps(v, ensure_ascii=False) for v in cells[i]]
+        row = f"[{",".join(["{}"] * len(names))}]"
+        return f'{{"columns":{json.dumps(names, ensure_ascii=False, separators=(",", ":"))},' \
+               f'"rows":[{",".join(map(row.format, *cells))}]}}'
+
+    raise ValueError("Table format must be one of: " + ", ".join(table_formats))
+
+
+def _validate(language, reader):
+    """Raises ValueError when language or reader is not supported.
+
+    language -- a language code from `languages`
+    reader -- a reader key from `readers`
+    """
+    with span('validate'):
+        if language not in languages:
+            raise ValueError("Language must be one of: " + ", ".join(languages))
+
+        if reader not in readers:
+            raise ValueError("Reader must be one of: " + ", ".join(readers))
+
+
+async def _gather(tasks, concurrency):
+    """Runs coroutine functions with at most `concurrency` of them in flight at once.
+
+    tasks -- a list of zero-argument coroutine functions
+    concurrency -- maximum number of tasks running at the same time
+    Results are returned in input order. A failing task does not stop the others, its exception is returned in place
+    of its result.
+    """
+    if concurrency < 1:
+        raise ValueError("Concurrency must be at least 1")
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(task):
+        async with semaphore:
+            try:
+                return await task()
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*(run(t) for t in tasks))
+
+
+explanation_schema = {
+    'type': 'object',
+    'properties': {'explanation': {'type': 'string'}},
+    'required': ['explanation'],
+    'additionalProperties': False
+}
+
+features_schema = {
+    'type': 'object',
+    'properties': {
+        'summary': {'type': 'string'},
+        'features': {
+            'type': 'array',
+            'items': {
+                'type': 'object',
+                'properties': {'feature_name': {'type': 'string'}, 'description': {'type': 'string'},
+                               'explanation': {'type': 'string'}},
+                'required': ['feature_name', 'description', 'explanation'],
+                'additionalProperties': False
+            }
+        }
+    },
+    'required': ['summary', 'features'],
+    'additionalProperties': False
+}
+
+
+def _features_schema(feature_names):
+    # The features schema restricted to the expected feature names, which structured outputs then enforce
+    item = features_schema['properties']['features']['items']
+    feature_name = {'type': 'string', 'enum': [str(f) for f in feature_names]}
+    features = {'type': 'array', 'items': {**item, 'properties': {**item['properties'], 'feature_name': feature_name}}}
+    return {**features_schema, 'properties': {**features_schema['properties'], 'features': features}}
+
+
+batch_explanation_schema = {
+    'type': 'object',
+    'properties': {'explanations': {'type': 'array', 'items': {'type': 'string'}}},
+    'required': ['explanations'],
+    'additionalProperties': False
+}
+
+batch_features_schema = {
+    'type': 'object',
+    'properties': {'requests': {'type': 'array', 'items': features_schema}},
+    'required': ['requests'],
+    'additionalProperties': False
+}
+
+
+output_explanation_schema = {
+    'type': 'object',
+    'properties': {'outputs': {'type': 'array', 'items': {'type': 'string'}}},
+    'required': ['outputs'],
+    'additionalProperties': False
+}
+
+output_features_schema = {
+    'type': 'object',
+    'properties': {'outputs': {'type': 'array', 'items': features_schema}},
+    'required': ['outputs'],
+    'additionalProperties': False
+}
+
+
+def _outputs_schema(schema, output_names):
+    # A multi-output schema with exactly one item per output, which structured outputs then enforce
+    outputs = {**schema['properties']['outputs'], 'minItems': len(output_names), 'maxItems': len(output_names)}
+    return {**schema, 'properties': {'outputs': outputs}}
+
+
+def _output_names(explanation, ndim):
+    # A multi-output explanation (e.g. of a classifier) has one more axis than `ndim`, the last one being the outputs
+    shape = np.shape(explanation.values)
+    if len(shape) <= ndim:
+        return None
+    names = getattr(explanation, 'output_names', None)
+    if names is None or isinstance(names, str) or len(names) != shape[-1]:
+        return [f'Output {j}' for j in range(shape[-1])]
+    return list(names)
+
+
+def _outputs(content, output_names):
+    outputs = json.loads(content)['outputs']
+    if len(outputs) != len(output_names):
+        raise ValueError(f"Expected {len(output_names)} outputs, got {len(outputs)}")
+    return dict(zip(output_names, outputs))
+
+
+def _lookup(cache, gpt_model, messages, language, reader):
+    with span('cache') as s:
+        key = cache_key(gpt_model, messages, language, reader)
+        content = cache.get(key)
+        s.set(hit=content is not None)
+    return key, content
+
+
+def _request(s, gpt_model, messages):
+    # The payload size is only measured when a hook records it
+    s.set(model=gpt_model)
+    if s.enabled:
+        s.set(payload_bytes=len(json.dumps(messages)))
+
+
+def _parse(parse, content, schema=None):
+    # Returns the result and the content it was parsed from, repaired when the response was not valid
+    with span('parse') as s:
+        try:
+            return parse(content), content
+        except (ValueError, KeyError, TypeError):
+            repaired = _repair(content, schema)
+            if repaired is None:
+                raise
+        s.set(repaired=True)
+        return parse(repaired), repaired
+
+
+def _complete(backend, gpt_model, messages, parse, cache=None, language='en', reader='general', schema=None):
+    """Sends a chat completion request and parses its content, looking it up in the cache first.
+
+    backend -- a backend (see `contextualshap.backends`)
+    gpt_model -- the GPT model
+    messages -- the chat messages
+    parse -- a function parsing the response content string into the result
+    cache -- an optional narration cache, only responses that parse successfully are stored
+    language -- the language of the response, part of the cache key
+    reader -- the reader level of comprehension, part of the cache key
+    schema -- the JSON schema of the response, given to the backend as a hint and used to repair an invalid response
+    """
+    key = None
+    if cache is not None:
+        key, content = _lookup(cache, gpt_model, messages, language, reader)
+        if content is not None:
+            return _parse(parse, content, schema)[0]
+
+    with span('request') as s:
+        _request(s, gpt_model, messages)
+        response = backend.complete(gpt_model, messages, schema)
+        s.set(**response.usage)
+    result, content = _parse(parse, response.content, schema)
+    if cache is not None:
+        cache.set(key, content)
+    return result
+
+
+async def _acomplete(backend, gpt_model, messages, parse, cache=None, language='en', reader='general', schema=None):
+    """Asynchronous version of `_complete`."""
+    key = None
+    if cache is not None:
+        key, content = _lookup(cache, gpt_model, messages, language, reader)
+        if content is not None:
+            return _parse(parse, content, schema)[0]
+
+    with span('request') as s:
+        _request(s, gpt_model, messages)
+        response = await backend.acomplete(gpt_model, messages, schema)
+        s.set(**response.usage)
+    result, content = _parse(parse, response.content, schema)
+    if cache is not None:
+        cache.set(key, content)
+    return result
+
+
+def _estimate_tokens(text):
+    """Estimates the number of tokens of a text, GPT tokenizers average about 4 characters per token.
+
+    text -- the text to estimate
+    """
+    return len(text) // 4 + 1
+
+
+def _string_prefix(raw):
+    """Returns the longest prefix of a JSON string body without an incomplete escape sequence.
+
+    raw -- the characters of a JSON string after its opening quote
+    """
+    i = 0
+    while i < len(raw):
+        if raw[i] == '\\':
+            step = 6 if raw[i + 1:i + 2] == 'u' else 2
+            if i + step > len(raw):
+                break
+            i += step
+        else:
+            i += 1
+    return raw[:i]
+
+
+class _JSONStream:
+    """Incremental parser of a JSON object streamed in chunks of text.
+
+    `feed` returns the (key, value) events completed by a chunk: one event per top-level member when its value is
+    complete, and one event per item for top-level arrays, so `{"summary": "...", "features": [{...}, {...}]}` yields
+    ('summary', '...'), ('features', {...}) and ('features', {...}). The string values of `partial_keys` are yielded as
+    (key, text) deltas while they are generated. Text around the object, such as markdown code fences, is ignored.
+    """
+
+    def __init__(self, partial_keys=()):
+        self.partial_keys = set(partial_keys)
+        self._text = ''
+        self._i = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._key = None
+        self._start = None
+        self._item = None
+        self._sent = 0
+
+    def _partial(self):
+        return (self._key in self.partial_keys and self._start is not None and len(self._stack) == 1
+                and self._text[self._start] == '"')
+
+    def _delta(self, end, closed):
+        # Only the characters after the part already sent are decoded, so a long string costs linear time overall
+        start = max(self._sent, self._start + 1)
+        raw = _string_prefix(self._text[start:end])
+        delta = json.loads('"' + raw + '"')
+        if not closed and delta and '\ud800' <= delta[-1] <= '\udbff':
+            # Wait for the low surrogate of a pair split between chunks, sent again with it
+            raw = raw[:-6] if raw[-6:-4] == '\\u' else raw[:-1]
+            delta = delta[:-1]
+        self._sent = start + len(raw)
+        return delta
+
+    def feed(self, chunk):
+        self._text += chunk
+        text = self._text
+        events = []
+        while self._i < len(text):
+            i = self._i
+            c = text[i]
+            self._i += 1
+            depth = len(self._stack)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if depth == 1 and self._key is None:
+                        self._key = json.loads(text[self._start:i + 1])
+                        self._start = None
+                    elif self._partial():
+                        delta = self._delta(i, True)
+                        if delta:
+                            events.append((self._key, delta))
+                continue
+
+            if c.isspace():
+                continue
+
+            if depth == 0:
+                if c == '{':
+                    self._stack.append(c)
+            elif depth == 1:
+                if c in ',}':
+                    if self._key is not None and self._start is not None and text[self._start] != '[' \
+                            and not self._partial():
+                        events.append((self._key, json.loads(text[self._start:i])))
+                    self._key, self._start, self._sent = None, None, 0
+                    if c == '}':
+                        self._stack.pop()
+                elif c == '"':
+                    self._in_string = True
+                    if self._key is None or self._start is None:
+                        self._start = i
+                elif c != ':':
+                    if self._start is None:
+                        self._start = i
+                    if c in '{[':
+                        self._stack.append(c)
+            elif depth == 2 and self._stack[1] == '[':
+                if c in ',]':
+                    if self._item is not None:
+                        events.append((self._key, json.loads(text[self._item:i])))
+                        self._item = None
+                    if c == ']':
+                        self._stack.pop()
+                else:
+                    if self._item is None:
+                        self._item = i
+                    if c == '"':
+                        self._in_string = True
+                    elif c in '{[':
+                        self._stack.append(c)
+            elif c == '"':
+                self._in_string = True
+            elif c in '{[':
+                self._stack.append(c)
+            elif c in '}]':
+                self._stack.pop()
+
+        if self._in_string and self._partial():
+            delta = self._delta(self._i, False)
+            if delta:
+                events.append((self._key, delta))
+        return events
+
+    def close(self):
+        # The event of the last item of an array cut before its closing bracket, when the item itself is complete
+        if len(self._stack) != 2 or self._stack[1] != '[' or self._item is None:
+            return []
+        try:
+            item, _ = json.JSONDecoder().raw_decode(self._text, self._item)
+        except ValueError:
+            return []
+        return [(self._key, item)]
+
+
+def _repair(content, schema):
+    """Recovers the members of a JSON response wrapped in markdown or other text, or truncated, None when the required
+    members cannot be recovered. Only the complete items of a truncated array are kept, and a truncated string is kept
+    up to where it was cut.
+
+    content -- the response content
+    schema -- the JSON schema of the response
+    """
+    if schema is None:
+        return None
+    properties = schema.get('properties', {})
+    strings = [k for k, p in properties.items() if p.get('type') == 'string']
+    try:
+        parser = _JSONStream(strings)
+        events = parser.feed(content) + parser.close()
+    except ValueError:
+        return None
+
+    response = {}
+    for key, value in events:
+        if key not in properties:
+            continue
+        if key in strings:
+            response[key] = response.get(key, '') + value
+        elif properties[key].get('type') == 'array':
+            response.setdefault(key, []).append(value)
+        else:
+            response[key] = value
+    for key in schema.get('required', []):
+        if key not in response:
+            if properties.get(key, {}).get('type') != 'array':
+                return None
+            # A missing array is left empty, the caller may request its items again
+            response[key] = []
+    return json.dumps(response, ensure_ascii=False)
+
+
+def _stream(backend, gpt_model, messages, parse, partial_keys=(), cache=None, language='en', reader='general',
+            schema=None):
+    """Sends a streamed chat completion request and yields the (key, value) events of its JSON content as soon as they
+    are complete, see `_JSONStream`. A cached response is replayed without calling the API.
+
+    backend -- a backend (see `contextualshap.backends`)
+    gpt_model -- the GPT model
+    messages -- the chat messages
+    parse -- a function parsing the whole response content, it validates the response once the stream ends
+    partial_keys -- the keys whose string values are yielded as deltas
+    cache -- an optional narration cache, only responses that parse successfully are stored
+    language -- the language of the response, part of the cache key
+    reader -- the reader level of comprehension, part of the cache key
+    schema -- the JSON schema of the response, given to the backend as a hint
+    """
+    parser = _JSONStream(partial_keys)
+    key = None
+    if cache is not None:
+        key, content = _lookup(cache, gpt_model, messages, language, reader)
+        if content is not None:
+            yield from parser.feed(content)
+            return
+
+    chunks = []
+    with span('request', stream=True) as s:
+        _request(s, gpt_model, messages)
+        for delta in backend.stream(gpt_model, messages, schema):
+            chunks.append(delta)
+            yield from parser.feed(delta)
+
+    _, content = _parse(parse, ''.join(chunks), schema)
+    if cache is not None:
+        cache.set(key, content)
+
+
+async def _astream(backend, gpt_model, messages, parse, partial_keys=(), cache=None, language='en', reader='general',
+                   schema=None):
+    """Asynchronous version of `_stream`."""
+    parser = _JSONStream(partial_keys)
+    key = None
+    if cache is not None:
+        key, content = _lookup(cache, gpt_model, messages, language, reader)
+        if content is not None:
+            for event in parser.feed(content):
+                yield event
+            return
+
+    chunks = []
+    with span('request', stream=True) as s:
+        _request(s, gpt_model, messages)
+        async for delta in backend.astream(gpt_model, messages, schema):
+            chunks.append(delta)
+            for event in parser.feed(delta):
+                yield event
+
+    _, content = _parse(parse, ''.join(chunks), schema)
+    if cache is not None:
+        cache.set(key, content)
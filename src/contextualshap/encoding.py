@@ -0,0 +1,110 @@
+import base64
+import io
+import threading
+from collections import deque
+from .common import _LazyModule
+from .instrument import span
+
+image_formats = ['png', 'jpeg', 'webp']
+details = ['auto', 'low', 'high']
+plt = _LazyModule('matplotlib.pyplot')
+
+
+class ImageEncoding:
+    """
+    How the plots are encoded before they are sent to GPT. The default encoding is a PNG at the Matplotlib DPI, a
+    smaller and lossy image lowers the upload size and the vision tokens of each request at the cost of legibility.
+
+    The last `history` encoded images are recorded in `payloads`, a sequence of dictionaries with the `format`, `width`
+    and `height` of the image, its `image_bytes` and the `payload_bytes` of the base64 data URL sent in the request.
+    """
+
+    def __init__(self, image_format='png', dpi=None, max_size=None, quality=None, detail=None, history=100):
+        """
+        :param image_format: 'png', 'jpeg' or 'webp'.
+        :param dpi: the resolution of the image, None uses the Matplotlib `savefig.dpi` setting.
+        :param max_size: an optional maximum width and height in pixels, the resolution is lowered to fit it.
+        :param quality: the quality of 'jpeg' and 'webp' images from 1 to 100, None uses the Pillow default.
+        :param detail: the OpenAI image `detail` level, 'auto', 'low' or 'high', None leaves it to the API default.
+            'low' costs a fixed small number of tokens and is enough for plots with few features.
+        :param history: the number of encoded images recorded in `payloads`, the oldest one is dropped first, so a
+            long-lived session does not grow without bound.
+        """
+        if image_format not in image_formats:
+            raise ValueError("Image format must be one of: " + ", ".join(image_formats))
+        if detail is not None and detail not in details:
+            raise ValueError("Detail must be one of: " + ", ".join(details))
+        if quality is not None and image_format == 'png':
+            raise ValueError("Quality only applies to the jpeg and webp image formats")
+
+        self.image_format = image_format
+        self.dpi = dpi
+        self.max_size = max_size
+        self.quality = quality
+        self.detail = detail
+        self.payloads = deque(maxlen=history)
+        self._payload_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def payload_bytes(self):
+        """The total payload bytes of the images encoded so far, including those no longer in `payloads`."""
+        with self._lock:
+            return self._payload_bytes
+
+    def _dpi(self, figure):
+        dpi = self.dpi if self.dpi is not None else plt.rcParams['savefig.dpi']
+        if dpi == 'figure':
+            dpi = figure.dpi
+        if self.max_size is not None:
+            dpi = min(dpi, self.max_size / max(figure.get_size_inches()))
+        return dpi
+
+    def __getstate__(self):
+        # Only the settings are sent to the rendering processes, the payloads are recorded by the calling process
+        state = self.__dict__.copy()
+        state['payloads'] = deque(maxlen=self.payloads.maxlen)
+        state['_payload_bytes'] = 0
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _save(self, figure):
+        dpi = self._dpi(figure)
+        kwargs = {} if self.quality is None else {'pil_kwargs': {'quality': self.quality}}
+
+        with span('render', format=self.image_format) as s:
+            buf = io.BytesIO()
+            figure.savefig(buf, format=self.image_format, dpi=dpi, **kwargs)
+            data = buf.getvalue()
+            buf.close()
+            s.set(image_bytes=len(data))
+
+        width, height = (round(x * dpi) for x in figure.get_size_inches())
+        return data, width, height
+
+    def _image(self, data, width, height):
+        with span('encode') as s:
+            url = f"data:image/{self.image_format};base64,{base64.b64encode(data).decode()}"
+            s.set(payload_bytes=len(url))
+        with self._lock:
+            self.payloads.append({'format': self.image_format, 'width': width, 'height': height,
+                                  'image_bytes': len(data), 'payload_bytes': len(url)})
+            self._payload_bytes += len(url)
+
+        image = {"url": url}
+        if self.detail is not None:
+            image["detail"] = self.detail
+        return image
+
+    def encode(self, figure=None):
+        """
+        Encodes a figure into the `image_url` content of a chat message.
+
+        :param figure: a Matplotlib figure, None encodes the current figure.
+        :return: a dictionary with the data `url` of the image and its `detail` level
+        """
+        return self._image(*self._save(plt.gcf() if figure is None else figure))
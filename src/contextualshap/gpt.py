@@ -1,15 +1,444 @@
-from openai import OpenAI
-import shap
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import functools
 import json
-import pandas as pd
-from .common import _table, languages, readers
+import numpy as np
+from . import session
+from .backends import as_backend
+from .instrument import span
+from .prompts import prompt_template
+from .common import _LazyModule, _acomplete, _astream, _column, _complete, _estimate_tokens, _features_schema, _gather, _output_names, _outputs, _outputs_schema, _serialize, _stream, _validate, output_features_schema
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
 
-def explain(shap_values: list[shap.Explanation], feature_aliases: dict, feature_descriptions: dict, openai_api_key = None, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general'):
+shap = _LazyModule('shap')
+pd = _LazyModule('pandas')
+
+
+def _shap_columns(shap_values, output_names=None):
+    # Works on the whole values/data arrays instead of one dict per (sample, feature) cell
+    if isinstance(shap_values, shap.Explanation):
+        values = np.asarray(shap_values.values)
+        data = np.asarray(shap_values.data)
+    else:
+        values = np.stack([np.asarray(sv.values) for sv in shap_values])
+        data = np.stack([np.asarray(sv.data) for sv in shap_values])
+
+    n_samples, n_features = values.shape[:2]
+    columns = {'Sample Number': np.repeat(np.arange(n_samples), n_features),
+               'Feature Name': np.tile(np.asarray(shap_values[0].feature_names, dtype=object), n_samples),
+               'Input Value': data.reshape(-1)}
+    if output_names is None:
+        columns['SHAP Value'] = values.reshape(-1)
+    else:
+        # One SHAP value column per output, sliced from a (sample * feature, output) view of the values
+        rows = values.reshape(n_samples * n_features, -1)
+        for j, name in enumerate(output_names):
+            columns[f'SHAP Value ({name})'] = rows[:, j]
+    return columns
+
+
+def _single_output(shap_values, feature):
+    if _output_names(shap_values[0], 1) is not None:
+        raise ValueError(f"{feature} is not supported for multi-output SHAP values")
+
+
+def _messages(shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+              table_format='markdown', precision=None, output_names=None):
+    with span('prompt'):
+        template = prompt_template('explain' if output_names is None else 'explain_outputs',
+                                   shap_values[0].feature_names, feature_aliases, feature_descriptions,
+                                   additional_background, language, reader)
+        return template.messages(_serialize(_shap_columns(shap_values, output_names), table_format, precision))
+
+
+def _batch_messages(shap_values_list, feature_aliases, feature_descriptions, additional_background, language, reader,
+                    table_format='markdown', precision=None):
+    # One prompt for the SHAP values of several requests, told apart by their request number
+    for sv in shap_values_list:
+        _single_output(sv, 'Batching requests')
+    with span('prompt'):
+        template = prompt_template('explain_batch', shap_values_list[0][0].feature_names, feature_aliases,
+                                   feature_descriptions, additional_background, language, reader)
+        columns = [_shap_columns(sv) for sv in shap_values_list]
+        table = {'Request Number': np.repeat(np.arange(len(columns)), [len(c['Feature Name']) for c in columns])}
+        for name in columns[0]:
+            table[name] = np.concatenate([c[name] for c in columns])
+        return template.messages(_serialize(table, table_format, precision))
+
+
+def _batch_results(content, n):
+    requests = json.loads(content)['requests']
+    if len(requests) != n:
+        raise ValueError(f"Expected {n} explanations, got {len(requests)}")
+    return [(r['summary'], pd.DataFrame(r['features'])) for r in requests]
+
+
+def _result(content):
+    response = json.loads(content)
+    return response['summary'], pd.DataFrame(response['features'])
+
+
+def _output_results(content, output_names):
+    return {name: (o['summary'], pd.DataFrame(o['features'])) for name, o in _outputs(content, output_names).items()}
+
+
+def _response(shap_values):
+    # A multi-output explanation is narrated with one summary and features per output, in a single request
+    output_names = _output_names(shap_values[0], 1)
+    if output_names is None:
+        return None, _result, _features_schema(shap_values[0].feature_names)
+    return output_names, functools.partial(_output_results, output_names=output_names), \
+        _outputs_schema(output_features_schema, output_names)
+
+
+def _feature_subset(shap_values, index):
+    if isinstance(shap_values, shap.Explanation):
+        values, data = np.asarray(shap_values.values), np.asarray(shap_values.data)
+    else:
+        values = np.stack([np.asarray(sv.values) for sv in shap_values])
+        data = np.stack([np.asarray(sv.data) for sv in shap_values])
+    feature_names = shap_values[0].feature_names
+    return shap.Explanation(values=values[:, index], data=data[:, index],
+                            feature_names=[feature_names[i] for i in index])
+
+
+def _valid_features(features, feature_names, feature_aliases, explained=True):
+    # The first row of each expected feature with an explanation, the model may name a feature by its alias
+    names = {str((feature_aliases or {}).get(f, f)): f for f in feature_names}
+    names.update({str(f): f for f in feature_names})
+    valid = {}
+    for row in features.to_dict('records'):
+        name = names.get(str(row.get('feature_name')))
+        explanation = row.get('explanation')
+        if name is not None and name not in valid and (
+                not explained or isinstance(explanation, str) and explanation.strip()):
+            valid[name] = row
+    return valid
+
+
+def _follow_up(result, shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+               table_format='markdown', precision=None):
+    # The messages requesting again only the features missing from an explanation, or invalid in it, or None
+    feature_names = list(shap_values[0].feature_names)
+    valid = _valid_features(result[1], feature_names, feature_aliases)
+    missing = [i for i, f in enumerate(feature_names) if f not in valid]
+    if not missing:
+        return None, valid
+    with span('follow_up', missing=len(missing)):
+        # The template of every feature is reused, so the prefix is the same bytes as in the first request and can
+        # be served from the provider prefix cache, and only the rows of the missing features are sent after it
+        template = prompt_template('explain', feature_names, feature_aliases, feature_descriptions,
+                                   additional_background, language, reader)
+        columns = _shap_columns(_feature_subset(shap_values, missing))
+        return template.messages(_serialize(columns, table_format, precision)), valid
+
+
+def _merge(result, valid, follow_up, shap_values, feature_aliases):
+    # A feature still invalid after the follow-up keeps its row of the first response, if it had one
+    feature_names = list(shap_values[0].feature_names)
+    valid = {**_valid_features(result[1], feature_names, feature_aliases, explained=False),
+             **_valid_features(follow_up[1], feature_names, feature_aliases), **valid}
+    rows = [valid[f] for f in feature_names if f in valid]
+    return result[0], pd.DataFrame(rows) if rows else result[1].iloc[0:0]
+
+
+def _explain(client, shap_values, feature_aliases, feature_descriptions, additional_background=None, gpt_model='gpt-4o',
+             language='en', reader='general', cache=None, table_format='markdown', precision=None):
+    _validate(language, reader)
+
+    output_names, parse, schema = _response(shap_values)
+    messages = _messages(shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+                         table_format, precision, output_names)
+
+    result = _complete(client, gpt_model, messages, parse, cache, language, reader, schema)
+    if output_names is not None:
+        return result
+    messages, valid = _follow_up(result, shap_values, feature_aliases, feature_descriptions, additional_background,
+                                 language, reader, table_format, precision)
+    if messages is None:
+        return result
+    return _merge(result, valid, _complete(client, gpt_model, messages, parse, cache, language, reader, schema),
+                  shap_values, feature_aliases)
+
+
+def _reduce_messages(partials, feature_names, feature_aliases, feature_descriptions, additional_background, language,
+                     reader):
+    template = prompt_template('reduce', feature_names, feature_aliases, feature_descriptions, additional_background,
+                               language, reader)
+    return template.messages(json.dumps(partials, ensure_ascii=False))
+
+
+def _message_tokens(messages):
+    return sum(_estimate_tokens(m['content']) for m in messages)
+
+
+def _chunks(shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+            token_budget, table_format='markdown', precision=None):
+    # The prompt of a chunk is its fixed part plus the table rows of each of its samples, a row costs its cells and
+    # about 3 separator characters per cell
+    columns = _shap_columns(shap_values)
+    row_lengths = sum(np.char.str_len(_column(c, precision)) + 3 for c in columns.values())
+    sample_tokens = list(row_lengths.reshape(len(shap_values), -1).sum(axis=1) // 4 + 1)
+    base_tokens = _message_tokens(_messages(shap_values[:1], feature_aliases, feature_descriptions,
+                                            additional_background, language, reader, table_format,
+                                            precision)) - sample_tokens[0]
+
+    if base_tokens + max(sample_tokens) > token_budget:
+        raise ValueError(f"Token budget of {token_budget} is too small to explain a single sample, "
+                         f"at least {base_tokens + max(sample_tokens)} tokens are needed")
+
+    chunks = []
+    start = 0
+    tokens = base_tokens
+    for x in range(len(shap_values)):
+        if tokens + sample_tokens[x] > token_budget:
+            chunks.append(shap_values[start:x])
+            start = x
+            tokens = base_tokens
+        tokens += sample_tokens[x]
+    chunks.append(shap_values[start:])
+    return chunks
+
+
+def _raise_first(results):
+    for r in results:
+        if isinstance(r, Exception):
+            raise r
+
+
+async def _aexplain_map_reduce(client, shap_values, feature_aliases, feature_descriptions, additional_background=None,
+                               gpt_model='gpt-4o', language='en', reader='general', token_budget=8000, concurrency=8,
+                               cache=None, table_format='markdown', precision=None):
+    _validate(language, reader)
+    _single_output(shap_values, 'A token budget')
+
+    # Map: explain each chunk of samples that fits the token budget
+    chunks = _chunks(shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+                     token_budget, table_format, precision)
+    results = await _gather(
+        [lambda c=c: aexplain(c, feature_aliases, feature_descriptions, client, gpt_model, additional_background,
+                              language, reader, cache, table_format=table_format, precision=precision)
+         for c in chunks],
+        concurrency)
+    _raise_first(results)
+
+    if len(results) == 1:
+        return results[0]
+
+    # Reduce: merge groups of partial explanations that fit the token budget until a single one is left
+    feature_names = shap_values[0].feature_names
+    partials = [{'summary': summary, 'features': features.to_dict('records')} for summary, features in results]
+    base_tokens = _message_tokens(_reduce_messages([], feature_names, feature_aliases, feature_descriptions,
+                                                   additional_background, language, reader))
+
+    async def reduce(group):
+        messages = _reduce_messages(group, feature_names, feature_aliases, feature_descriptions,
+                                    additional_background, language, reader)
+        return await _acomplete(client, gpt_model, messages, _result, cache, language, reader,
+                                _features_schema(feature_names))
+
+    while len(partials) > 1:
+        groups = [[]]
+        tokens = base_tokens
+        for partial in partials:
+            partial_tokens = _estimate_tokens(json.dumps(partial, ensure_ascii=False))
+            # A group always merges at least two partial explanations, so every round makes progress
+            if len(groups[-1]) >= 2 and tokens + partial_tokens > token_budget:
+                groups.append([])
+                tokens = base_tokens
+            groups[-1].append(partial)
+            tokens += partial_tokens
+
+        results = await _gather([lambda g=g: reduce(g) if len(g) > 1 else _identity(g[0]) for g in groups],
+                                concurrency)
+        _raise_first(results)
+        partials = [{'summary': summary, 'features': features.to_dict('records')} for summary, features in results]
+
+    return partials[0]['summary'], pd.DataFrame(partials[0]['features'])
+
+
+async def _identity(partial):
+    return partial['summary'], pd.DataFrame(partial['features'])
+
+
+def explain(shap_values: list[shap.Explanation], feature_aliases: dict, feature_descriptions: dict, openai_api_key = None, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general', cache = None, token_budget = None, concurrency = 8, table_format = 'markdown', precision = None):
     """
     Generates an explanation for each features according to the SHAP values. The generated narration can be displayed to
     end-users to better help end-users understand about the result of the SHAP values. Can be paired with SHAP visualizations
     to increase user experience.
+    This function uses the shared `contextualshap.Session` of the API key, so repeated calls reuse the same connections.
+
+    When `token_budget` is given, many samples can be explained at once. The samples are split into chunks whose prompt
+    fits the budget, the chunks are explained concurrently, and the partial explanations are merged into one.
+
+    The SHAP values of a multi-output model (e.g. a classifier, with one SHAP value per feature and output) are
+    explained for every output in a single request, with one SHAP value column per output in the prompt.
+
+    With a list of languages or readers, the SHAP values are explained once in the first language and reader, and the
+    explanation is rewritten for the other ones with concurrent text-only requests, without the SHAP values.
+
+    :param shap_values: a list of SHAP values, please take only a few SHAP values to avoid OpenAI API token limit unless `token_budget` is given
+    :param feature_aliases: an optional dictionary containing alias per feature, to increase explanation clarity
+    :param feature_descriptions: an optional dictionary containing description per feature, to increase explanation clarity
+    :param openai_api_key: OpenAI API key string
+    :param gpt_model: the OpenAI GPT model
+    :param additional_background: additional narration containing background story of the model to increase explanation power
+    :param language: the language of the response, or a list of languages, which returns a dictionary mapping each language to its result
+    :param reader: the reader level of comprehension, can be 'general' or 'expert', or a list of reader levels, which returns a dictionary mapping each reader (or each (language, reader) pair when both are lists) to its result
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API
+    :param token_budget: an optional maximum number of estimated prompt tokens per request, enables explaining the samples in chunks
+    :param concurrency: maximum number of chunk requests sent at the same time when `token_budget` is given
+    :param table_format: the format of the SHAP values table in the prompt, can be 'markdown', 'csv' or 'json'
+    :param precision: an optional number of significant digits of the values in the prompt, to reduce prompt tokens
+    :return: summary (a string) anf a list of dictionary containing descriptions for each feature names, or a dictionary mapping each output name to them for multi-output SHAP values
+    """
+    return session.get_session(openai_api_key).explain(shap_values, feature_aliases, feature_descriptions, gpt_model,
+                                                       additional_background, language, reader, cache, token_budget,
+                                                       concurrency, table_format, precision)
+
+
+async def aexplain(shap_values: list[shap.Explanation], feature_aliases: dict, feature_descriptions: dict, client: AsyncOpenAI, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general', cache = None, token_budget = None, concurrency = 8, table_format = 'markdown', precision = None):
+    """
+    Asynchronous version of `explain` which uses an existing `AsyncOpenAI` client, so many explanations can share one
+    client and run concurrently.
+
+    :param shap_values: a list of SHAP values, please take only a few SHAP values to avoid OpenAI API token limit
+    :param feature_aliases: an optional dictionary containing alias per feature, to increase explanation clarity
+    :param feature_descriptions: an optional dictionary containing description per feature, to increase explanation clarity
+    :param client: an `openai.AsyncOpenAI` client, or a backend (see `contextualshap.backends`)
+    :param gpt_model: the OpenAI GPT model
+    :param additional_background: additional narration containing background story of the model to increase explanation power
+    :param language: the language of the response
+    :param reader: the reader level of comprehension, can be 'general' or 'expert'
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API
+    :param token_budget: an optional maximum number of estimated prompt tokens per request, enables explaining the samples in chunks
+    :param concurrency: maximum number of chunk requests sent at the same time when `token_budget` is given
+    :param table_format: the format of the SHAP values table in the prompt, can be 'markdown', 'csv' or 'json'
+    :param precision: an optional number of significant digits of the values in the prompt, to reduce prompt tokens
+    :return: summary (a string) anf a list of dictionary containing descriptions for each feature names, or a dictionary mapping each output name to them for multi-output SHAP values
+    """
+    client = as_backend(client)
+
+    if token_budget is not None:
+        return await _aexplain_map_reduce(client, shap_values, feature_aliases, feature_descriptions,
+                                          additional_background, gpt_model, language, reader, token_budget, concurrency,
+                                          cache, table_format, precision)
+
+    _validate(language, reader)
+
+    output_names, parse, schema = _response(shap_values)
+    messages = _messages(shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+                         table_format, precision, output_names)
+
+    result = await _acomplete(client, gpt_model, messages, parse, cache, language, reader, schema)
+    if output_names is not None:
+        return result
+    # A response missing features is completed by a follow-up request of the missing features only
+    messages, valid = _follow_up(result, shap_values, feature_aliases, feature_descriptions, additional_background,
+                                 language, reader, table_format, precision)
+    if messages is None:
+        return result
+    return _merge(result, valid, await _acomplete(client, gpt_model, messages, parse, cache, language, reader, schema),
+                  shap_values, feature_aliases)
+
+
+async def _aexplain_many(client, shap_values_list, feature_aliases, feature_descriptions, additional_background=None,
+                         gpt_model='gpt-4o', language='en', reader='general', concurrency=8, cache=None,
+                         table_format='markdown', precision=None):
+    _validate(language, reader)
+
+    return await _gather(
+        [lambda sv=sv: aexplain(sv, feature_aliases, feature_descriptions, client, gpt_model, additional_background,
+                                language, reader, cache, table_format=table_format, precision=precision)
+         for sv in shap_values_list],
+        concurrency)
+
+
+async def aexplain_many(shap_values_list: list, feature_aliases: dict, feature_descriptions: dict, openai_api_key = None, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general', concurrency = 8, cache = None, table_format = 'markdown', precision = None):
+    """
+    Asynchronous version of `explain_many`, to be awaited from a running event loop (e.g. a Jupyter notebook).
+
+    :return: a list with one item per element of `shap_values_list`, see `explain_many`
+    """
+    return await session.get_session(openai_api_key).aexplain_many(
+        shap_values_list, feature_aliases, feature_descriptions, gpt_model, additional_background, language, reader,
+        concurrency, cache, table_format, precision)
+
+
+def explain_many(shap_values_list: list, feature_aliases: dict, feature_descriptions: dict, openai_api_key = None, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general', concurrency = 8, cache = None, table_format = 'markdown', precision = None):
+    """
+    Runs `explain` for many groups of SHAP values at once. Requests are sent concurrently through a single
+    `AsyncOpenAI` client, with at most `concurrency` requests in flight at the same time.
+    Use `aexplain_many` when an event loop is already running.
+
+    :param shap_values_list: a list of SHAP values groups, each is explained separately like the `shap_values` of `explain`
+    :param feature_aliases: an optional dictionary containing alias per feature, to increase explanation clarity
+    :param feature_descriptions: an optional dictionary containing description per feature, to increase explanation clarity
+    :param openai_api_key: OpenAI API key string
+    :param gpt_model: the OpenAI GPT model
+    :param additional_background: additional narration containing background story of the model to increase explanation power
+    :param language: the language of the response
+    :param reader: the reader level of comprehension, can be 'general' or 'expert'
+    :param concurrency: maximum number of requests sent at the same time
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API
+    :param table_format: the format of the SHAP values table in the prompt, can be 'markdown', 'csv' or 'json'
+    :param precision: an optional number of significant digits of the values in the prompt, to reduce prompt tokens
+    :return: a list in the same order as `shap_values_list`, each item is either the (summary, features) result of
+        `explain` or the exception raised while explaining that item
+    """
+    return session.get_session(openai_api_key).explain_many(
+        shap_values_list, feature_aliases, feature_descriptions, gpt_model, additional_background, language, reader,
+        concurrency, cache, table_format, precision)
+
+
+def explain_clusters(shap_values: shap.Explanation, feature_aliases: dict, feature_descriptions: dict, openai_api_key = None, n_clusters = 8, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general', concurrency = 8, cache = None, table_format = 'markdown', precision = None, seed = 0):
+    """
+    Explains a large batch of samples with one request per cluster instead of one per sample. The samples are grouped
+    by their SHAP values with k-means, the sample closest to the center of each cluster is explained like in `explain`,
+    and every sample gets the explanation of its cluster with the similarity of its SHAP values to those of the
+    explained sample. A low similarity means the sample is poorly described by its cluster, more clusters help then.
+
+    :param shap_values: the SHAP values of the samples
+    :param feature_aliases: an optional dictionary containing alias per feature, to increase explanation clarity
+    :param feature_descriptions: an optional dictionary containing description per feature, to increase explanation clarity
+    :param openai_api_key: OpenAI API key string
+    :param n_clusters: the maximum number of clusters, and so of requests
+    :param gpt_model: the OpenAI GPT model
+    :param additional_background: additional narration containing background story of the model to increase explanation power
+    :param language: the language of the response
+    :param reader: the reader level of comprehension, can be 'general' or 'expert'
+    :param concurrency: maximum number of requests sent at the same time
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API
+    :param table_format: the format of the SHAP values table in the prompt, can be 'markdown', 'csv' or 'json'
+    :param precision: an optional number of significant digits of the values in the prompt, to reduce prompt tokens
+    :param seed: the seed of the clustering
+    :return: a `contextualshap.cluster.Clusters`, indexing it with a sample index returns the (summary, features)
+        result of the sample cluster, or the exception raised while explaining it, and the similarity of the sample
+    """
+    return session.get_session(openai_api_key).explain_clusters(
+        shap_values, n_clusters, feature_aliases, feature_descriptions, gpt_model, additional_background, language,
+        reader, concurrency, cache, table_format, precision, seed)
+
+
+def _explain_stream(client, shap_values, feature_aliases, feature_descriptions, additional_background=None,
+                    gpt_model='gpt-4o', language='en', reader='general', cache=None, table_format='markdown',
+                    precision=None):
+    _validate(language, reader)
+    _single_output(shap_values, 'Streaming')
+
+    messages = _messages(shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+                         table_format, precision)
+
+    return _stream(client, gpt_model, messages, _result, cache=cache, language=language, reader=reader,
+                    schema=_features_schema(shap_values[0].feature_names))
+
+
+def explain_stream(shap_values: list[shap.Explanation], feature_aliases: dict, feature_descriptions: dict, openai_api_key = None, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general', cache = None, table_format = 'markdown', precision = None):
+    """
+    Streaming version of `explain`. The response is parsed while it is generated, so the summary and each feature
+    explanation can be displayed as soon as it is complete instead of after the whole response.
 
     :param shap_values: a list of SHAP values, please take only a few SHAP values to avoid OpenAI API token limit
     :param feature_aliases: an optional dictionary containing alias per feature, to increase explanation clarity
@@ -19,55 +448,31 @@ def explain(shap_values: list[shap.Explanation], feature_aliases: dict, feature_
     :param additional_background: additional narration containing background story of the model to increase explanation power
     :param language: the language of the response
     :param reader: the reader level of comprehension, can be 'general' or 'expert'
-    :return: summary (a string) anf a list of dictionary containing descriptions for each feature names
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is replayed without calling the API
+    :param table_format: the format of the SHAP values table in the prompt, can be 'markdown', 'csv' or 'json'
+    :param precision: an optional number of significant digits of the values in the prompt, to reduce prompt tokens
+    :return: a generator of ('summary', summary string) and ('features', feature dictionary) pairs, in the order they are
+        generated
     """
+    return session.get_session(openai_api_key).explain_stream(shap_values, feature_aliases, feature_descriptions,
+                                                              gpt_model, additional_background, language, reader,
+                                                              cache, table_format, precision)
 
-    if language not in languages:
-        raise ValueError("Language must be one of: " + ", ".join(languages))
 
-    if reader not in readers:
-        raise ValueError("Reader must be one of: " + ", ".join(readers))
+async def aexplain_stream(shap_values: list[shap.Explanation], feature_aliases: dict, feature_descriptions: dict, client: AsyncOpenAI, gpt_model = 'gpt-4o', additional_background = None, language = 'en', reader = 'general', cache = None, table_format = 'markdown', precision = None):
+    """
+    Asynchronous version of `explain_stream` which uses an existing `AsyncOpenAI` client.
 
-    prompt_feature_aliases = []
-    prompt_shap_values = []
-    for f in shap_values[0].feature_names:
-        desc = ''
-        if f in feature_descriptions:
-            desc = feature_descriptions[f]
+    :return: an asynchronous iterator of ('summary', summary string) and ('features', feature dictionary) pairs, see
+        `explain_stream`
+    """
+    client = as_backend(client)
+    _validate(language, reader)
+    _single_output(shap_values, 'Streaming')
 
-        if f in feature_aliases:
-            prompt_feature_aliases.append(
-                {'Feature Name': f, 'Feature Alias': feature_aliases[f], 'Feature Description': desc})
-        else:
-            prompt_feature_aliases.append({'Feature Name': f, 'Feature Alias': f, 'Feature Description': desc})
+    messages = _messages(shap_values, feature_aliases, feature_descriptions, additional_background, language, reader,
+                         table_format, precision)
 
-    for x in range(len(shap_values)):
-        for i in range(len(shap_values[x].data)):
-            prompt_shap_values.append(
-                {'Sample Number': str(x), 'Feature Name': shap_values[x].feature_names[i], 'Input Value': shap_values[x].data[i],
-                 'SHAP Value': shap_values[x].values[i]})
-
-    client = OpenAI(api_key=openai_api_key)
-
-    completion = client.chat.completions.create(
-        model=gpt_model,
-        messages=[
-            {
-                "role": "user",
-                "content": f"""
-    SHAP refers to SHapley Additive exPlanations. Refer to the "A Unified Approach to Interpreting Model Predictions" paper by Scott Lundberg. This is about AI model training.
-    Your job is to output an explanation about each feature according to the SHAP values to better explain to readers the meaning of these SHAP values for each of the features and the result of the AI model.
-    f{readers[reader]}
-    This is a table of feature names of the dataset, their aliases, and the description of the feature. If there is no description or alias, interpret the feature name yourself.
-    {_table(prompt_feature_aliases)}
-    You are now given a few samples of the AI model prediction, consists of the input value and SHAP value for each feature. 
-    {_table(prompt_shap_values)}
-    {'' if additional_background is None else f'Context background of this model to be included in the explanation: {additional_background}.'}
-    Also add a summary of everything that is given.
-    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know. Output is only a JSON object with a string field `summary` and `features`, which is an array of JSON with field name 'feature_name' for the feature name, 'description' for the description that you interpreted, and 'explanation' for the explanation. Do not enclose the JSON in markdown code."""
-            }
-        ]
-    )
-
-    response = json.loads(completion.choices[0].message.content)
-    return response['summary'], pd.DataFrame(response['features'])
\ No newline at end of file
+    async for event in _astream(client, gpt_model, messages, _result, cache=cache, language=language, reader=reader,
+                                schema=_features_schema(shap_values[0].feature_names)):
+        yield event
@@ -0,0 +1,186 @@
+import contextvars
+import threading
+import time
+import warnings
+
+_hooks = ()
+_hooks_lock = threading.Lock()
+_current = contextvars.ContextVar('contextualshap_span', default=None)
+
+
+def add_hook(hook):
+    """
+    Registers a hook called with every finished Span. Hooks are called in the thread that ran the span, so they must be
+    thread-safe. An exception raised by a hook is turned into a warning and does not stop the narration.
+
+    :param hook: a function taking a Span
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = _hooks + (hook,)
+
+
+def remove_hook(hook):
+    """
+    Unregisters a hook registered with `add_hook`.
+
+    :param hook: the hook to remove
+    """
+    global _hooks
+    with _hooks_lock:
+        _hooks = tuple(h for h in _hooks if h is not hook)
+
+
+class Span:
+    """
+    A timed stage of a narration. `name` is one of:
+
+    - 'explain', 'explain_many', 'explain_clusters', 'waterfall', 'waterfall_many', 'bar' and 'bar_many', the whole
+      call of a Session method
+    - 'cluster', the clustering of the samples, with the number of `samples` and of `clusters`
+    - 'aggregate', the mean absolute SHAP values computed by `contextualshap.plots.mean_abs_shap`, with its `rows`
+    - 'store', the shift detection of a `contextualshap.store.NarrationStore`, with its number of `features` and of
+      `changed` ones
+    - 'validate', the validation of the language and the reader
+    - 'prompt', the construction of the prompt messages
+    - 'draw', the SHAP plot drawn with Matplotlib
+    - 'render', the figure saved to an image, with its `image_bytes`
+    - 'encode', the base64 encoding of the image, with its `payload_bytes`
+    - 'cache', the cache lookup, with `hit` set to True or False
+    - 'request', the backend call, with the `model`, the request `payload_bytes` and the `prompt_tokens`,
+      `completion_tokens` and `cached_tokens` of the response, and its `retries` and `throttled` seconds when the
+      backend is a `contextualshap.ratelimit.RateLimitedBackend`
+    - 'parse', the parsing of the response, with `repaired` set to True when an invalid response was repaired
+    - 'follow_up', the request of the features missing from an explanation, with its number of `missing` features
+    - 'translate', the rewriting of a narration for the other languages and readers, with its number of `variants`
+
+    `parent` is the span running when this one started, so the stages of a narration share the same root span.
+    `start` and `end` are `time.perf_counter` values, `duration` is in seconds, and `error` is the exception that ended
+    the span, if any.
+    """
+
+    enabled = True
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.parent = None
+        self.start = None
+        self.end = None
+        self.error = None
+        self._token = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def root(self):
+        span = self
+        while span.parent is not None:
+            span = span.parent
+        return span
+
+    def set(self, **attributes):
+        """Adds attributes to the span."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.parent = _current.get()
+        self._token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        self.error = exc
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # A span of a generator can end in another context than the one it started in
+            _current.set(self.parent)
+        for hook in _hooks:
+            try:
+                hook(self)
+            except Exception as e:
+                warnings.warn(f"Instrumentation hook {hook!r} failed: {e!r}")
+        return False
+
+    def __repr__(self):
+        return f"Span({self.name!r}, duration={self.duration!r}, attributes={self.attributes!r})"
+
+
+class _NoSpan:
+    # Returned when no hook is registered, so an instrumented stage costs a single check
+    enabled = False
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def current():
+    """Returns the running Span, or None."""
+    return _current.get()
+
+
+def span(name, **attributes):
+    """
+    Returns a context manager timing a stage of a narration, see Span. Nothing is recorded when no hook is registered.
+
+    :param name: the name of the stage
+    :param attributes: the initial attributes of the span
+    :return: a Span, or a no-op context manager with the same `set` method and a False `enabled` attribute
+    """
+    if not _hooks:
+        return _no_span
+    return Span(name, attributes)
+
+
+class Recorder:
+    """
+    A hook keeping the finished spans, to be registered with `add_hook`, or used as a context manager which registers
+    it for the duration of the block.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def __call__(self, span_):
+        with self._lock:
+            self.spans.append(span_)
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, *args):
+        remove_hook(self)
+
+    def summary(self):
+        """
+        Aggregates the recorded spans by name.
+
+        :return: a dictionary mapping span names to a dictionary of their `count`, total `duration` in seconds, and the
+            sum of their numeric attributes (e.g. `prompt_tokens` or `payload_bytes`) and of their True `hit` attributes
+        """
+        with self._lock:
+            spans = list(self.spans)
+        summary = {}
+        for s in spans:
+            totals = summary.setdefault(s.name, {'count': 0, 'duration': 0.0})
+            totals['count'] += 1
+            totals['duration'] += s.duration
+            for key, value in s.attributes.items():
+                if isinstance(value, (bool, int, float)):
+                    totals[key] = totals.get(key, 0) + value
+        return summary
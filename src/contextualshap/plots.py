@@ -1,90 +1,263 @@
+from __future__ import annotations
 import copy
-import shap
-import io
-import matplotlib.pyplot as plt
-import base64
+import functools
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import json
-from openai import OpenAI
-from .common import _table, languages, readers
+import numpy as np
+from . import session
+from .encoding import ImageEncoding
+from .instrument import span
+from .prompts import prompt_template
+from .common import _LazyModule, _acomplete, _complete, _gather, _output_names, _outputs, _outputs_schema, _serialize, _stream, _validate, explanation_schema, output_explanation_schema
 
+shap = _LazyModule('shap')
+matplotlib = _LazyModule('matplotlib')
+plt = _LazyModule('matplotlib.pyplot')
 
-def _explain_waterfall(image, explanation: shap.Explanation, feature_aliases=None, feature_descriptions=None,
-                       additional_background=None, openai_api_key=None, gpt_model='gpt-4o', language='en',
-                       reader='general'):
-    if language not in languages:
-        raise ValueError("Language must be one of: " + ", ".join(languages))
-
-    if reader not in readers:
-        raise ValueError("Reader must be one of: " + ", ".join(readers))
 
+def _waterfall_data(explanation: shap.Explanation):
     if hasattr(explanation.base_values, "__len__"):
-        # TODO: document what should happen if base_values is a vector
+        # A vector of base values is a multi-output sample, described by _output_waterfall_data instead
         raise ValueError("Explanation base values is a list, currently unsupported")
     else:
         prediction = explanation.base_values
 
-    client = OpenAI(api_key=openai_api_key)
-
-    bi = base64.b64encode(image).decode()
-    prompt_features = []
-
-    i = 0
-    for f in explanation.feature_names:
-        desc = ''
-        if feature_descriptions is not None and f in feature_descriptions:
-            desc = feature_descriptions[f]
-
-        alias = ''
-        if feature_aliases is not None and f in feature_aliases:
-            alias = feature_aliases[f]
-
-        prompt_features.append(
-            {'Feature Name': f, 'Feature Alias': alias, 'Feature Description': desc,
-             'SHAP Value': str(explanation.values[i]), 'Sample Value': str(explanation.data[i])})
-        i = i + 1
-
-    completion = client.chat.completions.create(
-        model=gpt_model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"""
-            SHAP refers to SHapley Additive exPlanations. Refer to the "A Unified Approach to Interpreting Model Predictions" paper by Scott Lundberg. This is about AI model training.
-            Your job is to output an easy explanation about the image in the context of the SHAP values to better explain to readers the meaning of the waterfall plot.
-            f{readers[reader]}
-            The given image is a waterfall plot of a single prediction sample in the dataset. The result of the prediction of this sample of the dataset is {prediction}.
-            {'' if len(prompt_features) == 0 else f'Alias and description of the feature names:\n{_table(prompt_features)}\nThe feature description sometimes explain what the values mean, and you must include the explanation for the values in the result.\n'}
-            {'' if additional_background is None else f'Context background of this model to be included in the explanation: {additional_background}.'}
-            Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
-            Output is only a JSON object with a string field `explanation` containing the explanation.
-            Do not enclose the JSON in markdown code."""
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{bi}"
-                        }
-                    }
-                ]
-            }
-        ]
-    )
-
-    response = json.loads(completion.choices[0].message.content)
+    table = _serialize({'Feature Name': np.asarray(explanation.feature_names, dtype=object),
+                        'SHAP Value': np.asarray(explanation.values), 'Sample Value': np.asarray(explanation.data)})
+    return f"The result of the prediction of this sample of the dataset is {prediction}.\n{table}"
+
+
+def _waterfall_messages(image, explanation: shap.Explanation, feature_aliases=None, feature_descriptions=None,
+                        additional_background=None, language='en', reader='general'):
+    template = prompt_template('waterfall', explanation.feature_names, feature_aliases, feature_descriptions,
+                               additional_background, language, reader)
+    return template.messages(_waterfall_data(explanation), image)
+
+
+modes = ['image', 'numeric']
+
+
+def _check_mode(mode):
+    if mode not in modes:
+        raise ValueError("Mode must be one of: " + ", ".join(modes))
+
+
+def _numeric_waterfall_data(explanation: shap.Explanation, max_display=10):
+    if hasattr(explanation.base_values, "__len__"):
+        raise ValueError("Explanation base values is a list, currently unsupported")
+
+    values = np.asarray(explanation.values)
+    base_value = float(explanation.base_values)
+    prediction = base_value + float(values.sum())
+
+    # The same features as the waterfall plot shows: the largest absolute SHAP values first
+    ranked = np.argsort(-np.abs(values), kind='stable')
+    order, rest = ranked[:max_display], ranked[max_display:]
+    table = _serialize({'Feature Name': np.asarray(explanation.feature_names, dtype=object)[order],
+                        'Sample Value': np.asarray(explanation.data)[order], 'SHAP Value': values[order]})
+    others = '' if len(rest) == 0 else \
+        f'The other {len(rest)} features together have a SHAP value of {float(values[rest].sum())}.\n'
+    return (f"The base value is {base_value}. The result of the prediction of this sample of the dataset is "
+            f"{prediction}.\n{table}{others}")
+
+
+def _numeric_waterfall_messages(explanation: shap.Explanation, feature_aliases=None, feature_descriptions=None,
+                                additional_background=None, language='en', reader='general', max_display=10):
+    template = prompt_template('waterfall_numeric', explanation.feature_names, feature_aliases, feature_descriptions,
+                               additional_background, language, reader)
+    return template.messages(_numeric_waterfall_data(explanation, max_display))
+
+
+def _waterfall_batch_messages(images, explanations, feature_aliases=None, feature_descriptions=None,
+                              additional_background=None, language='en', reader='general', max_display=10):
+    # One prompt for the waterfall plots of several requests, the images (if any) are sent in the request order
+    numeric = images[0] is None
+    template = prompt_template('waterfall_numeric_batch' if numeric else 'waterfall_batch',
+                               explanations[0].feature_names, feature_aliases, feature_descriptions,
+                               additional_background, language, reader)
+    data = "".join(f"Request {i}:\n"
+                   f"{_numeric_waterfall_data(e, max_display) if numeric else _waterfall_data(e)}"
+                   for i, e in enumerate(explanations))
+    return template.messages(data, None if numeric else list(images))
+
+
+def _output_waterfall_data(explanation: shap.Explanation, output_names, max_display=None):
+    # The values of a multi-output sample are a (feature, output) array, every output is handled at once
+    values = np.asarray(explanation.values, dtype=float)
+    base_values = np.asarray(explanation.base_values, dtype=float).reshape(-1)
+    outputs = _serialize({'Output': np.asarray(output_names, dtype=object), 'Base Value': base_values,
+                          'Prediction': base_values + values.sum(axis=0)})
+
+    # The features with the largest absolute SHAP value of any output first
+    ranked = np.argsort(-np.abs(values).max(axis=1), kind='stable')
+    order, rest = ranked[:max_display], ranked[max_display:]
+    columns = {'Feature Name': np.asarray(explanation.feature_names, dtype=object)[order],
+               'Sample Value': np.asarray(explanation.data)[order]}
+    for j, name in enumerate(output_names):
+        columns[f'SHAP Value ({name})'] = values[order, j]
+    others = '' if len(rest) == 0 else \
+        (f'The other {len(rest)} features together have a SHAP value of '
+         f"{', '.join(f'{v} ({name})' for name, v in zip(output_names, values[rest].sum(axis=0)))}.\n")
+    return f"{outputs}{_serialize(columns)}{others}"
+
+
+def _output_waterfall_messages(images, explanation: shap.Explanation, output_names, feature_aliases=None,
+                               feature_descriptions=None, additional_background=None, language='en', reader='general',
+                               max_display=10):
+    # One prompt for every output of a sample, the images (if any) are sent in the order of the outputs
+    numeric = images is None
+    template = prompt_template('waterfall_numeric_outputs' if numeric else 'waterfall_outputs',
+                               explanation.feature_names, feature_aliases, feature_descriptions, additional_background,
+                               language, reader)
+    return template.messages(_output_waterfall_data(explanation, output_names, max_display if numeric else None),
+                             images)
+
+
+def _explanations(content, n):
+    explanations = json.loads(content)['explanations']
+    if len(explanations) != n:
+        raise ValueError(f"Expected {n} explanations, got {len(explanations)}")
+    return explanations
+
+
+def _explanation(content):
+    response = json.loads(content)
     return response['explanation']
 
 
+def _render(image_encoding=None, figure=None):
+    return (ImageEncoding() if image_encoding is None else image_encoding).encode(figure)
+
+
+def _draws(mode, show, explain=True):
+    # The numeric mode sends the SHAP values as text, so the plot is only drawn when it is shown, or when it is the
+    # only thing asked for
+    return mode == 'image' or show or not explain
+
+
+def _response(output_names):
+    # A multi-output explanation is narrated with one explanation per output, in a single request
+    if output_names is None:
+        return _explanation, explanation_schema
+    return functools.partial(_outputs, output_names=output_names), \
+        _outputs_schema(output_explanation_schema, output_names)
+
+
+def _single_output(output_names, feature):
+    if output_names is not None:
+        raise ValueError(f"{feature} is not supported for multi-output explanations")
+
+
+def _waterfall_prompt(image, explanation: shap.Explanation, feature_aliases=None, feature_descriptions=None,
+                      additional_background=None, language='en', reader='general', max_display=10):
+    with span('prompt'):
+        output_names = _output_names(explanation, 1)
+        if output_names is not None:
+            return _output_waterfall_messages(image, explanation, output_names, feature_aliases, feature_descriptions,
+                                              additional_background, language, reader, max_display)
+        # Without an image, the numeric mode sends the SHAP values as text
+        if image is None:
+            return _numeric_waterfall_messages(explanation, feature_aliases, feature_descriptions,
+                                               additional_background, language, reader, max_display)
+        return _waterfall_messages(image, explanation, feature_aliases, feature_descriptions, additional_background,
+                                   language, reader)
+
+
+def _explain_waterfall(image, explanation: shap.Explanation, client, feature_aliases=None, feature_descriptions=None,
+                       additional_background=None, gpt_model='gpt-4o', language='en', reader='general', cache=None,
+                       max_display=10):
+    _validate(language, reader)
+
+    parse, schema = _response(_output_names(explanation, 1))
+    messages = _waterfall_prompt(image, explanation, feature_aliases, feature_descriptions, additional_background,
+                                 language, reader, max_display)
+
+    return _complete(client, gpt_model, messages, parse, cache, language, reader, schema)
+
+
+async def _aexplain_waterfall(image, explanation: shap.Explanation, client, feature_aliases=None,
+                              feature_descriptions=None, additional_background=None, gpt_model='gpt-4o', language='en',
+                              reader='general', cache=None, max_display=10):
+    _validate(language, reader)
+
+    parse, schema = _response(_output_names(explanation, 1))
+    messages = _waterfall_prompt(image, explanation, feature_aliases, feature_descriptions, additional_background,
+                                 language, reader, max_display)
+
+    return await _acomplete(client, gpt_model, messages, parse, cache, language, reader, schema)
+
+
+def _alias_names(feature_names, feature_aliases):
+    return [feature_aliases.get(f, f) for f in feature_names]
+
+
+def _alias_view(explanation: shap.Explanation, feature_names):
+    # A shallow copy shares the values, base_values, data and display_data arrays, only the feature names are replaced
+    nsv = copy.copy(explanation)
+    nsv.feature_names = feature_names
+    return nsv
+
+
+def _waterfall_alias(explanation: shap.Explanation, feature_aliases):
+    return _alias_view(explanation, _alias_names(explanation.feature_names, feature_aliases))
+
+
+def _waterfall(client, explanation: shap.Explanation, feature_aliases, feature_descriptions=None,
+               additional_background=None, show=True, explain=True, gpt_model='gpt-4o', language='en',
+               reader='general', cache=None, mode='image', image_encoding=None, **kwargs):
+    _check_mode(mode)
+
+    nsv = _waterfall_alias(explanation, feature_aliases)
+    output_names = _output_names(explanation, 1)
+
+    if _draws(mode, show, explain):
+        with span('draw'):
+            if output_names is None:
+                shap.plots.waterfall(nsv, show=False, **kwargs)
+            else:
+                # A multi-output sample gets one waterfall plot per output, each in its own figure
+                figures = []
+                for j, name in enumerate(output_names):
+                    figures.append(plt.figure())
+                    shap.plots.waterfall(nsv[:, j], show=False, **kwargs)
+                    plt.title(str(name))
+
+    if explain:
+        # The numeric mode sends the SHAP values as text, so the plot is not rendered to an image
+        if mode == 'numeric':
+            data = None
+        elif output_names is None:
+            data = _render(image_encoding)
+        else:
+            data = [_render(image_encoding, figure) for figure in figures]
+
+        if show:
+            plt.show()
+
+        return _explain_waterfall(data, explanation, client, feature_aliases, feature_descriptions,
+                                  additional_background, gpt_model, language, reader, cache,
+                                  kwargs.get('max_display', 10))
+    else:
+        if show:
+            plt.show()
+        return None
+
+
 def waterfall(explanation: shap.Explanation, feature_aliases=None, feature_descriptions=None,
               additional_background=None, show=True, explain=True, openai_api_key=None, gpt_model='gpt-4o',
-              language='en', reader='general', **kwargs):
+              language='en', reader='general', cache=None, mode='image', image_encoding=None, **kwargs):
     """
     Displays a SHAP waterfall plot. This is a utility wrapper function that accepts feature aliases dictionary
     to easily alias some feature names that are otherwise retrieved by default through explanation.feature_names.
     By setting `explain` to True, this function will also return a string of narration containing explanation about the waterfall plot.
     **kwargs is passed to shap.plots.waterfall function to modify the function.
+    This function uses the shared `contextualshap.Session` of the API key, so repeated calls reuse the same connections.
+    The explanation of a multi-output model (e.g. a classifier) gets one waterfall plot per output, and every output is
+    narrated in a single request, returning a dictionary mapping each output name to its narration.
+    With a list of languages or readers, the plot is narrated once and the narration is rewritten for the other ones
+    with concurrent text-only requests, without re-sending the image or the SHAP values.
 
     :param explanation: a shap.Explanation instance retrieved from calling shap explainer.
     :param feature_aliases: an optional dictionary mapping of old feature name to new feature name.
@@ -94,108 +267,373 @@ def waterfall(explanation: shap.Explanation, feature_aliases=None, feature_descr
     :param explain: setting this to false will not call OpenAI API to retrieve the plot explanation, so API key, GPT model, and language parameters are not used. Nothing will be returned if explain is False.
     :param openai_api_key: an OpenAI API key to use for API calls.
     :param gpt_model: a GPT model to use.
+    :param language: a language code to use, or a list of language codes, which returns a dictionary mapping each language to its narration.
+    :param reader: the reader level of comprehension, can be 'general' or 'expert', or a list of reader levels, which returns a dictionary mapping each reader (or each (language, reader) pair when both are lists) to its narration.
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API.
+    :param mode: 'image' sends the rendered plot to GPT, 'numeric' sends the base value, the prediction and the top `max_display` SHAP values as text instead, which skips rendering the plot to an image, and drawing it when `show` is False.
+    :param image_encoding: an optional `contextualshap.encoding.ImageEncoding` setting the format, resolution and detail level of the image sent to GPT, and recording its payload bytes.
+    :return: anything returned by shap.plots.waterfall, especially in the case of setting `show=False`.
+    """
+    return session.get_session(openai_api_key).waterfall(explanation, feature_aliases, feature_descriptions,
+                                                         additional_background, show, explain, gpt_model, language,
+                                                         reader, cache, mode, image_encoding, **kwargs)
+
+
+def _texts(events):
+    for _, text in events:
+        yield text
+
+
+def _waterfall_stream(client, explanation: shap.Explanation, feature_aliases, feature_descriptions=None,
+                      additional_background=None, show=True, gpt_model='gpt-4o', language='en', reader='general',
+                      cache=None, mode='image', image_encoding=None, **kwargs):
+    _check_mode(mode)
+    _validate(language, reader)
+    _single_output(_output_names(explanation, 1), 'Streaming')
+
+    if _draws(mode, show):
+        with span('draw'):
+            shap.plots.waterfall(_waterfall_alias(explanation, feature_aliases), show=False, **kwargs)
+    data = _render(image_encoding) if mode == 'image' else None
+
+    # The plot is shown before the first token arrives, the generator only waits for the explanation
+    if show:
+        plt.show()
+
+    messages = _waterfall_prompt(data, explanation, feature_aliases, feature_descriptions, additional_background,
+                                 language, reader, kwargs.get('max_display', 10))
+    return _texts(_stream(client, gpt_model, messages, _explanation, ['explanation'], cache, language, reader,
+                           explanation_schema))
+
+
+def waterfall_stream(explanation: shap.Explanation, feature_aliases=None, feature_descriptions=None,
+                     additional_background=None, show=True, openai_api_key=None, gpt_model='gpt-4o', language='en',
+                     reader='general', cache=None, mode='image', image_encoding=None, **kwargs):
+    """
+    Streaming version of `waterfall` with `explain` set to True. The plot is displayed right away, then the explanation
+    is yielded piece by piece while it is generated.
+    **kwargs is passed to shap.plots.waterfall function to modify the function.
+
+    :return: a generator of strings, joined together they are the explanation returned by `waterfall`.
+    """
+    return session.get_session(openai_api_key).waterfall_stream(explanation, feature_aliases, feature_descriptions,
+                                                                additional_background, show, gpt_model, language,
+                                                                reader, cache, mode, image_encoding, **kwargs)
+
+
+def _waterfall_sample(explanation: shap.Explanation, feature_aliases):
+    # Only the arrays of one sample are sent to a rendering process instead of pickling the whole Explanation
+    return dict(values=explanation.values, base_values=explanation.base_values, data=explanation.data,
+                display_data=explanation.display_data,
+                feature_names=_alias_names(explanation.feature_names, feature_aliases),
+                lower_bounds=getattr(explanation, 'lower_bounds', None),
+                upper_bounds=getattr(explanation, 'upper_bounds', None))
+
+
+def _init_render_process():
+    # Rendering processes never show the plots
+    matplotlib.use('Agg', force=True)
+
+
+def _render_waterfall_process(sample, image_encoding, kwargs):
+    try:
+        shap.plots.waterfall(shap.Explanation(**sample), show=False, **kwargs)
+        return image_encoding._save(plt.gcf())
+    except Exception as e:
+        return e
+    finally:
+        plt.close('all')
+
+
+def _save_waterfalls(explanations, feature_aliases, image_encoding, processes=None, **kwargs):
+    if processes is None:
+        # Matplotlib is not thread-safe, so the plots are rendered one by one in the calling thread
+        saved = []
+        for i in range(len(explanations)):
+            try:
+                with span('draw'):
+                    shap.plots.waterfall(_waterfall_alias(explanations[i], feature_aliases), show=False, **kwargs)
+                saved.append(image_encoding._save(plt.gcf()))
+            except Exception as e:
+                saved.append(e)
+            finally:
+                plt.close()
+        return saved
+
+    samples = []
+    for i in range(len(explanations)):
+        try:
+            samples.append(_waterfall_sample(explanations[i], feature_aliases))
+        except Exception as e:
+            samples.append(e)
+    valid = [sample for sample in samples if not isinstance(sample, Exception)]
+
+    # Spawned processes do not inherit the threads and the pyplot state of the calling process
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_render_process) as pool:
+        rendered = iter(list(pool.map(_render_waterfall_process, valid, itertools.repeat(image_encoding),
+                                      itertools.repeat(kwargs), chunksize=max(1, len(valid) // (processes * 4)))))
+    return [sample if isinstance(sample, Exception) else next(rendered) for sample in samples]
+
+
+def _render_waterfalls(explanations, feature_aliases, mode='image', image_encoding=None, processes=None, **kwargs):
+    _check_mode(mode)
+    if mode == 'numeric':
+        # Nothing to render, the SHAP values are sent as text
+        return [None] * len(explanations)
+
+    feature_aliases = {} if feature_aliases is None else feature_aliases
+    image_encoding = ImageEncoding() if image_encoding is None else image_encoding
+    saved = _save_waterfalls(explanations, feature_aliases, image_encoding, processes, **kwargs)
+    return [item if isinstance(item, Exception) else image_encoding._image(*item) for item in saved]
+
+
+def render_waterfalls(explanations, feature_aliases=None, processes=None, image_encoding=None, **kwargs):
+    """
+    Renders many SHAP waterfall plots without explaining them. With `processes`, the plots are rendered in parallel by
+    a pool of headless processes, each receiving only the arrays of its samples. Every figure is closed once saved.
+    **kwargs is passed to shap.plots.waterfall function to modify the function.
+
+    :param explanations: a list of single sample shap.Explanation instances, or a shap.Explanation of many samples.
+    :param feature_aliases: an optional dictionary mapping of old feature name to new feature name.
+    :param processes: an optional number of rendering processes, None renders the plots one by one in the calling thread.
+    :param image_encoding: an optional `contextualshap.encoding.ImageEncoding` of the images, the default is PNG.
+    :return: a list in the same order as `explanations`, each item is either the image bytes or the exception raised
+        while rendering that sample.
+    """
+    feature_aliases = {} if feature_aliases is None else feature_aliases
+    image_encoding = ImageEncoding() if image_encoding is None else image_encoding
+    saved = _save_waterfalls(explanations, feature_aliases, image_encoding, processes, **kwargs)
+    return [item if isinstance(item, Exception) else item[0] for item in saved]
+
+
+async def _anarrate_waterfalls(client, images, explanations, feature_aliases, feature_descriptions=None,
+                               additional_background=None, gpt_model='gpt-4o', language='en', reader='general',
+                               concurrency=8, cache=None, max_display=10):
+    _validate(language, reader)
+
+    async def narrate(image, explanation):
+        if isinstance(image, Exception):
+            raise image
+        return await _aexplain_waterfall(image, explanation, client, feature_aliases, feature_descriptions,
+                                         additional_background, gpt_model, language, reader, cache, max_display)
+
+    return await _gather([lambda i=i: narrate(images[i], explanations[i]) for i in range(len(explanations))],
+                         concurrency)
+
+
+async def awaterfall_many(explanations, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                          openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general', concurrency=8,
+                          cache=None, mode='image', image_encoding=None, processes=None, **kwargs):
+    """
+    Asynchronous version of `waterfall_many`, to be awaited from a running event loop (e.g. a Jupyter notebook).
+
+    :return: a list with one item per explanation, see `waterfall_many`.
+    """
+    return await session.get_session(openai_api_key).awaterfall_many(
+        explanations, feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader,
+        concurrency, cache, mode, image_encoding, processes, **kwargs)
+
+
+def waterfall_many(explanations, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                   openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general', concurrency=8, cache=None,
+                   mode='image', image_encoding=None, processes=None, **kwargs):
+    """
+    Explains many SHAP waterfall plots at once. Every plot is rendered without being shown, then the explanation
+    requests are sent concurrently through a single `AsyncOpenAI` client, with at most `concurrency` requests in flight
+    at the same time. Use `awaterfall_many` when an event loop is already running.
+    **kwargs is passed to shap.plots.waterfall function to modify the function.
+
+    :param explanations: a list of single sample shap.Explanation instances, or a shap.Explanation of many samples.
+    :param feature_aliases: an optional dictionary mapping of old feature name to new feature name.
+    :param feature_descriptions: an optional dictionary mapping of old feature name to description.
+    :param additional_background: an optional background string to be given to GPT to enhance explanation.
+    :param openai_api_key: an OpenAI API key to use for API calls.
+    :param gpt_model: a GPT model to use.
     :param language: a language code to use.
     :param reader: the reader level of comprehension, can be 'general' or 'expert'
-    :return: anything returned by shap.plots.waterfall, especially in the case of setting `show=False`.
+    :param concurrency: maximum number of requests sent at the same time.
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API.
+    :param mode: 'image' sends the rendered plots to GPT, 'numeric' sends the SHAP values as text and skips rendering, see `waterfall`.
+    :param image_encoding: an optional `contextualshap.encoding.ImageEncoding` of the images, see `waterfall`.
+    :param processes: an optional number of processes rendering the plots in parallel, see `render_waterfalls`.
+    :return: a list in the same order as `explanations`, each item is either the explanation string or the exception
+        raised while rendering or explaining that sample.
     """
-    if feature_aliases is None:
-        feature_aliases = {}
+    return session.get_session(openai_api_key).waterfall_many(
+        explanations, feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader,
+        concurrency, cache, mode, image_encoding, processes, **kwargs)
 
-    feature_names = []
-    for f in explanation.feature_names:
-        if f in feature_aliases:
-            feature_names.append(feature_aliases[f])
-        else:
-            feature_names.append(f)
-    nsv = copy.deepcopy(explanation)
-    nsv.feature_names = feature_names
 
-    shap.plots.waterfall(nsv, show=False, **kwargs)
+def _bar_messages(image, feature_names, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                  language='en', reader='general', output_names=None):
+    if output_names is not None:
+        template = prompt_template('bar_outputs', feature_names, feature_aliases, feature_descriptions,
+                                   additional_background, language, reader)
+        return template.messages(f"{', '.join(str(name) for name in output_names)}\n", image)
+    # Everything but the image is static, so the whole text is the cached prefix
+    return prompt_template('bar', feature_names, feature_aliases, feature_descriptions, additional_background,
+                           language, reader).messages(image=image)
+
+
+def _bar_outputs(shap_values):
+    # A multi-output Explanation has (sample, feature, output) values
+    return _output_names(shap_values, 2) if isinstance(shap_values, shap.Explanation) else None
+
+
+def _output_cohorts(shap_values: shap.Explanation, output_names):
+    # Each output is a cohort, so shap.plots.bar draws the bars of every output in one plot
+    return {str(name): shap_values[..., j] for j, name in enumerate(output_names)}
+
+
+def _bar_cohorts(shap_values):
+    if isinstance(shap_values, shap.Explanation):
+        return {'': shap_values}
+    elif isinstance(shap_values, shap.Cohorts):
+        return shap_values.cohorts
+    elif isinstance(shap_values, dict):
+        return shap_values
+    else:
+        emsg = (
+            "The shap_values argument must be an Explanation object, Cohorts "
+            "object, or dictionary of Explanation objects!"
+        )
+        raise TypeError(emsg)
+
+
+def _numeric_bar_messages(shap_values, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                          language='en', reader='general', max_display=10, output_names=None):
+    cohorts = _bar_cohorts(shap_values)
+
+    # Like shap.plots.bar, a matrix of SHAP values is summarized by its mean absolute value per feature
+    importances = {}
+    for label, exp in cohorts.items():
+        values = np.asarray(exp.values)
+        # A single sample, or values already aggregated by `mean_abs_shap`, are only made absolute
+        importances[label] = np.abs(values).mean(axis=0) if values.ndim == 2 else np.abs(values)
+
+    feature_names = list(cohorts.values())[0].feature_names
+    order = np.argsort(-np.max([np.abs(v) for v in importances.values()], axis=0), kind='stable')[:max_display]
+    columns = {'Feature Name': np.asarray(feature_names, dtype=object)[order]}
+    for label, importance in importances.items():
+        # The column names have no pipe, which would split the header cells of a markdown table
+        column = 'Mean Absolute SHAP Value' if label == '' else f'Mean Absolute SHAP Value ({label})'
+        columns[column] = importance[order]
+    others = len(feature_names) - len(order)
+
+    template = prompt_template('bar_numeric' if output_names is None else 'bar_numeric_outputs', feature_names,
+                               feature_aliases, feature_descriptions, additional_background, language, reader)
+    groups = len(importances) > 1 and output_names is None
+    return template.messages(f"{'The values are given for each group of samples.\n' if groups else ''}"
+                             f"{_serialize(columns)}"
+                             f"{'' if others == 0 else f'The other {others} features are less important.\n'}")
+
+
+def _bar_prompt(image, feature_names, shap_values, feature_aliases=None, feature_descriptions=None,
+                additional_background=None, language='en', reader='general', max_display=10, output_names=None):
+    with span('prompt'):
+        # Without an image, the numeric mode sends the SHAP values as text
+        if image is None:
+            return _numeric_bar_messages(shap_values, feature_aliases, feature_descriptions, additional_background,
+                                         language, reader, max_display, output_names)
+        return _bar_messages(image, feature_names, feature_aliases, feature_descriptions, additional_background,
+                             language, reader, output_names)
+
+
+def _explain_bar(image, feature_names, client, feature_aliases=None, feature_descriptions=None,
+                 additional_background=None, gpt_model='gpt-4o', language='en', reader='general', cache=None,
+                 shap_values=None, max_display=10, output_names=None):
+    _validate(language, reader)
+
+    parse, schema = _response(output_names)
+    messages = _bar_prompt(image, feature_names, shap_values, feature_aliases, feature_descriptions,
+                           additional_background, language, reader, max_display, output_names)
+
+    return _complete(client, gpt_model, messages, parse, cache, language, reader, schema)
+
+
+async def _aexplain_bar(image, feature_names, client, feature_aliases=None, feature_descriptions=None,
+                        additional_background=None, gpt_model='gpt-4o', language='en', reader='general',
+                        cache=None, shap_values=None, max_display=10, output_names=None):
+    _validate(language, reader)
+
+    parse, schema = _response(output_names)
+    messages = _bar_prompt(image, feature_names, shap_values, feature_aliases, feature_descriptions,
+                           additional_background, language, reader, max_display, output_names)
+
+    return await _acomplete(client, gpt_model, messages, parse, cache, language, reader, schema)
+
+
+def _bar_alias(shap_values, feature_aliases):
+    if isinstance(shap_values, shap.Explanation):
+        original_feature_names = shap_values.feature_names
+        nsv = _alias_view(shap_values, _alias_names(original_feature_names, feature_aliases))
+    elif isinstance(shap_values, (shap.Cohorts, dict)):
+        cohorts = shap_values.cohorts if isinstance(shap_values, shap.Cohorts) else shap_values
+        original_feature_names = []
+        # Cohorts usually share their feature names, so the aliases are built once per distinct list of names
+        aliased = {}
+        nsv = {}
+        for label, exp in cohorts.items():
+            original_feature_names = exp.feature_names
+            key = tuple(original_feature_names)
+            if key not in aliased:
+                aliased[key] = _alias_names(original_feature_names, feature_aliases)
+            nsv[label] = _alias_view(exp, aliased[key])
+    else:
+        emsg = (
+            "The shap_values argument must be an Explanation object, Cohorts "
+            "object, or dictionary of Explanation objects!"
+        )
+        raise TypeError(emsg)
+
+    return nsv, original_feature_names
+
+
+def _bar(client, shap_values, feature_aliases, feature_descriptions=None, additional_background=None, explain=True,
+         show=True, gpt_model='gpt-4o', language='en', reader='general', cache=None, mode='image', image_encoding=None,
+         **kwargs):
+    _check_mode(mode)
+
+    output_names = _bar_outputs(shap_values)
+    if output_names is not None:
+        shap_values = _output_cohorts(shap_values, output_names)
+    nsv, original_feature_names = _bar_alias(shap_values, feature_aliases)
+
+    if _draws(mode, show, explain):
+        with span('draw'):
+            shap.plots.bar(nsv, show=False, **kwargs)
 
     if explain:
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        data = buf.getvalue()
-        buf.close()
+        # The numeric mode sends the SHAP values as text, so the plot is not rendered to an image
+        data = _render(image_encoding) if mode == 'image' else None
 
         if show:
             plt.show()
 
-        return _explain_waterfall(data, explanation, feature_aliases, feature_descriptions, additional_background,
-                                  openai_api_key, gpt_model, language, reader)
+        return _explain_bar(data, original_feature_names, client, feature_aliases, feature_descriptions,
+                            additional_background, gpt_model, language, reader, cache, shap_values,
+                            kwargs.get('max_display', 10), output_names)
     else:
         if show:
             plt.show()
         return None
 
 
-def _explain_bar(image, feature_names, feature_aliases=None, feature_descriptions=None, additional_background=None,
-                 openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general'):
-    if language not in languages:
-        raise ValueError("Language must be one of: " + ", ".join(languages))
-
-    if reader not in readers:
-        raise ValueError("Reader must be one of: " + ", ".join(readers))
-
-    client = OpenAI(api_key=openai_api_key)
-
-    bi = base64.b64encode(image).decode()
-    prompt_features = []
-
-    for f in feature_names:
-        desc = ''
-        if feature_descriptions is not None and f in feature_descriptions:
-            desc = feature_descriptions[f]
-
-        alias = ''
-        if feature_aliases is not None and f in feature_aliases:
-            alias = feature_aliases[f]
-
-        prompt_features.append(
-            {'Feature Name': f, 'Feature Alias': alias, 'Feature Description': desc})
-
-    completion = client.chat.completions.create(
-        model=gpt_model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"""
-            SHAP refers to SHapley Additive exPlanations. Refer to the "A Unified Approach to Interpreting Model Predictions" paper by Scott Lundberg. This is about AI model training.
-            Your job is to output an easy explanation about the image in the context of the SHAP values to better explain to readers the meaning of the bar plot.
-            f{readers[reader]}
-            The given image is a bar plot of a features in the dataset and their corresponding average SHAP values.
-            {'' if len(prompt_features) == 0 else f'Alias and description of the feature names:\n{_table(prompt_features)}\n'}
-            {'' if additional_background is None else f'Context background of this model to be included in the explanation: {additional_background}.'}
-            Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
-            Output is only a JSON object with a string field `explanation` containing the explanation.
-            Do not enclose the JSON in markdown code."""
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{bi}"
-                        }
-                    }
-                ]
-            }
-        ]
-    )
-
-    response = json.loads(completion.choices[0].message.content)
-    return response['explanation']
-
-
 def bar(shap_values, feature_aliases=None, feature_descriptions=None, additional_background=None, explain=True,
-        show=True, openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general', **kwargs):
+        show=True, openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general', cache=None, mode='image',
+        image_encoding=None, **kwargs):
     """
         Displays a SHAP bar plot. This is a utility wrapper function that accepts feature aliases dictionary
         to easily alias some feature names that are otherwise retrieved by default through shap_values.feature_names.
         By setting `explain` to True, this function will also return a string of narration containing explanation about the bar plot.
         **kwargs is passed to shap.plots.bar function to modify the function.
+        This function uses the shared `contextualshap.Session` of the API key, so repeated calls reuse the same connections.
+        The outputs of a multi-output shap.Explanation (e.g. of a classifier) are drawn side by side in one plot, and every
+        output is narrated in a single request, returning a dictionary mapping each output name to its narration.
+        With a list of languages or readers, the plot is narrated once and the narration is rewritten for the other ones
+        with concurrent text-only requests, without re-sending the image or the SHAP values.
+        SHAP values larger than memory can be aggregated with `mean_abs_shap` first, and its result given to this function.
 
         :param shap_values: a shap.Explanation or shap.Cohorts or dictionary of shap.Explanation instance retrieved from calling shap explainer.
         :param feature_aliases: an optional dictionary mapping of old feature name to new feature name.
@@ -205,69 +643,192 @@ def bar(shap_values, feature_aliases=None, feature_descriptions=None, additional
         :param explain: setting this to false will not call OpenAI API to retrieve the plot explanation, so API key, GPT model, and language parameters are not used. Nothing will be returned if explain is False.
         :param openai_api_key: an OpenAI API key to use for API calls.
         :param gpt_model: a GPT model to use.
-        :param language: a language code to use.
-        :param reader: the reader level of comprehension, can be 'general' or 'expert'
+        :param language: a language code to use, or a list of language codes, which returns a dictionary mapping each language to its narration.
+        :param reader: the reader level of comprehension, can be 'general' or 'expert', or a list of reader levels, which returns a dictionary mapping each reader (or each (language, reader) pair when both are lists) to its narration.
+        :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API.
+        :param mode: 'image' sends the rendered plot to GPT, 'numeric' sends the mean absolute SHAP value of the top `max_display` features as text instead, which skips rendering the plot to an image, and drawing it when `show` is False.
+        :param image_encoding: an optional `contextualshap.encoding.ImageEncoding` setting the format, resolution and detail level of the image sent to GPT, and recording its payload bytes.
         :return: anything returned by shap.plots.waterfall, especially in the case of setting `show=False`.
         """
+    return session.get_session(openai_api_key).bar(shap_values, feature_aliases, feature_descriptions,
+                                                   additional_background, explain, show, gpt_model, language, reader,
+                                                   cache, mode, image_encoding, **kwargs)
 
-    if feature_aliases is None:
-        feature_aliases = {}
 
-    original_feature_names = []
-    feature_names = []
-    if isinstance(shap_values, shap.Explanation):
-        for f in shap_values.feature_names:
-            if f in feature_aliases:
-                feature_names.append(feature_aliases[f])
+def _bar_stream(client, shap_values, feature_aliases, feature_descriptions=None, additional_background=None,
+                show=True, gpt_model='gpt-4o', language='en', reader='general', cache=None, mode='image',
+                image_encoding=None, **kwargs):
+    _check_mode(mode)
+    _validate(language, reader)
+    _single_output(_bar_outputs(shap_values), 'Streaming')
+
+    nsv, original_feature_names = _bar_alias(shap_values, feature_aliases)
+    if _draws(mode, show):
+        with span('draw'):
+            shap.plots.bar(nsv, show=False, **kwargs)
+    data = _render(image_encoding) if mode == 'image' else None
+
+    # The plot is shown before the first token arrives, the generator only waits for the explanation
+    if show:
+        plt.show()
+
+    messages = _bar_prompt(data, original_feature_names, shap_values, feature_aliases, feature_descriptions,
+                           additional_background, language, reader, kwargs.get('max_display', 10))
+    return _texts(_stream(client, gpt_model, messages, _explanation, ['explanation'], cache, language, reader,
+                           explanation_schema))
+
+
+def bar_stream(shap_values, feature_aliases=None, feature_descriptions=None, additional_background=None, show=True,
+               openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general', cache=None, mode='image',
+               image_encoding=None, **kwargs):
+    """
+    Streaming version of `bar` with `explain` set to True. The plot is displayed right away, then the explanation is
+    yielded piece by piece while it is generated.
+    **kwargs is passed to shap.plots.bar function to modify the function.
+
+    :return: a generator of strings, joined together they are the explanation returned by `bar`.
+    """
+    return session.get_session(openai_api_key).bar_stream(shap_values, feature_aliases, feature_descriptions,
+                                                          additional_background, show, gpt_model, language, reader,
+                                                          cache, mode, image_encoding, **kwargs)
+
+
+def _chunks(array, chunk_size):
+    # A memory-mapped array is read one slice of rows at a time, an iterable is already chunked
+    if isinstance(array, np.ndarray):
+        return (array[i:i + chunk_size] for i in range(0, len(array), chunk_size))
+    return iter(array)
+
+
+def mean_abs_shap(shap_values, feature_names, cohorts=None, chunk_size=65536):
+    """
+    Computes the mean absolute SHAP value of each feature in a single pass over chunks of rows, so the SHAP values of
+    more samples than fit in memory can be plotted and narrated with `bar`. Only one chunk is in memory at a time, and
+    the result is the small Explanation `bar` draws anyway.
+
+    :param shap_values: a 2D array of SHAP values, one row per sample, e.g. a memory-mapped `np.load(path, mmap_mode='r')`, or an iterable of 2D chunks of rows, e.g. the shards of a dataset.
+    :param feature_names: the feature names of the columns.
+    :param cohorts: optional cohort labels of the rows, an array aligned with the rows of `shap_values`, or an iterable of label chunks aligned with its chunks.
+    :param chunk_size: the number of rows read at a time from an array.
+    :return: a shap.Explanation of the mean absolute SHAP value of each feature, or a dictionary mapping each cohort label to one
+    """
+    feature_names = list(feature_names)
+    sums = {}
+    counts = {}
+    with span('aggregate') as s:
+        rows = 0
+        chunks = _chunks(shap_values, chunk_size)
+        if cohorts is None:
+            pairs = zip(chunks, itertools.repeat(None))
+        else:
+            # The label chunks are read alongside the value chunks, one of them running out first is an error
+            missing = object()
+            pairs = itertools.zip_longest(chunks, _chunks(np.asarray(cohorts) if isinstance(shap_values, np.ndarray)
+                                                          else cohorts, chunk_size), fillvalue=missing)
+        for chunk, chunk_labels in pairs:
+            if cohorts is not None and (chunk is missing or chunk_labels is missing):
+                raise ValueError("Expected as many chunks of cohort labels as chunks of SHAP values")
+            values = np.abs(np.asarray(chunk, dtype=float))
+            if values.ndim != 2 or values.shape[1] != len(feature_names):
+                raise ValueError(f"Expected chunks of shape (rows, {len(feature_names)}), got {values.shape}")
+            rows += len(values)
+            if chunk_labels is None:
+                groups, totals, sizes = [''], values.sum(axis=0)[None, :], [len(values)]
             else:
-                feature_names.append(f)
-        nsv = copy.deepcopy(shap_values)
-        nsv.feature_names = feature_names
-        original_feature_names = shap_values.feature_names
-    elif isinstance(shap_values, shap.Cohorts):
-        cohorts = copy.deepcopy(shap_values.cohorts)
-        for label, exp in cohorts.items():
-            original_feature_names = exp.feature_names
-            for f in exp.feature_names:
-                if f in feature_aliases:
-                    feature_names.append(feature_aliases[f])
-                else:
-                    feature_names.append(f)
-            exp.feature_names = feature_names
-        nsv = cohorts
-    elif isinstance(shap_values, dict):
-        cohorts = copy.deepcopy(shap_values)
-        for label, exp in cohorts.items():
-            original_feature_names = exp.feature_names
-            for f in exp.feature_names:
-                if f in feature_aliases:
-                    feature_names.append(feature_aliases[f])
-                else:
-                    feature_names.append(f)
-            exp.feature_names = feature_names
-        nsv = cohorts
-    else:
-        emsg = (
-            "The shap_values argument must be an Explanation object, Cohorts "
-            "object, or dictionary of Explanation objects!"
-        )
-        raise TypeError(emsg)
+                chunk_labels = np.asarray(chunk_labels)
+                if len(chunk_labels) != len(values):
+                    raise ValueError(f"Expected {len(values)} cohort labels, got {len(chunk_labels)}")
+                groups, inverse, sizes = np.unique(chunk_labels, return_inverse=True, return_counts=True)
+                # A one-hot (cohort, row) matrix sums the rows of every cohort of the chunk in one product
+                one_hot = np.zeros((len(groups), len(values)))
+                one_hot[inverse.reshape(-1), np.arange(len(values))] = 1
+                totals = one_hot @ values
+            for group, total, size in zip(groups, totals, sizes):
+                group = str(group)
+                sums[group] = sums.get(group, 0) + total
+                counts[group] = counts.get(group, 0) + int(size)
+        s.set(rows=rows)
+
+    if rows == 0:
+        raise ValueError("No SHAP values to aggregate")
+    means = {group: shap.Explanation(values=sums[group] / counts[group], feature_names=feature_names) for group in sums}
+    return means[''] if cohorts is None else means
+
+
+def _render_bars(shap_values_list, feature_aliases, mode='image', image_encoding=None, **kwargs):
+    _check_mode(mode)
+    if mode == 'numeric':
+        # Nothing to render, the SHAP values are sent as text
+        return [(None, None, shap_values) for shap_values in shap_values_list]
+
+    # Matplotlib is not thread-safe, so the plots are rendered one by one before the requests are sent concurrently
+    rendered = []
+    for shap_values in shap_values_list:
+        try:
+            nsv, original_feature_names = _bar_alias(shap_values, feature_aliases)
+            with span('draw'):
+                shap.plots.bar(nsv, show=False, **kwargs)
+            rendered.append((_render(image_encoding), original_feature_names, shap_values))
+        except Exception as e:
+            rendered.append(e)
+        finally:
+            plt.close()
+    return rendered
+
+
+async def _anarrate_bars(client, rendered, feature_aliases, feature_descriptions=None, additional_background=None,
+                         gpt_model='gpt-4o', language='en', reader='general', concurrency=8, cache=None,
+                         max_display=10):
+    _validate(language, reader)
+
+    async def narrate(item):
+        if isinstance(item, Exception):
+            raise item
+        image, original_feature_names, shap_values = item
+        return await _aexplain_bar(image, original_feature_names, client, feature_aliases, feature_descriptions,
+                                   additional_background, gpt_model, language, reader, cache, shap_values,
+                                   max_display)
+
+    return await _gather([lambda item=item: narrate(item) for item in rendered], concurrency)
+
+
+async def abar_many(shap_values_list, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                    openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general', concurrency=8, cache=None,
+                    mode='image', image_encoding=None, **kwargs):
+    """
+    Asynchronous version of `bar_many`, to be awaited from a running event loop (e.g. a Jupyter notebook).
 
-    shap.plots.bar(nsv, show=False, **kwargs)
+    :return: a list with one item per element of `shap_values_list`, see `bar_many`.
+    """
+    return await session.get_session(openai_api_key).abar_many(
+        shap_values_list, feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader,
+        concurrency, cache, mode, image_encoding, **kwargs)
 
-    if explain:
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        data = buf.getvalue()
-        buf.close()
 
-        if show:
-            plt.show()
+def bar_many(shap_values_list, feature_aliases=None, feature_descriptions=None, additional_background=None,
+             openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general', concurrency=8, cache=None,
+             mode='image', image_encoding=None, **kwargs):
+    """
+    Explains many SHAP bar plots at once. Every plot is rendered without being shown, then the explanation requests are
+    sent concurrently through a single `AsyncOpenAI` client, with at most `concurrency` requests in flight at the same
+    time. Use `abar_many` when an event loop is already running.
+    **kwargs is passed to shap.plots.bar function to modify the function.
 
-        return _explain_bar(data, original_feature_names, feature_aliases, feature_descriptions, additional_background,
-                            openai_api_key, gpt_model, language, reader)
-    else:
-        if show:
-            plt.show()
-        return None
+    :param shap_values_list: a list where each item is a shap.Explanation or shap.Cohorts or dictionary of shap.Explanation.
+    :param feature_aliases: an optional dictionary mapping of old feature name to new feature name.
+    :param feature_descriptions: an optional dictionary mapping of old feature name to description.
+    :param additional_background: an optional background string to be given to GPT to enhance explanation.
+    :param openai_api_key: an OpenAI API key to use for API calls.
+    :param gpt_model: a GPT model to use.
+    :param language: a language code to use.
+    :param reader: the reader level of comprehension, can be 'general' or 'expert'
+    :param concurrency: maximum number of requests sent at the same time.
+    :param cache: an optional narration cache (see `contextualshap.cache`), a cached narration is returned without calling the API.
+    :param mode: 'image' sends the rendered plots to GPT, 'numeric' sends the SHAP values as text and skips rendering, see `bar`.
+    :param image_encoding: an optional `contextualshap.encoding.ImageEncoding` of the images, see `bar`.
+    :return: a list in the same order as `shap_values_list`, each item is either the explanation string or the
+        exception raised while rendering or explaining that item.
+    """
+    return session.get_session(openai_api_key).bar_many(
+        shap_values_list, feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader,
+        concurrency, cache, mode, image_encoding, **kwargs)
@@ -0,0 +1,281 @@
+import functools
+from .common import _estimate_tokens, _table, languages, readers
+
+tasks = ['explain', 'reduce', 'waterfall', 'waterfall_numeric', 'bar', 'bar_numeric', 'explain_batch', 'waterfall_batch',
+         'waterfall_numeric_batch', 'explain_outputs', 'waterfall_outputs', 'waterfall_numeric_outputs', 'bar_outputs',
+         'bar_numeric_outputs', 'translate']
+# The tasks whose prompt lists every feature, the alias of a feature defaults to its name
+_every_feature = ('explain', 'reduce', 'explain_batch', 'explain_outputs')
+
+_introduction = 'SHAP refers to SHapley Additive exPlanations. Refer to the "A Unified Approach to Interpreting Model Predictions" paper by Scott Lundberg. This is about AI model training.'
+_json_explanation = """Output is only a JSON object with a string field `explanation` containing the explanation.
+    Do not enclose the JSON in markdown code."""
+_features_fields = "a string field `summary` and `features`, which is an array of JSON with field name 'feature_name' for the feature name, 'description' for the description that you interpreted, and 'explanation' for the explanation."
+_json_features = f"Output is only a JSON object with {_features_fields} Do not enclose the JSON in markdown code."
+
+
+class PromptTemplate:
+    """
+    The compiled prompt of a task for one language, reader, feature set and background. Every static part of the
+    prompt, including the table of feature aliases and descriptions, is in `prefix`, which is built once and is the
+    same bytes for every request. The per-request data (the SHAP values, the partial explanations or the plot numbers)
+    and the image are appended after it, so the provider can reuse its cached prefix (OpenAI caches prompt prefixes of
+    1024 tokens or more), and the `cached_tokens` of each request are reported by its 'request' span (see
+    `contextualshap.instrument`).
+    """
+
+    def __init__(self, task, prefix):
+        self.task = task
+        self.prefix = prefix
+
+    @property
+    def prefix_tokens(self):
+        """The estimated number of tokens of the prefix."""
+        return _estimate_tokens(self.prefix)
+
+    def messages(self, data='', image=None):
+        """
+        :param data: the text of the request data.
+        :param image: an optional `image_url` content, or a list of them, sent after the text.
+        :return: the chat messages of the request
+        """
+        text = self.prefix + data
+        if image is None:
+            return [{"role": "user", "content": text}]
+        images = image if isinstance(image, list) else [image]
+        return [{"role": "user", "content": [{"type": "text", "text": text},
+                                             *({"type": "image_url", "image_url": i} for i in images)]}]
+
+    def __repr__(self):
+        return f"PromptTemplate({self.task!r}, prefix_tokens={self.prefix_tokens})"
+
+
+def _background(additional_background):
+    return '' if additional_background is None else \
+        f'Context background of this model to be included in the explanation: {additional_background}.'
+
+
+def _features_table(features, every_feature):
+    # The explain prompts list every feature, the plot prompts only the features with an alias or a description
+    return [{'Feature Name': f, 'Feature Alias': alias, 'Feature Description': desc}
+            for f, alias, desc in features if every_feature or alias or desc]
+
+
+def _explain_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to output an explanation about each feature according to the SHAP values to better explain to readers the meaning of these SHAP values for each of the features and the result of the AI model.
+    {readers[reader]}
+    This is a table of feature names of the dataset, their aliases, and the description of the feature. If there is no description or alias, interpret the feature name yourself.
+    {_table(_features_table(features, True))}
+    {_background(additional_background)}
+    Also add a summary of everything that is given.
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know. {_json_features}
+    You are now given a few samples of the AI model prediction, consists of the input value and SHAP value for each feature.
+"""
+
+
+def _reduce_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to merge several partial explanations of the SHAP values of the same AI model into a single explanation. Each partial explanation was written from a different group of samples of the AI model prediction.
+    {readers[reader]}
+    This is a table of feature names of the dataset, their aliases, and the description of the feature. If there is no description or alias, interpret the feature name yourself.
+    {_table(_features_table(features, True))}
+    {_background(additional_background)}
+    Merge them so that the summary and the explanation of each feature cover all of the groups of samples. Keep exactly one entry for each feature name.
+    Reply in {languages[language]} language. {_json_features}
+    These are the partial explanations, each is a JSON object with a summary and an explanation for each feature.
+"""
+
+
+def _aliases(features, note=''):
+    rows = _features_table(features, False)
+    return '' if len(rows) == 0 else f'Alias and description of the feature names:\n{_table(rows)}{note}'
+
+
+def _waterfall_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to output an easy explanation about the image in the context of the SHAP values to better explain to readers the meaning of the waterfall plot.
+    {readers[reader]}
+    The given image is a waterfall plot of a single prediction sample in the dataset.
+    {_aliases(features, 'The feature description sometimes explain what the values mean, and you must include the explanation for the values in the result.')}
+    {_background(additional_background)}
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
+    {_json_explanation}
+    These are the result of the prediction of the sample, and the SHAP value and the sample value of each feature.
+"""
+
+
+def _waterfall_numeric_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to output an easy explanation about the SHAP values of a single prediction sample in the dataset to better explain to readers the meaning of its waterfall plot.
+    {readers[reader]}
+    {_aliases(features, 'The feature description sometimes explain what the values mean, and you must include the explanation for the values in the result.')}
+    {_background(additional_background)}
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
+    {_json_explanation}
+    You are now given the base value (the expected model output), the result of the prediction of the sample, and the features with the largest absolute SHAP values, ordered from the largest. A positive SHAP value pushes the prediction above the base value, and a negative SHAP value pushes it below.
+"""
+
+
+def _bar_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to output an easy explanation about the image in the context of the SHAP values to better explain to readers the meaning of the bar plot.
+    {readers[reader]}
+    The given image is a bar plot of a features in the dataset and their corresponding average SHAP values.
+    {_aliases(features)}
+    {_background(additional_background)}
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
+    {_json_explanation}
+"""
+
+
+def _bar_numeric_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to output an easy explanation about the SHAP values to better explain to readers the meaning of the bar plot of the feature importance.
+    {readers[reader]}
+    {_aliases(features)}
+    {_background(additional_background)}
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
+    {_json_explanation}
+    You are now given the features of the dataset ordered from the most important, with their average absolute SHAP values.
+"""
+
+
+def _explain_batch_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to output an explanation about each feature according to the SHAP values for each of several independent requests. Each request is a few samples of the AI model prediction, and is explained separately from the others.
+    {readers[reader]}
+    This is a table of feature names of the dataset, their aliases, and the description of the feature. If there is no description or alias, interpret the feature name yourself.
+    {_table(_features_table(features, True))}
+    {_background(additional_background)}
+    Also add a summary of everything that is given in each request.
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know. Output is only a JSON object with a field `requests`, which is an array with one JSON object per request in the order of the request numbers. Each of them has {_features_fields} Do not enclose the JSON in markdown code.
+    You are now given the samples of the requests, consists of the request number, and the input value and SHAP value for each feature.
+"""
+
+
+def _waterfall_batch_prefix(features, additional_background, language, reader, numeric=False):
+    if numeric:
+        given = 'You are given the SHAP values of several prediction samples in the dataset, one per request, to better explain to readers the meaning of their waterfall plots.'
+    else:
+        given = 'The given images are waterfall plots of several prediction samples in the dataset, one per request, in the order of the requests.'
+    return f"""
+    {_introduction}
+    Your job is to output an easy explanation for each of several independent requests in the context of the SHAP values. Each request is explained separately from the others.
+    {readers[reader]}
+    {given}
+    {_aliases(features, 'The feature description sometimes explain what the values mean, and you must include the explanation for the values in the result.')}
+    {_background(additional_background)}
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
+    Output is only a JSON object with a field `explanations`, which is an array with one explanation string per request, in the order of the requests.
+    Do not enclose the JSON in markdown code.
+    These are the {'base value, ' if numeric else ''}result of the prediction and the SHAP values of the sample of each request.
+"""
+
+
+def _explain_outputs_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to output an explanation about each feature according to the SHAP values for each output of a multi-output AI model (e.g. each class of a classifier), to better explain to readers the meaning of these SHAP values for each of the features and the result of the AI model for that output.
+    {readers[reader]}
+    This is a table of feature names of the dataset, their aliases, and the description of the feature. If there is no description or alias, interpret the feature name yourself.
+    {_table(_features_table(features, True))}
+    {_background(additional_background)}
+    Also add a summary of everything that is given for each output.
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know. Output is only a JSON object with a field `outputs`, which is an array with one JSON object per output in the order of the SHAP value columns. Each of them has {_features_fields} Do not enclose the JSON in markdown code.
+    You are now given a few samples of the AI model prediction, consists of the input value of each feature and its SHAP value for each output.
+"""
+
+
+def _waterfall_outputs_prefix(features, additional_background, language, reader, numeric=False):
+    if numeric:
+        given = 'You are given the SHAP values of a single prediction sample in the dataset for each output, to better explain to readers the meaning of its waterfall plots.'
+    else:
+        given = 'The given images are waterfall plots of a single prediction sample in the dataset, one per output, in the order of the outputs.'
+    return f"""
+    {_introduction}
+    Your job is to output an easy explanation for each output of a multi-output AI model (e.g. each class of a classifier) in the context of the SHAP values. Each output is explained separately, and its explanation may compare it with the other outputs.
+    {readers[reader]}
+    {given}
+    {_aliases(features, 'The feature description sometimes explain what the values mean, and you must include the explanation for the values in the result.')}
+    {_background(additional_background)}
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
+    Output is only a JSON object with a field `outputs`, which is an array with one explanation string per output, in the order of the outputs.
+    Do not enclose the JSON in markdown code.
+    You are now given the base value (the expected model output) and the result of the prediction of each output, and the features {'with the largest absolute SHAP values, ordered from the largest' if numeric else 'of the sample'}, with their sample value and one SHAP value column per output. A positive SHAP value pushes the prediction of an output above its base value, and a negative SHAP value pushes it below.
+"""
+
+
+def _bar_outputs_prefix(features, additional_background, language, reader, numeric=False):
+    if numeric:
+        given = 'You are now given the features of the dataset ordered from the most important, with their average absolute SHAP values for each output.'
+    else:
+        given = 'The given image is a bar plot of the features in the dataset and their average absolute SHAP values, with one bar per output for each feature. You are now given the outputs of the model.'
+    return f"""
+    {_introduction}
+    Your job is to output an easy explanation for each output of a multi-output AI model (e.g. each class of a classifier) in the context of the SHAP values, to better explain to readers the meaning of the bar plot of the feature importance. Each output is explained separately, and its explanation may compare it with the other outputs.
+    {readers[reader]}
+    {_aliases(features)}
+    {_background(additional_background)}
+    Reply in {languages[language]} language. Give explanation for each feature name and the SHAP values for amateur readers. Also add some more explanation or context that you know.
+    Output is only a JSON object with a field `outputs`, which is an array with one explanation string per output, in the order of the outputs.
+    Do not enclose the JSON in markdown code.
+    {given}
+"""
+
+
+def _translate_prefix(features, additional_background, language, reader):
+    return f"""
+    {_introduction}
+    Your job is to rewrite a narration of SHAP values, given as a JSON object, for another language and reader. Keep its meaning, its numbers and its JSON structure.
+    {readers[reader]}
+    Reply in {languages[language]} language. Rewrite every string value of the JSON, except the 'feature_name' values which are kept as they are. Output is only a JSON object with the same fields and the same number of items.
+    Do not enclose the JSON in markdown code.
+    This is the narration.
+"""
+
+
+_prefixes = {'explain': _explain_prefix, 'reduce': _reduce_prefix, 'waterfall': _waterfall_prefix,
+             'waterfall_numeric': _waterfall_numeric_prefix, 'bar': _bar_prefix, 'bar_numeric': _bar_numeric_prefix,
+             'explain_batch': _explain_batch_prefix, 'waterfall_batch': _waterfall_batch_prefix,
+             'waterfall_numeric_batch': functools.partial(_waterfall_batch_prefix, numeric=True),
+             'explain_outputs': _explain_outputs_prefix, 'waterfall_outputs': _waterfall_outputs_prefix,
+             'waterfall_numeric_outputs': functools.partial(_waterfall_outputs_prefix, numeric=True),
+             'bar_outputs': _bar_outputs_prefix, 'bar_numeric_outputs': functools.partial(_bar_outputs_prefix, numeric=True),
+             'translate': _translate_prefix}
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(task, features, additional_background, language, reader):
+    return PromptTemplate(task, _prefixes[task](features, additional_background, language, reader))
+
+
+def prompt_template(task, feature_names, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                    language='en', reader='general'):
+    """
+    Returns the compiled PromptTemplate of a task. Templates are cached, so the prefix of the same task, language,
+    reader, features and background is built once per process.
+
+    :param task: one of `tasks`.
+    :param feature_names: the feature names of the SHAP values.
+    :param feature_aliases: an optional dictionary mapping of feature name to alias.
+    :param feature_descriptions: an optional dictionary mapping of feature name to description.
+    :param additional_background: an optional background string of the model.
+    :param language: the language code of the responses.
+    :param reader: the reader level of comprehension, can be 'general' or 'expert'.
+    :return: a PromptTemplate
+    """
+    if task not in tasks:
+        raise ValueError("Task must be one of: " + ", ".join(tasks))
+    feature_aliases = {} if feature_aliases is None else feature_aliases
+    feature_descriptions = {} if feature_descriptions is None else feature_descriptions
+    features = tuple((str(f), str(feature_aliases.get(f, f if task in _every_feature else '')),
+                      str(feature_descriptions.get(f, ''))) for f in feature_names)
+    return _compile(task, features, additional_background, language, reader)
@@ -0,0 +1,264 @@
+import asyncio
+import random
+import threading
+import time
+from .backends import Backend
+from .common import _estimate_tokens
+from .instrument import current
+
+# The statuses of the errors worth retrying: timeouts, conflicts, rate limits and server errors
+retry_statuses = {408, 409, 429, 500, 502, 503, 504}
+# The tokens of an image part, a low detail image costs 85 tokens and a high detail one 85 per 512 pixels tile plus 85
+_image_tokens = {'low': 85, 'auto': 765, 'high': 765}
+
+
+def estimate_tokens(messages, completion_tokens=0):
+    """
+    Estimates the tokens a request counts against a tokens-per-minute quota, before it is sent.
+
+    :param messages: the chat messages of the request.
+    :param completion_tokens: the expected tokens of the response.
+    :return: the estimated number of tokens
+    """
+    tokens = completion_tokens
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            tokens += _estimate_tokens(content)
+            continue
+        for part in content:
+            if part['type'] == 'text':
+                tokens += _estimate_tokens(part['text'])
+            else:
+                tokens += _image_tokens.get(part['image_url'].get('detail', 'auto'), _image_tokens['auto'])
+    return tokens
+
+
+class _TokenBucket:
+    # A bucket refilled at `limit` per minute. Taking tokens reserves them even when the bucket is empty, the caller
+    # then waits until the bucket is refilled, so concurrent callers are served in order without going over the limit.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._tokens = limit
+        self._updated = time.monotonic()
+
+    def take(self, n, now):
+        self._tokens = min(self.limit, self._tokens + max(0.0, now - self._updated) * self.limit / 60)
+        self._updated = max(self._updated, now)
+        # A request larger than the bucket waits for a whole bucket instead of forever
+        self._tokens -= min(n, self.limit)
+        return max(0.0, -self._tokens * 60 / self.limit)
+
+    def give(self, n):
+        self._tokens = min(self.limit, self._tokens + n)
+
+
+def _status(error):
+    status = getattr(error, 'status_code', None)
+    if status is None and type(error).__name__ in ('APIConnectionError', 'APITimeoutError'):
+        # The connection errors of the openai package have no status
+        return 408
+    return status
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        # An HTTP date is not worth parsing, the backoff is used instead
+        pass
+    return None
+
+
+class RateLimitedBackend(Backend):
+    """
+    A backend sending the requests of another backend within requests-per-minute and tokens-per-minute quotas, and
+    retrying its transient errors. The tokens of every request are estimated before it is sent (the prompt and the
+    expected `completion_tokens`) and corrected with the usage of its response, or with the estimated tokens of the
+    streamed text for a stream, so concurrent narrations keep the quotas saturated without going over them.
+
+    A rate limited (429) error pauses every request until its `Retry-After` delay, and the other transient errors
+    (timeouts, connection and server errors) are retried after a jittered exponential backoff. `retries` counts the
+    retried requests and `throttled` the seconds spent waiting for the quotas, and the 'request' span of each request
+    gets its `retries` and `throttled` seconds (see `contextualshap.instrument`).
+    """
+
+    def __init__(self, backend, requests_per_minute=None, tokens_per_minute=None, max_retries=5, base_delay=0.5,
+                 max_delay=60.0, completion_tokens=500, seed=None):
+        """
+        :param backend: the Backend sending the requests, e.g. an OpenAIBackend.
+        :param requests_per_minute: the requests per minute quota, None for no quota.
+        :param tokens_per_minute: the tokens per minute quota, None for no quota.
+        :param max_retries: the maximum number of retries of a request.
+        :param base_delay: the seconds of the first backoff, doubled at every retry.
+        :param max_delay: the maximum seconds of a backoff.
+        :param completion_tokens: the expected tokens of a response, counted before the request is sent.
+        :param seed: an optional seed of the backoff jitter.
+        """
+        self.backend = backend
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.completion_tokens = completion_tokens
+        self.retries = 0
+        self.throttled = 0.0
+        self._requests = None if requests_per_minute is None else _TokenBucket(requests_per_minute)
+        self._tokens = None if tokens_per_minute is None else _TokenBucket(tokens_per_minute)
+        self._paused_until = 0.0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens):
+        # Returns the seconds to wait before sending a request of `tokens` estimated tokens
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self._requests is not None:
+                wait = max(wait, self._requests.take(1, now))
+            if self._tokens is not None:
+                wait = max(wait, self._tokens.take(tokens, now))
+            self.throttled += wait
+        return wait
+
+    def _settle(self, estimated, usage):
+        # Gives back the tokens estimated but not used, or takes the tokens used over the estimate
+        if self._tokens is None or usage.get('prompt_tokens') is None:
+            return
+        used = usage['prompt_tokens'] + (usage.get('completion_tokens') or 0)
+        with self._lock:
+            if used < estimated:
+                self._tokens.give(estimated - used)
+            else:
+                self._tokens.take(used - estimated, time.monotonic())
+
+    def _backoff(self, error, attempt):
+        # Returns the seconds to wait before retrying, or None when the error is not retried
+        if attempt >= self.max_retries or _status(error) not in retry_statuses:
+            return None
+        delay = _retry_after(error)
+        with self._lock:
+            if delay is None:
+                # Full jitter: a random delay up to the exponential backoff, so the retries of a burst spread out
+                delay = self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            if _status(error) == 429:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self.retries += 1
+        return delay
+
+    @staticmethod
+    def _record(attempt, throttled):
+        span = current()
+        if span is not None:
+            span.set(retries=attempt, throttled=throttled)
+
+    def complete(self, gpt_model, messages, schema=None):
+        estimated = estimate_tokens(messages, self.completion_tokens)
+        attempt, throttled = 0, 0.0
+        while True:
+            wait = self._reserve(estimated)
+            throttled += wait
+            time.sleep(wait)
+            try:
+                result = self.backend.complete(gpt_model, messages, schema)
+            except Exception as e:
+                delay = self._backoff(e, attempt)
+                if delay is None:
+                    self._record(attempt, throttled)
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._settle(estimated, result.usage)
+            self._record(attempt, throttled)
+            return result
+
+    async def acomplete(self, gpt_model, messages, schema=None):
+        estimated = estimate_tokens(messages, self.completion_tokens)
+        attempt, throttled = 0, 0.0
+        while True:
+            wait = self._reserve(estimated)
+            throttled += wait
+            await asyncio.sleep(wait)
+            try:
+                result = await self.backend.acomplete(gpt_model, messages, schema)
+            except Exception as e:
+                delay = self._backoff(e, attempt)
+                if delay is None:
+                    self._record(attempt, throttled)
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._settle(estimated, result.usage)
+            self._record(attempt, throttled)
+            return result
+
+    @staticmethod
+    def _streamed(messages, chunks):
+        # Streams have no usage, the tokens of the prompt and of the streamed text are estimated instead
+        return {'prompt_tokens': estimate_tokens(messages), 'completion_tokens': _estimate_tokens(''.join(chunks))}
+
+    def stream(self, gpt_model, messages, schema=None):
+        # A stream is only retried until its first chunk, the chunks already yielded cannot be taken back
+        estimated = estimate_tokens(messages, self.completion_tokens)
+        attempt, throttled = 0, 0.0
+        while True:
+            wait = self._reserve(estimated)
+            throttled += wait
+            time.sleep(wait)
+            chunks = []
+            try:
+                for chunk in self.backend.stream(gpt_model, messages, schema):
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                delay = None if chunks else self._backoff(e, attempt)
+                if delay is None:
+                    self._record(attempt, throttled)
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            finally:
+                # Also settled when the caller stops reading the stream early
+                if chunks:
+                    self._settle(estimated, self._streamed(messages, chunks))
+            self._record(attempt, throttled)
+            return
+
+    async def astream(self, gpt_model, messages, schema=None):
+        estimated = estimate_tokens(messages, self.completion_tokens)
+        attempt, throttled = 0, 0.0
+        while True:
+            wait = self._reserve(estimated)
+            throttled += wait
+            await asyncio.sleep(wait)
+            chunks = []
+            try:
+                async for chunk in self.backend.astream(gpt_model, messages, schema):
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                delay = None if chunks else self._backoff(e, attempt)
+                if delay is None:
+                    self._record(attempt, throttled)
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                if chunks:
+                    self._settle(estimated, self._streamed(messages, chunks))
+            self._record(attempt, throttled)
+            return
+
+    def close(self):
+        self.backend.close()
+
+    async def aclose(self):
+        await self.backend.aclose()
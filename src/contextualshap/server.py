@@ -0,0 +1,356 @@
+"""
+A local HTTP narration server, to run contextualshap as a sidecar of many model-serving replicas:
+
+    contextualshap-server --port 8000 --window 0.02 --max-batch 8
+
+`POST /explain` takes the JSON object `{"values": [[...]], "data": [[...]], "feature_names": [...]}` of a few samples
+and answers `{"summary": ..., "features": [...]}` like `gpt.explain`. `POST /waterfall` takes the `values`, `data` and
+`base_values` of one sample and answers `{"explanation": ...}` like `plots.waterfall`. Both accept the optional
+`feature_aliases`, `feature_descriptions`, `additional_background`, `gpt_model`, `language` and `reader` fields, and
+`mode` and `max_display` for waterfalls. `GET /health` answers the counters of the server.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from . import gpt, plots
+from .cache import SQLiteCache, cache_key
+from .common import _LazyModule, _acomplete, _gather, _lookup, _validate, batch_explanation_schema, batch_features_schema, explanation_schema, features_schema
+from .session import Session
+
+shap = _LazyModule('shap')
+matplotlib = _LazyModule('matplotlib')
+
+kinds = ['explain', 'waterfall']
+# The single request parser and schema, and the batch parser and schema of each kind
+_parsers = {'explain': (gpt._result, features_schema, gpt._batch_results, batch_features_schema),
+            'waterfall': (plots._explanation, explanation_schema, plots._explanations, batch_explanation_schema)}
+# Matplotlib figures are not thread-safe, the request threads render the plots one at a time
+_render_lock = threading.Lock()
+
+
+def _response(kind, result):
+    if kind == 'explain':
+        summary, features = result
+        return {'summary': summary, 'features': features.to_dict('records')}
+    return {'explanation': result}
+
+
+class _Request:
+    def __init__(self, kind, key, batch_key, options, shap_values, image, messages, mode, max_display, table_format,
+                 precision):
+        self.kind = kind
+        self.key = key
+        self.batch_key = batch_key
+        self.options = options
+        self.shap_values = shap_values
+        self.image = image
+        self.messages = messages
+        self.mode = mode
+        self.max_display = max_display
+        self.table_format = table_format
+        self.precision = precision
+
+
+class Narrator:
+    """
+    Coalesces and micro-batches the requests of a NarrationServer. A request identical to one in flight waits for the
+    same narration instead of sending another one. Requests which share their options and feature names and arrive
+    within `window` seconds are sent together in one multi-request prompt, at most `max_batch` at once, and the answer
+    is split back per request. When a batched answer does not parse or does not have one narration per request, every
+    request of the batch is sent on its own. Invalid responses are repaired, but features missing from an explanation
+    are not requested again, so the server answers with one call per batch.
+
+    `prepare` runs in the request threads, `narrate` on the event loop of the session. `stats` counts the `requests`,
+    the `coalesced` and `cached` ones, the requests answered by a `batched` call, and the backend `calls`.
+    """
+
+    def __init__(self, session, window=0.02, max_batch=8):
+        """
+        :param session: the `contextualshap.session.Session` of the backend and the default options.
+        :param window: the seconds a request waits for other requests to be batched with.
+        :param max_batch: the maximum number of requests of one call, 1 disables the micro-batching.
+        """
+        if max_batch < 1:
+            raise ValueError("Max batch must be at least 1")
+        self.session = session
+        self.window = window
+        self.max_batch = max_batch
+        self.stats = {'requests': 0, 'coalesced': 0, 'cached': 0, 'batched': 0, 'calls': 0}
+        self._inflight = {}
+        self._pending = {}
+        self._tasks = set()
+
+    def prepare(self, kind, body):
+        """
+        Validates a request body and builds its prompt, rendering its plot if needed.
+
+        :param kind: one of `kinds`.
+        :param body: the decoded JSON body of the request.
+        :return: the prepared request, to be given to `narrate`
+        """
+        if kind not in kinds:
+            raise ValueError("Kind must be one of: " + ", ".join(kinds))
+        options = self.session._options(body.get('feature_aliases'), body.get('feature_descriptions'),
+                                        body.get('additional_background'), body.get('gpt_model'),
+                                        body.get('language'), body.get('reader'), None)
+        _validate(options['language'], options['reader'])
+        mode = body.get('mode', 'image')
+        max_display = int(body.get('max_display', 10))
+        table_format = body.get('table_format', 'markdown')
+        precision = body.get('precision')
+        values = np.asarray(body['values'], dtype=float)
+        feature_names = [str(f) for f in body['feature_names']]
+
+        image = None
+        if kind == 'explain':
+            if values.ndim != 2:
+                raise ValueError("Explain values must be a list of samples")
+            shap_values = shap.Explanation(values=values, data=np.asarray(body['data']),
+                                           base_values=np.asarray(body.get('base_values', np.zeros(len(values)))),
+                                           feature_names=feature_names)
+            messages = gpt._messages(shap_values, options['feature_aliases'], options['feature_descriptions'],
+                                     options['additional_background'], options['language'], options['reader'],
+                                     table_format, precision)
+        else:
+            if values.ndim != 1:
+                raise ValueError("Waterfall values must be a single sample")
+            shap_values = shap.Explanation(values=values, data=np.asarray(body['data']),
+                                           base_values=float(body['base_values']), feature_names=feature_names)
+            with _render_lock:
+                image = plots._render_waterfalls([shap_values], options['feature_aliases'], mode,
+                                                 self.session.image_encoding, max_display=max_display)[0]
+            if isinstance(image, Exception):
+                raise image
+            messages = plots._waterfall_prompt(image, shap_values, options['feature_aliases'],
+                                               options['feature_descriptions'], options['additional_background'],
+                                               options['language'], options['reader'], max_display)
+
+        key = hashlib.sha256(json.dumps([kind, body], sort_keys=True, default=str).encode()).hexdigest()
+        shared = {k: v for k, v in options.items() if k != 'cache'}
+        batch_key = json.dumps([kind, mode, max_display, table_format, precision, feature_names, shared],
+                               sort_keys=True, default=str)
+        return _Request(kind, key, batch_key, options, shap_values, image, messages, mode, max_display, table_format,
+                        precision)
+
+    async def narrate(self, request):
+        """
+        Narrates a prepared request, with the identical requests in flight and the requests batched with it.
+
+        :return: the JSON response of the request
+        """
+        self.stats['requests'] += 1
+        future = self._inflight.get(request.key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(future)
+
+        options = request.options
+        if options['cache'] is not None:
+            _, content = _lookup(options['cache'], options['gpt_model'], request.messages, options['language'],
+                                 options['reader'])
+            if content is not None:
+                self.stats['cached'] += 1
+                return _response(request.kind, _parsers[request.kind][0](content))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._inflight[request.key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(request.key, None))
+
+        batch = self._pending.get(request.batch_key)
+        if batch is None:
+            batch = self._pending[request.batch_key] = []
+            loop.call_later(self.window, self._flush, request.batch_key, batch)
+        batch.append((request, future))
+        if len(batch) >= self.max_batch:
+            self._flush(request.batch_key, batch)
+        return await asyncio.shield(future)
+
+    def _flush(self, batch_key, batch):
+        # Called when the window ends or when the batch is full, whichever comes first
+        if self._pending.get(batch_key) is not batch:
+            return
+        del self._pending[batch_key]
+        task = asyncio.get_running_loop().create_task(self._narrate_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _batch_messages(self, requests):
+        first = requests[0]
+        options = first.options
+        args = (options['feature_aliases'], options['feature_descriptions'], options['additional_background'],
+                options['language'], options['reader'])
+        if first.kind == 'explain':
+            return gpt._batch_messages([r.shap_values for r in requests], *args, first.table_format, first.precision)
+        return plots._waterfall_batch_messages([r.image for r in requests], [r.shap_values for r in requests], *args,
+                                               first.max_display)
+
+    def _store(self, request, result):
+        # Each narration is cached under the key of its own request
+        options = request.options
+        if options['cache'] is not None:
+            options['cache'].set(cache_key(options['gpt_model'], request.messages, options['language'],
+                                           options['reader']),
+                                 json.dumps(_response(request.kind, result), ensure_ascii=False))
+
+    async def _narrate_one(self, request, parse, schema):
+        options = request.options
+        result = await _acomplete(self.session.backend, options['gpt_model'], request.messages, parse, None,
+                                  options['language'], options['reader'], schema)
+        self._store(request, result)
+        return result
+
+    async def _narrate_batch(self, batch):
+        requests = [request for request, _ in batch]
+        first = requests[0]
+        options = first.options
+        parse, schema, parse_batch, batch_schema = _parsers[first.kind]
+        backend = self.session.backend
+
+        results = None
+        if len(requests) > 1:
+            try:
+                self.stats['calls'] += 1
+                results = await _acomplete(backend, options['gpt_model'], self._batch_messages(requests),
+                                           lambda content: parse_batch(content, len(requests)), None,
+                                           options['language'], options['reader'], batch_schema)
+            except (KeyError, TypeError, ValueError):
+                # The answer cannot be split per request
+                results = None
+            except Exception as e:
+                results = [e] * len(requests)
+            else:
+                self.stats['batched'] += len(requests)
+                for request, result in zip(requests, results):
+                    self._store(request, result)
+
+        if results is None:
+            # The cache was already looked up by `narrate`, so the requests are sent without it
+            self.stats['calls'] += len(requests)
+            results = await _gather([lambda r=r: self._narrate_one(r, parse, schema) for r in requests],
+                                    len(requests))
+
+        for (request, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(_response(request.kind, result))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': f"Unknown path {self.path}"})
+        self._send(200, {'status': 'ok', **self.server.narrator.stats})
+
+    def do_POST(self):
+        narrator = self.server.narrator
+        kind = self.path.strip('/')
+        if kind not in kinds:
+            return self._send(404, {'error': f"Unknown path {self.path}"})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            request = narrator.prepare(kind, body)
+        except KeyError as e:
+            return self._send(400, {'error': f"Missing field {e}"})
+        except (TypeError, ValueError) as e:
+            return self._send(400, {'error': str(e)})
+        try:
+            result = narrator.session._run(narrator.narrate(request))
+        except Exception as e:
+            return self._send(502, {'error': f"{type(e).__name__}: {e}"})
+        self._send(200, result)
+
+    def log_message(self, *args):
+        pass
+
+
+class NarrationServer:
+    """
+    A threaded HTTP server in front of `gpt.explain` and `plots.waterfall`, see the module documentation and
+    Narrator. Use `serve_forever` to run it in the calling thread, or `start` to run it in a background thread.
+    """
+
+    def __init__(self, session=None, host='127.0.0.1', port=8000, window=0.02, max_batch=8):
+        """
+        :param session: the `contextualshap.session.Session` of the backend and the default options, None creates one
+            which is closed with the server.
+        :param host: the address the server listens on.
+        :param port: the port the server listens on, 0 picks a free port.
+        :param window: the seconds a request waits for other requests to be batched with.
+        :param max_batch: the maximum number of requests of one call.
+        """
+        self._owns_session = session is None
+        self.session = Session() if session is None else session
+        self.narrator = Narrator(self.session, window, max_batch)
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.narrator = self.narrator
+        self.url = f"http://{host}:{self._server.server_address[1]}"
+
+    def serve_forever(self):
+        """Serves the requests until `close` is called."""
+        self._server.serve_forever()
+
+    def start(self):
+        """Serves the requests in a background thread."""
+        threading.Thread(target=self.serve_forever, name='contextualshap-server', daemon=True).start()
+        return self
+
+    def close(self):
+        """Stops the server, and closes its session if the server created it."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._owns_session:
+            self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs a local contextualshap narration server.")
+    parser.add_argument('--host', default='127.0.0.1', help='the address the server listens on')
+    parser.add_argument('--port', type=int, default=8000, help='the port the server listens on')
+    parser.add_argument('--window', type=float, default=0.02, help='the micro-batching window in seconds')
+    parser.add_argument('--max-batch', type=int, default=8, help='the maximum number of requests of one call')
+    parser.add_argument('--gpt-model', default='gpt-4o', help='the default GPT model')
+    parser.add_argument('--language', default='en', help='the default language code of the narrations')
+    parser.add_argument('--reader', default='general', help="the default reader, 'general' or 'expert'")
+    parser.add_argument('--cache', help='an optional SQLite narration cache file')
+    args = parser.parse_args(argv)
+
+    # The plots are drawn in the request threads, which a GUI backend does not support, and are never shown
+    matplotlib.use('Agg')
+    session = Session(gpt_model=args.gpt_model, language=args.language, reader=args.reader,
+                      cache=None if args.cache is None else SQLiteCache(args.cache))
+    server = NarrationServer(session, args.host, args.port, args.window, args.max_batch)
+    print(f"Serving narrations on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+import asyncio
+import functools
+import threading
+from contextlib import nullcontext
+from . import gpt, plots
+from .cluster import cluster
+from .backends import OpenAIBackend
+from .instrument import current, span
+from .translate import _atranslate, _variants
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(openai_api_key=None):
+    """
+    Returns the process-wide session of an OpenAI API key, creating it on first use. The module-level functions of
+    `contextualshap.gpt` and `contextualshap.plots` use these sessions, so repeated calls reuse warm connections.
+
+    :param openai_api_key: an OpenAI API key, None uses the OPENAI_API_KEY environment variable
+    :return: a Session
+    """
+    with _sessions_lock:
+        session = _sessions.get(openai_api_key)
+        if session is None:
+            session = Session(openai_api_key)
+            _sessions[openai_api_key] = session
+        return session
+
+
+def _or(value, default):
+    return default if value is None else value
+
+
+def _span(name):
+    # A synchronous method running its asynchronous version is recorded once
+    parent = current()
+    return nullcontext() if parent is not None and parent.name == name else span(name)
+
+
+def _traced(name):
+    # Runs a method in a root span, so the hooks can group the stages of each call
+    def decorate(method):
+        if asyncio.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def traced(*args, **kwargs):
+                with _span(name):
+                    return await method(*args, **kwargs)
+        else:
+            @functools.wraps(method)
+            def traced(*args, **kwargs):
+                with _span(name):
+                    return method(*args, **kwargs)
+        return traced
+
+    return decorate
+
+
+class Session:
+    """
+    A long-lived narration session. It holds one backend, by default the OpenAI API with one shared client, so every
+    narration reuses the same HTTP connection pool instead of paying client setup and a new TLS handshake, and the
+    default parameters of the narrations.
+    Parameters left to None in the methods fall back to the session defaults.
+
+    Synchronous batch methods (`explain_many`, `waterfall_many` and `bar_many`) run on an event loop owned by the
+    session, so their connections stay warm between batches as well. Call `close` (or use the session as a context
+    manager) to release the connections.
+    """
+
+    def __init__(self, openai_api_key=None, gpt_model='gpt-4o', language='en', reader='general',
+                 feature_aliases=None, feature_descriptions=None, additional_background=None, cache=None,
+                 image_encoding=None, backend=None, **client_kwargs):
+        """
+        :param openai_api_key: an OpenAI API key, None uses the OPENAI_API_KEY environment variable.
+        :param gpt_model: the default GPT model.
+        :param language: the default language code of the responses.
+        :param reader: the default reader level of comprehension, can be 'general' or 'expert'.
+        :param feature_aliases: a default dictionary mapping of feature name to alias.
+        :param feature_descriptions: a default dictionary mapping of feature name to description.
+        :param additional_background: a default background string to be given to GPT to enhance explanation.
+        :param cache: a default narration cache (see `contextualshap.cache`).
+        :param image_encoding: a default `contextualshap.encoding.ImageEncoding` of the plots sent to GPT.
+        :param backend: the backend of the narrations (see `contextualshap.backends`), None uses an OpenAIBackend.
+        :param client_kwargs: passed to the `OpenAI` and `AsyncOpenAI` clients of the default backend, e.g. `base_url`, `timeout` or `max_retries`.
+        """
+        self.openai_api_key = openai_api_key
+        self.gpt_model = gpt_model
+        self.language = language
+        self.reader = reader
+        self.feature_aliases = feature_aliases
+        self.feature_descriptions = feature_descriptions
+        self.additional_background = additional_background
+        self.cache = cache
+        self.image_encoding = image_encoding
+        self.backend = OpenAIBackend(openai_api_key, **client_kwargs) if backend is None else backend
+        self._loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The shared `OpenAI` client of the OpenAI backend, created on first use."""
+        # A backend wrapping another one, like a RateLimitedBackend, uses the client of the wrapped backend
+        backend = getattr(self.backend, 'backend', self.backend)
+        if not isinstance(backend, OpenAIBackend):
+            raise TypeError("The session backend is not an OpenAIBackend")
+        return backend.client
+
+    def _run(self, coroutine):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='contextualshap-session', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    def close(self):
+        """Closes the backend and the event loop of the session."""
+        with self._lock:
+            loop, self._loop = self._loop, None
+        self.backend.close()
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self.backend.aclose(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _options(self, feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader,
+                 cache):
+        # Only `explain`, `waterfall` and `bar` narrate in many languages or for many readers, they resolve the lists
+        # before getting here
+        if _variants(_or(language, self.language), _or(reader, self.reader)) is not None:
+            raise ValueError("Lists of languages or readers are only supported by explain, waterfall and bar")
+        return dict(feature_aliases=_or(feature_aliases, _or(self.feature_aliases, {})),
+                    feature_descriptions=_or(feature_descriptions, _or(self.feature_descriptions, {})),
+                    additional_background=_or(additional_background, self.additional_background),
+                    gpt_model=_or(gpt_model, self.gpt_model),
+                    language=_or(language, self.language),
+                    reader=_or(reader, self.reader),
+                    cache=_or(cache, self.cache))
+
+    async def _translations(self, result, variants, gpt_model=None, cache=None, concurrency=8):
+        # The narration of the first variant is rewritten for the other ones with text-only requests
+        if result is None:
+            return None
+        pairs, keys = variants
+        rewritten = await _atranslate(self.backend, result, pairs[1:], _or(gpt_model, self.gpt_model),
+                                      _or(cache, self.cache), concurrency)
+        return dict(zip(keys, [result, *rewritten]))
+
+    @_traced('explain')
+    def explain(self, shap_values, feature_aliases=None, feature_descriptions=None, gpt_model=None,
+                additional_background=None, language=None, reader=None, cache=None, token_budget=None, concurrency=8,
+                table_format='markdown', precision=None):
+        """
+        Generates an explanation for each features according to the SHAP values, see `contextualshap.gpt.explain`.
+
+        :return: summary (a string) and a DataFrame containing descriptions for each feature names, or a dictionary
+            mapping each output name to them for multi-output SHAP values
+        """
+        variants = _variants(_or(language, self.language), _or(reader, self.reader))
+        if variants is not None:
+            language, reader = variants[0][0]
+            return self._run(self._translations(
+                self.explain(shap_values, feature_aliases, feature_descriptions, gpt_model, additional_background,
+                             language, reader, cache, token_budget, concurrency, table_format, precision),
+                variants, gpt_model, cache, concurrency))
+
+        if token_budget is not None:
+            return self._run(self.aexplain(shap_values, feature_aliases, feature_descriptions, gpt_model,
+                                           additional_background, language, reader, cache, token_budget, concurrency,
+                                           table_format, precision))
+
+        return gpt._explain(self.backend, shap_values, table_format=table_format, precision=precision, **self._options(
+            feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader, cache))
+
+    @_traced('explain')
+    async def aexplain(self, shap_values, feature_aliases=None, feature_descriptions=None, gpt_model=None,
+                       additional_background=None, language=None, reader=None, cache=None, token_budget=None,
+                       concurrency=8, table_format='markdown', precision=None):
+        """Asynchronous version of `explain`."""
+        variants = _variants(_or(language, self.language), _or(reader, self.reader))
+        if variants is not None:
+            language, reader = variants[0][0]
+            return await self._translations(
+                await self.aexplain(shap_values, feature_aliases, feature_descriptions, gpt_model,
+                                    additional_background, language, reader, cache, token_budget, concurrency,
+                                    table_format, precision),
+                variants, gpt_model, cache, concurrency)
+
+        return await gpt.aexplain(shap_values, client=self.backend, token_budget=token_budget,
+                                  concurrency=concurrency, table_format=table_format, precision=precision,
+                                  **self._options(
+                                      feature_aliases, feature_descriptions, additional_background, gpt_model,
+                                      language, reader, cache))
+
+    @_traced('explain_many')
+    async def aexplain_many(self, shap_values_list, feature_aliases=None, feature_descriptions=None, gpt_model=None,
+                            additional_background=None, language=None, reader=None, concurrency=8, cache=None,
+                            table_format='markdown', precision=None):
+        """Asynchronous version of `explain_many`, to be awaited from a running event loop."""
+        return await gpt._aexplain_many(self.backend, shap_values_list, concurrency=concurrency,
+                                        table_format=table_format, precision=precision, **self._options(
+            feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader, cache))
+
+    @_traced('explain_many')
+    def explain_many(self, shap_values_list, feature_aliases=None, feature_descriptions=None, gpt_model=None,
+                     additional_background=None, language=None, reader=None, concurrency=8, cache=None,
+                     table_format='markdown', precision=None):
+        """
+        Runs `explain` concurrently for many groups of SHAP values, see `contextualshap.gpt.explain_many`.
+
+        :return: a list in the same order as `shap_values_list` of results or exceptions
+        """
+        return self._run(self.aexplain_many(shap_values_list, feature_aliases, feature_descriptions, gpt_model,
+                                            additional_background, language, reader, concurrency, cache, table_format,
+                                            precision))
+
+    @_traced('explain_clusters')
+    async def aexplain_clusters(self, shap_values, n_clusters=8, feature_aliases=None, feature_descriptions=None,
+                                gpt_model=None, additional_background=None, language=None, reader=None, concurrency=8,
+                                cache=None, table_format='markdown', precision=None, seed=0):
+        """Asynchronous version of `explain_clusters`, to be awaited from a running event loop."""
+        clusters = cluster(shap_values, n_clusters, seed)
+        clusters.narrations = await gpt._aexplain_many(
+            self.backend, [shap_values[int(i):int(i) + 1] for i in clusters.representatives], concurrency=concurrency,
+            table_format=table_format, precision=precision, **self._options(
+                feature_aliases, feature_descriptions, additional_background, gpt_model, language, reader, cache))
+        return clusters
+
+    @_traced('explain_clusters')
+    def explain_clusters(self, shap_values, n_clusters=8, feature_aliases=None, feature_descriptions=None,
+                         gpt_model=None, additional_background=None, language=None, reader=None, concurrency=8,
+                         cache=None, table_format='markdown', precision=None, seed=0):
+        """
+        Explains the representative sample of each cluster of similar SHAP values, see
+        `contextualshap.gpt.explain_clusters`.
+
+        :return: a `contextualshap.cluster.Clusters`
+        """
+        return self._run(self.aexplain_clusters(shap_values, n_clusters, feature_aliases, feature_descriptions,
+                                                gpt_model, additional_background, language, reader, concurrency,
+                                                cache, table_format, precision, seed))
+
+    def explain_stream(self, shap_values, feature_aliases=None, feature_descriptions=None, gpt_model=None,
+                       additional_background=None, language=None, reader=None, cache=None, table_format='markdown',
+                       precision=None):
+        """
+        Streams the explanation of the SHAP values, see `contextualshap.gpt.explain_stream`.
+
+        :return: a generator of ('summary', summary string) and ('features', feature dictionary) pairs
+        """
+        return gpt._explain_stream(self.backend, shap_values, table_format=table_format, precision=precision,
+                                   **self._options(feature_aliases, feature_descriptions, additional_background,
+                                                   gpt_model, language, reader, cache))
+
+    def aexplain_stream(self, shap_values, feature_aliases=None, feature_descriptions=None, gpt_model=None,
+                        additional_background=None, language=None, reader=None, cache=None, table_format='markdown',
+                        precision=None):
+        """Asynchronous version of `explain_stream`, an asynchronous iterator to be used from a running event loop."""
+        return gpt.aexplain_stream(shap_values, client=self.backend, table_format=table_format,
+                                   precision=precision, **self._options(
+                                       feature_aliases, feature_descriptions, additional_background, gpt_model,
+                                       language, reader, cache))
+
+    @_traced('waterfall')
+    def waterfall(self, explanation, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                  show=True, explain=True, gpt_model=None, language=None, reader=None, cache=None, mode='image',
+                  image_encoding=None, **kwargs):
+        """
+        Displays a SHAP waterfall plot and explains it, see `contextualshap.plots.waterfall`.
+
+        :return: the explanation string, or None if `explain` is False
+        """
+        variants = _variants(_or(language, self.language), _or(reader, self.reader)) if explain else None
+        if variants is not None:
+            language, reader = variants[0][0]
+            return self._run(self._translations(
+                self.waterfall(explanation, feature_aliases, feature_descriptions, additional_background, show,
+                               explain, gpt_model, language, reader, cache, mode, image_encoding, **kwargs),
+                variants, gpt_model, cache))
+
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        # The backend creates its clients on first use, so plotting works without an API key
+        return plots._waterfall(self.backend, explanation, show=show, explain=explain,
+                                mode=mode, image_encoding=_or(image_encoding, self.image_encoding), **options,
+                                **kwargs)
+
+    def waterfall_stream(self, explanation, feature_aliases=None, feature_descriptions=None,
+                         additional_background=None, show=True, gpt_model=None, language=None, reader=None, cache=None,
+                         mode='image', image_encoding=None, **kwargs):
+        """
+        Displays a SHAP waterfall plot and streams its explanation, see `contextualshap.plots.waterfall_stream`.
+
+        :return: a generator of the explanation text as it is generated
+        """
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        return plots._waterfall_stream(self.backend, explanation, show=show, mode=mode,
+                                       image_encoding=_or(image_encoding, self.image_encoding), **options, **kwargs)
+
+    @_traced('waterfall_many')
+    async def awaterfall_many(self, explanations, feature_aliases=None, feature_descriptions=None,
+                              additional_background=None, gpt_model=None, language=None, reader=None, concurrency=8,
+                              cache=None, mode='image', image_encoding=None, processes=None, **kwargs):
+        """Asynchronous version of `waterfall_many`, to be awaited from a running event loop."""
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        images = plots._render_waterfalls(explanations, options['feature_aliases'], mode,
+                                          _or(image_encoding, self.image_encoding), processes, **kwargs)
+        return await plots._anarrate_waterfalls(self.backend, images, explanations, concurrency=concurrency,
+                                                max_display=kwargs.get('max_display', 10), **options)
+
+    @_traced('waterfall_many')
+    def waterfall_many(self, explanations, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                       gpt_model=None, language=None, reader=None, concurrency=8, cache=None, mode='image',
+                       image_encoding=None, processes=None, **kwargs):
+        """
+        Explains many SHAP waterfall plots concurrently, see `contextualshap.plots.waterfall_many`.
+
+        :return: a list in the same order as `explanations` of explanation strings or exceptions
+        """
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        # Plots are rendered in the calling thread, only the requests run on the session event loop
+        images = plots._render_waterfalls(explanations, options['feature_aliases'], mode,
+                                          _or(image_encoding, self.image_encoding), processes, **kwargs)
+
+        async def narrate():
+            return await plots._anarrate_waterfalls(self.backend, images, explanations,
+                                                    concurrency=concurrency, max_display=kwargs.get('max_display', 10),
+                                                    **options)
+
+        return self._run(narrate())
+
+    @_traced('bar')
+    def bar(self, shap_values, feature_aliases=None, feature_descriptions=None, additional_background=None,
+            explain=True, show=True, gpt_model=None, language=None, reader=None, cache=None, mode='image',
+            image_encoding=None, **kwargs):
+        """
+        Displays a SHAP bar plot and explains it, see `contextualshap.plots.bar`.
+
+        :return: the explanation string, or None if `explain` is False
+        """
+        variants = _variants(_or(language, self.language), _or(reader, self.reader)) if explain else None
+        if variants is not None:
+            language, reader = variants[0][0]
+            return self._run(self._translations(
+                self.bar(shap_values, feature_aliases, feature_descriptions, additional_background, explain, show,
+                         gpt_model, language, reader, cache, mode, image_encoding, **kwargs),
+                variants, gpt_model, cache))
+
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        # The backend creates its clients on first use, so plotting works without an API key
+        return plots._bar(self.backend, shap_values, explain=explain, show=show, mode=mode,
+                          image_encoding=_or(image_encoding, self.image_encoding), **options, **kwargs)
+
+    def bar_stream(self, shap_values, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                   show=True, gpt_model=None, language=None, reader=None, cache=None, mode='image', image_encoding=None,
+                   **kwargs):
+        """
+        Displays a SHAP bar plot and streams its explanation, see `contextualshap.plots.bar_stream`.
+
+        :return: a generator of the explanation text as it is generated
+        """
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        return plots._bar_stream(self.backend, shap_values, show=show, mode=mode,
+                                 image_encoding=_or(image_encoding, self.image_encoding), **options, **kwargs)
+
+    @_traced('bar_many')
+    async def abar_many(self, shap_values_list, feature_aliases=None, feature_descriptions=None,
+                        additional_background=None, gpt_model=None, language=None, reader=None, concurrency=8,
+                        cache=None, mode='image', image_encoding=None, **kwargs):
+        """Asynchronous version of `bar_many`, to be awaited from a running event loop."""
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        rendered = plots._render_bars(shap_values_list, options['feature_aliases'], mode,
+                                      _or(image_encoding, self.image_encoding), **kwargs)
+        return await plots._anarrate_bars(self.backend, rendered, concurrency=concurrency,
+                                          max_display=kwargs.get('max_display', 10), **options)
+
+    @_traced('bar_many')
+    def bar_many(self, shap_values_list, feature_aliases=None, feature_descriptions=None, additional_background=None,
+                 gpt_model=None, language=None, reader=None, concurrency=8, cache=None, mode='image',
+                 image_encoding=None, **kwargs):
+        """
+        Explains many SHAP bar plots concurrently, see `contextualshap.plots.bar_many`.
+
+        :return: a list in the same order as `shap_values_list` of explanation strings or exceptions
+        """
+        options = self._options(feature_aliases, feature_descriptions, additional_background, gpt_model, language,
+                                reader, cache)
+        # Plots are rendered in the calling thread, only the requests run on the session event loop
+        rendered = plots._render_bars(shap_values_list, options['feature_aliases'], mode,
+                                      _or(image_encoding, self.image_encoding), **kwargs)
+
+        async def narrate():
+            return await plots._anarrate_bars(self.backend, rendered, concurrency=concurrency,
+                                              max_display=kwargs.get('max_display', 10), **options)
+
+        return self._run(narrate())
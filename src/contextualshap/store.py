@@ -0,0 +1,257 @@
+import json
+import sqlite3
+import threading
+import time
+import numpy as np
+from . import session as sessions
+from .common import _LazyModule, _output_names
+from .instrument import span
+
+shap = _LazyModule('shap')
+pd = _LazyModule('pandas')
+
+# The statistics kept for each feature: the mean and the mean absolute SHAP value, then the quantiles
+quantiles = (0.1, 0.5, 0.9)
+
+
+def statistics(values):
+    """
+    Summarizes the SHAP values of each feature.
+
+    :param values: a 2D array of SHAP values, one row per sample.
+    :return: a (feature, statistic) array of the mean, the mean absolute value and the `quantiles` of each feature
+    """
+    values = np.asarray(values, dtype=float)
+    return np.column_stack([values.mean(axis=0), np.abs(values).mean(axis=0),
+                            np.quantile(values, quantiles, axis=0).T])
+
+
+def shift(previous, current):
+    """
+    Measures how much the SHAP values of each feature moved: the largest change of its statistics, relative to its
+    previous mean absolute SHAP value. Features whose SHAP values are much smaller than the others are measured
+    against 1% of the average feature instead, so their noise does not count as a shift.
+
+    :param previous: the (feature, statistic) array the narrations were written from, see `statistics`.
+    :param current: the (feature, statistic) array of the new SHAP values.
+    :return: the shift of each feature
+    """
+    previous = np.asarray(previous, dtype=float)
+    scale = np.maximum(previous[:, 1], max(0.01 * previous[:, 1].mean(), 1e-12))
+    return np.abs(np.asarray(current, dtype=float) - previous).max(axis=1) / scale
+
+
+def _values(shap_values):
+    if isinstance(shap_values, shap.Explanation):
+        if _output_names(shap_values, 2) is not None:
+            raise ValueError("The narration store is not supported for multi-output SHAP values")
+        return np.asarray(shap_values.values, dtype=float), np.asarray(shap_values.data), \
+            list(shap_values.feature_names)
+    return np.stack([np.asarray(sv.values, dtype=float) for sv in shap_values]), \
+        np.stack([np.asarray(sv.data) for sv in shap_values]), list(shap_values[0].feature_names)
+
+
+class NarrationStore:
+    """
+    A persistent store of narrations in a SQLite database, indexed by model version, cohort, language, reader and
+    feature. It keeps the explanation of each feature with the statistics of the SHAP values it was written from (see
+    `statistics`), so after a retrain or a data refresh only the features whose SHAP values shifted beyond `threshold`
+    (see `shift`) are sent to GPT, and the others are merged from the previous narration.
+
+    The statistics of a feature that did not shift are carried over unchanged, so a slow drift is still caught once it
+    adds up to the threshold. `changed` holds the features narrated by the last call.
+    """
+
+    def __init__(self, path, threshold=0.1):
+        """
+        :param path: the SQLite database file.
+        :param threshold: the shift of a feature above which it is narrated again.
+        """
+        self.path = path
+        self.threshold = threshold
+        self.changed = []
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS features '
+                         '(version TEXT NOT NULL, cohort TEXT NOT NULL, language TEXT NOT NULL, reader TEXT NOT NULL, '
+                         'feature TEXT NOT NULL, statistics TEXT NOT NULL, description TEXT, explanation TEXT, '
+                         'PRIMARY KEY (version, cohort, language, reader, feature))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS narrations '
+                         '(version TEXT NOT NULL, cohort TEXT NOT NULL, kind TEXT NOT NULL, language TEXT NOT NULL, '
+                         'reader TEXT NOT NULL, statistics TEXT, narration TEXT NOT NULL, updated REAL NOT NULL, '
+                         'PRIMARY KEY (version, cohort, kind, language, reader))')
+        self._db.commit()
+
+    def _latest(self, cohort, kind, language, reader, previous):
+        # The version narrated last, or the given previous version
+        with self._lock:
+            if previous is None:
+                row = self._db.execute('SELECT version FROM narrations WHERE cohort = ? AND kind = ? AND language = ? '
+                                       'AND reader = ? ORDER BY updated DESC LIMIT 1',
+                                       (cohort, kind, language, reader)).fetchone()
+                if row is None:
+                    return None, None, None
+                previous = row[0]
+            row = self._db.execute('SELECT statistics, narration FROM narrations WHERE version = ? AND cohort = ? '
+                                   'AND kind = ? AND language = ? AND reader = ?',
+                                   (previous, cohort, kind, language, reader)).fetchone()
+        return (previous, None, None) if row is None else (previous, *row)
+
+    def versions(self, cohort=''):
+        """
+        :param cohort: the cohort of the narrations.
+        :return: the versions of the narrations of a cohort, the latest last
+        """
+        with self._lock:
+            return [r[0] for r in self._db.execute('SELECT version FROM narrations WHERE cohort = ? '
+                                                   'GROUP BY version ORDER BY MAX(updated)', (cohort,))]
+
+    def features(self, version, cohort='', language='en', reader='general'):
+        """
+        :param version: the model version of the narration.
+        :param cohort: the cohort of the narration.
+        :param language: the language of the narration.
+        :param reader: the reader level of the narration.
+        :return: a dictionary mapping each stored feature of a narration to its statistics, description and explanation
+        """
+        with self._lock:
+            rows = self._db.execute('SELECT feature, statistics, description, explanation FROM features WHERE '
+                                    'version = ? AND cohort = ? AND language = ? AND reader = ?',
+                                    (version, cohort, language, reader)).fetchall()
+        return {f: (json.loads(s), d, e) for f, s, d, e in rows}
+
+    def _changed(self, feature_names, current, previous):
+        # The features without a previous narration, or whose SHAP values shifted beyond the threshold
+        stored = [f for f in feature_names if f in previous]
+        shifted = set()
+        if stored:
+            index = [feature_names.index(f) for f in stored]
+            shifts = shift([previous[f][0] for f in stored], current[index])
+            shifted = {f for f, s in zip(stored, shifts) if s > self.threshold}
+        return [f for f in feature_names if f not in previous or f in shifted]
+
+    def _save(self, version, cohort, kind, language, reader, narration, stats=None, features=()):
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO features (version, cohort, language, reader, feature, '
+                                 'statistics, description, explanation) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 [(version, cohort, language, reader, f, json.dumps(s), d, e)
+                                  for f, s, d, e in features])
+            self._db.execute('INSERT OR REPLACE INTO narrations (version, cohort, kind, language, reader, statistics, '
+                             'narration, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (version, cohort, kind, language, reader,
+                              None if stats is None else json.dumps(stats), narration, time.time()))
+            self._db.commit()
+
+    def explain(self, shap_values, version, cohort='', previous=None, session=None, feature_aliases=None,
+                feature_descriptions=None, additional_background=None, gpt_model=None, language=None, reader=None,
+                **kwargs):
+        """
+        Explains the SHAP values of a model version like `contextualshap.gpt.explain`, sending only the features whose
+        SHAP values shifted since the previous narration, and merging the explanations of the other features from it.
+
+        :param shap_values: the SHAP values of a single output model, a shap.Explanation or a list of them.
+        :param version: the model version of the SHAP values.
+        :param cohort: an optional cohort of the SHAP values, narrations of different cohorts are kept apart.
+        :param previous: the version to compare with, None uses the latest narrated version of the cohort.
+        :param session: the `contextualshap.Session` of the requests, None uses the shared session.
+        :param feature_aliases: an optional dictionary containing alias per feature.
+        :param feature_descriptions: an optional dictionary containing description per feature.
+        :param additional_background: additional narration containing background story of the model.
+        :param gpt_model: the OpenAI GPT model.
+        :param language: the language of the response.
+        :param reader: the reader level of comprehension, can be 'general' or 'expert'.
+        :param kwargs: passed to `contextualshap.Session.explain`, e.g. `table_format` or `precision`.
+        :return: summary (a string) and a DataFrame containing descriptions for each feature names
+        """
+        session = sessions.get_session() if session is None else session
+        language = sessions._or(language, session.language)
+        reader = sessions._or(reader, session.reader)
+        values, data, feature_names = _values(shap_values)
+        current = statistics(values)
+
+        previous, _, summary = self._latest(cohort, 'explain', language, reader, previous)
+        stored = {} if previous is None else self.features(previous, cohort, language, reader)
+        with span('store', features=len(feature_names)) as s:
+            changed = self._changed(feature_names, current, stored)
+            s.set(changed=len(changed))
+        self.changed = changed
+
+        narrated = {}
+        if changed or summary is None:
+            index = [feature_names.index(f) for f in changed] or list(range(len(feature_names)))
+            subset = shap.Explanation(values=values[:, index], data=data[:, index],
+                                      feature_names=[feature_names[i] for i in index])
+            background = additional_background
+            if summary is not None:
+                # The summary covers every feature, so it is written knowing the previous one
+                note = (f'Only the features that changed since the previous version are given. The summary of the '
+                        f'previous version was: {summary}')
+                background = note if background is None else f'{background} {note}'
+            summary, features = session.explain(subset, feature_aliases, feature_descriptions, gpt_model, background,
+                                                language, reader, **kwargs)
+            aliases = sessions._or(feature_aliases, sessions._or(session.feature_aliases, {}))
+            names = {str(aliases.get(f, f)): f for f in subset.feature_names}
+            names.update({f: f for f in subset.feature_names})
+            for row in features.to_dict('records'):
+                name = names.get(str(row.get('feature_name')))
+                if name is not None:
+                    narrated[name] = (current[feature_names.index(name)].tolist(), row.get('description'),
+                                      row.get('explanation'))
+
+        # The features not narrated again keep their previous explanation and statistics
+        merged = [(f, *narrated.get(f, stored.get(f, (None, None, None)))) for f in feature_names]
+        merged = [m for m in merged if m[1] is not None]
+        self._save(version, cohort, 'explain', language, reader, summary, features=merged)
+        return summary, pd.DataFrame([{'feature_name': f, 'description': d, 'explanation': e}
+                                      for f, _, d, e in merged])
+
+    def bar(self, shap_values, version, cohort='', previous=None, session=None, show=True, gpt_model=None,
+            language=None, reader=None, **kwargs):
+        """
+        Displays the bar plot of the SHAP values of a model version like `contextualshap.plots.bar`, and explains it
+        only when the SHAP values of a feature shifted since the previous narration, otherwise the previous narration
+        is returned without calling the API.
+
+        :param shap_values: the SHAP values of a single output model, a shap.Explanation.
+        :param version: the model version of the SHAP values.
+        :param cohort: an optional cohort of the SHAP values, narrations of different cohorts are kept apart.
+        :param previous: the version to compare with, None uses the latest narrated version of the cohort.
+        :param session: the `contextualshap.Session` of the requests, None uses the shared session.
+        :param show: setting this to false will not call plot.show to show the plot.
+        :param gpt_model: a GPT model to use.
+        :param language: a language code to use.
+        :param reader: the reader level of comprehension, can be 'general' or 'expert'.
+        :param kwargs: passed to `contextualshap.Session.bar`, e.g. `feature_aliases`, `mode` or `max_display`.
+        :return: the explanation string
+        """
+        session = sessions.get_session() if session is None else session
+        language = sessions._or(language, session.language)
+        reader = sessions._or(reader, session.reader)
+        values, _, feature_names = _values(shap_values)
+        current = statistics(values)
+
+        previous, stored, narration = self._latest(cohort, 'bar', language, reader, previous)
+        stored = {} if stored is None else json.loads(stored)
+        with span('store', features=len(feature_names)) as s:
+            changed = self._changed(feature_names, current, {f: (v,) for f, v in stored.items()})
+            s.set(changed=len(changed))
+        self.changed = changed
+
+        if narration is not None and not changed:
+            session.bar(shap_values, explain=False, show=show, **kwargs)
+        else:
+            narration = session.bar(shap_values, explain=True, show=show, gpt_model=gpt_model, language=language,
+                                    reader=reader, **kwargs)
+            stored = {f: current[i].tolist() for i, f in enumerate(feature_names)}
+        self._save(version, cohort, 'bar', language, reader, narration, stored)
+        return narration
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
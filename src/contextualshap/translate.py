@@ -0,0 +1,73 @@
+import json
+from .common import _LazyModule, _acomplete, _gather, _outputs_schema, _validate, explanation_schema, features_schema, output_explanation_schema, output_features_schema
+from .instrument import span
+from .prompts import prompt_template
+
+pd = _LazyModule('pandas')
+
+
+def _variants(language, reader):
+    # The (language, reader) pairs of a list of languages and/or readers, and the key of each pair in the returned
+    # mapping: the language, the reader, or both when both are lists
+    many_languages = isinstance(language, (list, tuple))
+    many_readers = isinstance(reader, (list, tuple))
+    if not many_languages and not many_readers:
+        return None
+    languages = list(language) if many_languages else [language]
+    readers = list(reader) if many_readers else [reader]
+    if len(languages) == 0 or len(readers) == 0:
+        raise ValueError("At least one language and one reader are needed")
+    pairs = [(l, r) for l in languages for r in readers]
+    for l, r in pairs:
+        _validate(l, r)
+    if many_languages and many_readers:
+        keys = pairs
+    else:
+        keys = languages if many_languages else readers
+    return pairs, keys
+
+
+def _content(result, nested=False):
+    # The JSON response a narration was parsed from, the outputs of a multi-output narration are nested in `outputs`
+    if isinstance(result, dict):
+        return {'outputs': [_content(r, True) for r in result.values()]}
+    if isinstance(result, tuple):
+        return {'summary': result[0], 'features': result[1].to_dict('records')}
+    return result if nested else {'explanation': result}
+
+
+def _schema(result):
+    if isinstance(result, dict):
+        schema = output_explanation_schema if isinstance(next(iter(result.values()), ''), str) \
+            else output_features_schema
+        return _outputs_schema(schema, result)
+    return features_schema if isinstance(result, tuple) else explanation_schema
+
+
+def _result(response, like):
+    # Parses a rewritten narration into the same shape as the narration it was rewritten from
+    if isinstance(like, dict):
+        outputs = response['outputs']
+        if len(outputs) != len(like):
+            raise ValueError(f"Expected {len(like)} outputs, got {len(outputs)}")
+        return {name: _result(o, l) for (name, l), o in zip(like.items(), outputs)}
+    if isinstance(like, tuple):
+        return response['summary'], pd.DataFrame(response['features'])
+    return response['explanation'] if isinstance(response, dict) else response
+
+
+def _messages(result, language, reader):
+    template = prompt_template('translate', (), language=language, reader=reader)
+    return template.messages(json.dumps(_content(result), ensure_ascii=False))
+
+
+async def _atranslate(backend, result, pairs, gpt_model='gpt-4o', cache=None, concurrency=8):
+    # Every variant is a text-only request rewriting the narration, without the plot image or the SHAP values
+    schema = _schema(result)
+
+    async def rewrite(language, reader):
+        return await _acomplete(backend, gpt_model, _messages(result, language, reader),
+                                lambda content: _result(json.loads(content), result), cache, language, reader, schema)
+
+    with span('translate', variants=len(pairs)):
+        return await _gather([lambda p=p: rewrite(*p) for p in pairs], concurrency)
@@ -0,0 +1,56 @@
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import shap
+
+
+def random_shap_values(n_samples=4, feature_names=('a', 'b', 'c'), outputs=None, output_names=None):
+    # Normally distributed SHAP values and inputs, with one more axis for the outputs of a multi-output model
+    rng = np.random.default_rng(0)
+    shape = (n_samples, len(feature_names)) if outputs is None else (n_samples, len(feature_names), outputs)
+    return shap.Explanation(values=rng.normal(size=shape), base_values=np.zeros(shape[:1] + shape[2:]),
+                            data=rng.normal(size=shape[:2]), feature_names=list(feature_names),
+                            output_names=output_names)
+
+
+class FakeOpenAI:
+    # An OpenAI client answering every chat completion with `content`, streamed in small chunks when asked to. It
+    # keeps the messages and the response format of every request, and its responses have `usage`.
+    usage = None
+
+    def __init__(self, api_key=None, **kwargs):
+        self.messages = []
+        self.response_formats = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    @property
+    def calls(self):
+        return len(self.messages)
+
+    @property
+    def prompts(self):
+        return [m[0]['content'] for m in self.messages]
+
+    def content(self, messages, schema):
+        # An explanation of every feature the schema allows, or of the plot
+        properties = {} if schema is None else schema['properties']
+        if 'features' not in properties:
+            return json.dumps({'explanation': 'explanation'})
+        feature_names = properties['features']['items']['properties']['feature_name'].get('enum', [])
+        return json.dumps({'summary': 'summary', 'features': [
+            {'feature_name': f, 'description': '', 'explanation': f} for f in feature_names]})
+
+    def create(self, model, messages, stream=False, response_format=None):
+        self.messages.append(messages)
+        self.response_formats.append(response_format)
+        content = self.content(messages, None if response_format is None else response_format['json_schema']['schema'])
+        if stream:
+            # The first chunk has no choices, like the usage chunks of the API
+            return iter([SimpleNamespace(choices=[])] +
+                        [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=content[i:i + 5]))])
+                         for i in range(0, len(content), 5)])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=self.usage)
+
+    def close(self):
+        pass
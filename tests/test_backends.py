@@ -0,0 +1,58 @@
+import asyncio
+import json
+import time
+import unittest
+
+import matplotlib.pyplot as plt
+from src.contextualshap import gpt, session
+from src.contextualshap.backends import ChatResult, StubBackend, StubError
+from src.contextualshap.common import explanation_schema, features_schema
+from tests.helpers import random_shap_values
+
+
+class BackendsTestCase(unittest.TestCase):
+    def test_stub_schema(self):
+        backend = StubBackend(text_length=10)
+        result = backend.complete('gpt-4o', [{'role': 'user', 'content': 'prompt'}], features_schema)
+        self.assertIsInstance(result, ChatResult)
+        response = json.loads(result.content)
+        self.assertEqual(response['summary'], 'lorem ipsu')
+        self.assertEqual(set(response['features'][0]), {'feature_name', 'description', 'explanation'})
+        self.assertGreater(result.usage['prompt_tokens'], 0)
+        chunks = list(backend.stream('gpt-4o', [], explanation_schema))
+        self.assertEqual(json.loads(''.join(chunks)), {'explanation': 'lorem ipsu'})
+
+    def test_stub_session(self):
+        with session.Session(backend=StubBackend()) as s:
+            summary, features = s.explain(random_shap_values())
+            self.assertEqual(list(features.columns), ['feature_name', 'description', 'explanation'])
+            self.assertEqual(len(s.waterfall(random_shap_values()[0], show=False, mode='numeric')), 200)
+            events = list(s.explain_stream(random_shap_values()))
+            # One explanation per feature, as the schema restricts the feature names
+            self.assertEqual([key for key, _ in events], ['summary', 'features', 'features', 'features'])
+
+    def test_stub_multi_output(self):
+        shap_values = random_shap_values(outputs=2, output_names=['x', 'y'])
+        with session.Session(backend=StubBackend(text_length=5)) as s:
+            results = s.explain(shap_values)
+            self.assertEqual(list(results), ['x', 'y'])
+            self.assertEqual(results['y'][0], 'lorem')
+            self.assertEqual(s.waterfall(shap_values[0], show=False, mode='numeric'), {'x': 'lorem', 'y': 'lorem'})
+            self.assertEqual(s.bar(shap_values, show=False, mode='numeric'), {'x': 'lorem', 'y': 'lorem'})
+            plt.close('all')
+
+    def test_stub_latency_failures(self):
+        backend = StubBackend(latency=0.05, failure_rate=0.5, seed=0)
+        with session.Session(backend=backend) as s:
+            start = time.perf_counter()
+            results = s.explain_many([random_shap_values()] * 20, concurrency=20)
+            elapsed = time.perf_counter() - start
+        failures = sum(isinstance(r, StubError) for r in results)
+        self.assertEqual(backend.calls, 20)
+        self.assertTrue(0 < failures < 20)
+        # The requests wait concurrently
+        self.assertLess(elapsed, 0.5)
+
+    def test_aexplain_backend(self):
+        summary, _ = asyncio.run(gpt.aexplain(random_shap_values(), {}, {}, StubBackend(text_length=5)))
+        self.assertEqual(summary, 'lorem')
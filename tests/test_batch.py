@@ -0,0 +1,135 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from src.contextualshap import backends, session
+from src.contextualshap.batch import BatchJob, ingest
+from src.contextualshap.cache import MemoryCache
+from tests.helpers import FakeOpenAI, random_shap_values
+
+
+def _answer(request):
+    kind = request['custom_id'].split('-')[0]
+    if kind == 'explain':
+        content = {'summary': 'summary', 'features': [{'feature_name': 'a', 'description': '', 'explanation': ''}]}
+    else:
+        content = {'explanation': kind}
+    body = {'choices': [{'message': {'role': 'assistant', 'content': json.dumps(content)}}]}
+    return {'id': 'response', 'custom_id': request['custom_id'], 'response': {'status_code': 200, 'body': body},
+            'error': None}
+
+
+class FakeBatchOpenAI(FakeOpenAI):
+    def __init__(self, api_key=None, **kwargs):
+        super().__init__(api_key, **kwargs)
+        self.files = SimpleNamespace(create=self.create_file, content=self.content)
+        self.batches = SimpleNamespace(create=self.create_batch, retrieve=self.retrieve)
+        self.polls = 0
+
+    def create_file(self, file, purpose):
+        self.requests = [json.loads(line) for line in file.read().decode().splitlines()]
+        return SimpleNamespace(id='file-input')
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        return SimpleNamespace(id='batch')
+
+    def retrieve(self, batch_id):
+        self.polls += 1
+        status = 'completed' if self.polls > 1 else 'in_progress'
+        return SimpleNamespace(status=status, output_file_id='file-output', error_file_id=None)
+
+    def content(self, file_id):
+        return SimpleNamespace(text=''.join(json.dumps(_answer(r)) + '\n' for r in self.requests))
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.shap_values = random_shap_values()
+
+    def test_write_ingest(self):
+        with tempfile.TemporaryDirectory() as d, session.Session(language='id') as s:
+            job = BatchJob(s)
+            first = job.add_explain(self.shap_values)
+            self.assertEqual(job.add_explain(self.shap_values), first)
+            job.add_waterfall(self.shap_values[0], mode='numeric')
+            job.add_bar(self.shap_values)
+            self.assertEqual(len(job), 4)
+
+            input_path = os.path.join(d, 'input.jsonl')
+            self.assertEqual(job.write(input_path), 3)
+            with open(input_path) as f:
+                requests = [json.loads(line) for line in f]
+            self.assertEqual([r['custom_id'] for r in requests], list(dict.fromkeys(job.custom_ids)))
+            self.assertEqual(requests[0]['url'], '/v1/chat/completions')
+            self.assertIn('Indonesian', requests[0]['body']['messages'][0]['content'])
+            response_format = requests[0]['body']['response_format']
+            self.assertTrue(response_format['json_schema']['strict'])
+            self.assertEqual(response_format['json_schema']['schema']['properties']['features']['items']
+                             ['properties']['feature_name']['enum'], ['a', 'b', 'c'])
+            self.assertIn('explanation', requests[1]['body']['response_format']['json_schema']['schema']['required'])
+            self.assertEqual(BatchJob(s).add_explain(self.shap_values), first)
+
+            output_path = os.path.join(d, 'output.jsonl')
+            failed = dict(_answer(requests[2]), response={'status_code': 500, 'body': {'error': 'server'}})
+            with open(output_path, 'w') as f:
+                f.write(json.dumps(_answer(requests[0])) + '\n')
+                f.write(json.dumps(_answer(requests[1])) + '\n')
+                f.write(json.dumps(failed) + '\n')
+
+            cache = MemoryCache()
+            results = job.ingest(output_path, cache)
+            self.assertEqual(results[0][0], 'summary')
+            self.assertEqual(list(results[1][1]['feature_name']), ['a'])
+            self.assertEqual(results[2], 'waterfall')
+            self.assertIsInstance(results[3], RuntimeError)
+            self.assertEqual(len(cache), 2)
+
+    def test_run(self):
+        client = FakeBatchOpenAI()
+        with tempfile.TemporaryDirectory() as d, mock.patch.object(backends, 'OpenAI', return_value=client), \
+                session.Session() as s:
+            job = BatchJob(s)
+            job.add_explain(self.shap_values)
+            job.add_bar(self.shap_values, mode='numeric')
+            results = job.run(os.path.join(d, 'input.jsonl'), os.path.join(d, 'output.jsonl'), poll_interval=0)
+
+        self.assertEqual(client.polls, 2)
+        self.assertEqual(results[0][0], 'summary')
+        self.assertEqual(results[1], 'bar')
+
+    def test_multi_output(self):
+        shap_values = random_shap_values(outputs=2)
+        with session.Session() as s:
+            job = BatchJob(s)
+            with self.assertRaises(ValueError):
+                job.add_explain(shap_values)
+            with self.assertRaises(ValueError):
+                job.add_waterfall(shap_values[0], mode='numeric')
+            with self.assertRaises(ValueError):
+                job.add_bar(shap_values, mode='numeric')
+        self.assertEqual(len(job), 0)
+
+    def test_ingest_repair(self):
+        def line(custom_id, content):
+            body = {'choices': [{'message': {'role': 'assistant', 'content': content}}]}
+            return json.dumps({'custom_id': custom_id, 'response': {'status_code': 200, 'body': body}, 'error': None})
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'output.jsonl')
+            with open(path, 'w') as f:
+                f.write(line('waterfall-1', '```json\n{"explanation": "fenced"}\n```') + '\n')
+                f.write(line('explain-2', '{"summary": "cut", "features": [{"feature_name": "a", "descr') + '\n')
+                f.write(line('bar-3', 'Sorry, I cannot help with that.') + '\n')
+            cache = MemoryCache()
+            results = ingest(path, cache)
+
+        self.assertEqual(results['waterfall-1'], 'fenced')
+        self.assertEqual(results['explain-2'][0], 'cut')
+        self.assertEqual(len(results['explain-2'][1]), 0)
+        self.assertIsInstance(results['bar-3'], ValueError)
+        # The repaired content is cached, the unrecoverable one is not
+        self.assertEqual(json.loads(cache.get('1')), {'explanation': 'fenced'})
+        self.assertEqual(len(cache), 2)
@@ -0,0 +1,31 @@
+import unittest
+
+from benchmarks import bench_narration
+from src.contextualshap import instrument
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    def test_run_compare(self):
+        results = bench_narration.run(samples=[2], features=[8], cohorts=[1, 2], rounds=1)
+        names = {r['benchmark'] for r in results}
+        self.assertTrue({'explain.end_to_end', 'waterfall.savefig', 'waterfall.encode', 'bar.alias',
+                         'bar.end_to_end'} <= names)
+        self.assertEqual(len([r for r in results if r['benchmark'] == 'bar.draw']), 2)
+
+        slower = [dict(r, median=r['median'] * 2) for r in results]
+        self.assertEqual(bench_narration.compare(results, results), [])
+        self.assertEqual(len(bench_narration.compare(slower, results)), len(results))
+
+    def test_fake_server_answers_every_feature(self):
+        shap_values = bench_narration._dataset(2, 8)
+        server = bench_narration.FakeServer()
+        try:
+            with bench_narration.Session(openai_api_key='benchmark', base_url=server.base_url, max_retries=0) as s, \
+                    instrument.Recorder() as recorder:
+                summary, features = s.explain(shap_values)
+        finally:
+            server.close()
+        self.assertEqual(list(features['feature_name']), list(shap_values.feature_names))
+        # The benchmark measures the normal path, without a follow-up request
+        self.assertEqual(recorder.summary()['request']['count'], 1)
+        self.assertNotIn('follow_up', recorder.summary())
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+import shap
+from src.contextualshap import backends, session
+from src.contextualshap.cache import MemoryCache, SQLiteCache, TieredCache, cache_key
+from tests.helpers import FakeOpenAI
+
+
+
+class CacheTestCase(unittest.TestCase):
+    def test_memory_cache_lru(self):
+        cache = MemoryCache(max_entries=2)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        self.assertEqual(cache.get('a'), '1')
+        cache.set('c', '3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), '3')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_sqlite_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as d:
+            cache = SQLiteCache(os.path.join(d, 'cache.db'), max_entries=2)
+            cache.set('a', '1')
+            time.sleep(0.01)
+            cache.set('b', '2')
+            time.sleep(0.01)
+            cache.get('a')
+            cache.set('c', '3')
+            self.assertEqual(len(cache), 2)
+            self.assertIsNone(cache.get('b'))
+            cache.close()
+
+            cache = SQLiteCache(os.path.join(d, 'cache.db'), ttl=0)
+            time.sleep(0.01)
+            self.assertIsNone(cache.get('a'))
+            cache.close()
+
+    def test_tiered_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            disk = SQLiteCache(os.path.join(d, 'cache.db'))
+            disk.set('a', '1')
+            cache = TieredCache(MemoryCache(), disk)
+            self.assertEqual(cache.get('a'), '1')
+            self.assertEqual(cache.memory.get('a'), '1')
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            disk.close()
+
+            # The memory tier expires a narration when the disk tier does, counting from its creation on disk
+            disk = SQLiteCache(os.path.join(d, 'expiring.db'), ttl=0.4)
+            disk.set('a', '1')
+            time.sleep(0.2)
+            cache = TieredCache(MemoryCache(), disk)
+            self.assertEqual(cache.get('a'), '1')
+            cache.set('b', '2')
+            time.sleep(0.3)
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('b'), '2')
+            time.sleep(0.2)
+            self.assertIsNone(cache.get('b'))
+            self.assertEqual(len(cache.memory), 0)
+            disk.close()
+
+    def test_memory_cache_ttl(self):
+        cache = MemoryCache(ttl=0.05)
+        cache.set('a', '1')
+        self.assertEqual(cache.get('a'), '1')
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_cache_key(self):
+        messages = [{'role': 'user', 'content': 'prompt'}]
+        self.assertEqual(cache_key('gpt-4o', messages, 'en', 'general'), cache_key('gpt-4o', messages, 'en', 'general'))
+        self.assertNotEqual(cache_key('gpt-4o', messages, 'en', 'general'), cache_key('gpt-4o', messages, 'id', 'general'))
+
+    def test_explain_cache(self):
+        shap_values = shap.Explanation(values=np.ones((2, 1)), data=np.ones((2, 1)), feature_names=['a'])
+        cache = MemoryCache()
+        client = FakeOpenAI()
+        with mock.patch.object(backends, 'OpenAI', return_value=client), session.Session(cache=cache) as s:
+            first = s.explain(shap_values)
+            second = s.explain(shap_values)
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(first[0], second[0])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
@@ -0,0 +1,61 @@
+import unittest
+
+import numpy as np
+import shap
+from src.contextualshap import cluster, session
+from src.contextualshap.backends import StubBackend
+
+
+def _shap_values(n_per_cluster=20, n_features=5):
+    # Three well separated groups of SHAP values
+    rng = np.random.default_rng(0)
+    centers = np.array([[3, 0, 0, 0, -1], [0, -3, 1, 0, 0], [0, 0, 0, 4, 2]], dtype=float)
+    values = np.concatenate([c + rng.normal(scale=0.1, size=(n_per_cluster, n_features)) for c in centers])
+    return shap.Explanation(values=values, base_values=np.zeros(len(values)), data=rng.normal(size=values.shape),
+                            feature_names=[f'f{i}' for i in range(n_features)])
+
+
+class ClusterTestCase(unittest.TestCase):
+    def test_kmeans(self):
+        values = _shap_values().values
+        labels, centers = cluster.kmeans(values, 3)
+        self.assertEqual(centers.shape, (3, 5))
+        for group in range(3):
+            self.assertEqual(len(set(labels[group * 20:(group + 1) * 20])), 1)
+        self.assertEqual(len(set(labels)), 3)
+
+        # Fewer distinct rows than clusters
+        labels, centers = cluster.kmeans(np.ones((10, 2)), 4)
+        self.assertEqual(len(centers), 1)
+        self.assertTrue((labels == 0).all())
+
+    def test_cluster(self):
+        shap_values = _shap_values()
+        clusters = cluster.cluster(shap_values, 3)
+        self.assertEqual(len(clusters), 60)
+        self.assertEqual(len(clusters.representatives), 3)
+        for k, r in enumerate(clusters.representatives):
+            self.assertEqual(clusters.labels[r], k)
+            self.assertEqual(clusters.similarity[r], 1)
+        self.assertGreater(clusters.similarity.min(), 0.99)
+
+        # A single cluster describes the samples poorly
+        self.assertLess(cluster.cluster(shap_values, 1).similarity.min(), 0.5)
+
+        multi_output = shap.Explanation(values=np.zeros((4, 5, 2)), data=np.zeros((4, 5)))
+        with self.assertRaises(ValueError):
+            cluster.cluster(multi_output, 2)
+
+    def test_explain_clusters(self):
+        backend = StubBackend()
+        with session.Session(backend=backend) as s:
+            clusters = s.explain_clusters(_shap_values(), n_clusters=3)
+        self.assertEqual(backend.calls, 3)
+        (summary, features), similarity = clusters[45]
+        self.assertEqual(len(summary), 200)
+        self.assertGreater(similarity, 0.99)
+        self.assertEqual(clusters.narrations[clusters.labels[45]][0], summary)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import csv
+import io
+import json
+import unittest
+
+import numpy as np
+import shap
+from src.contextualshap import gpt
+from src.contextualshap.common import _JSONStream, _features_schema, _repair, _serialize, _table
+
+
+class CommonTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.shap_values = shap.Explanation(values=rng.normal(size=(5, 4)), base_values=np.zeros(5),
+                                            data=rng.normal(size=(5, 4)) * 1000,
+                                            feature_names=['MedInc', 'HouseAge', 'AveRooms', 'Latitude'])
+
+    def test_shap_table_matches_rows(self):
+        # The table built per cell before the serializer was vectorized
+        rows = []
+        for x in range(len(self.shap_values)):
+            for i in range(len(self.shap_values[x].data)):
+                rows.append({'Sample Number': str(x), 'Feature Name': self.shap_values[x].feature_names[i],
+                             'Input Value': self.shap_values[x].data[i], 'SHAP Value': self.shap_values[x].values[i]})
+
+        columns = gpt._shap_columns(self.shap_values)
+        self.assertEqual(_serialize(columns), _table(rows))
+        self.assertEqual(_serialize(gpt._shap_columns([self.shap_values[x] for x in range(5)])), _table(rows))
+
+    def test_formats(self):
+        columns = gpt._shap_columns(self.shap_values)
+
+        parsed = list(csv.reader(io.StringIO(_serialize(columns, 'csv'))))
+        self.assertEqual(parsed[0], list(columns))
+        self.assertEqual(len(parsed), 21)
+        self.assertEqual(float(parsed[1][3]), self.shap_values.values[0, 0])
+
+        parsed = json.loads(_serialize(columns, 'json', precision=3))
+        self.assertEqual(parsed['columns'], list(columns))
+        self.assertEqual(parsed['rows'][4][:2], [1, 'MedInc'])
+        self.assertAlmostEqual(parsed['rows'][4][3], self.shap_values.values[1, 0], delta=0.01)
+
+        self.assertLess(len(_serialize(columns, precision=3)), len(_serialize(columns)))
+        with self.assertRaises(ValueError):
+            _serialize(columns, 'xml')
+
+    def test_json_stream(self):
+        response = {'summary': 'A "quoted" \\ summary, é 😀', 'features': [
+            {'feature_name': 'a', 'description': 'x, y]', 'explanation': '{z}'},
+            {'feature_name': 'b', 'description': '', 'explanation': ''}]}
+        content = '```json\n' + json.dumps(response, indent=2) + '\n```'
+        for size in [1, 3, 7, len(content)]:
+            parser = _JSONStream()
+            events = []
+            for i in range(0, len(content), size):
+                events += parser.feed(content[i:i + size])
+            self.assertEqual(events, [('summary', response['summary'])] +
+                             [('features', f) for f in response['features']])
+
+        # Escapes and surrogate pairs split between chunks are sent once they are complete
+        text = 'café 😀 "done"\n'
+        for content in [json.dumps({'explanation': text}), json.dumps({'explanation': text}, ensure_ascii=False)]:
+            for size in [1, 2, 5]:
+                parser = _JSONStream(['explanation'])
+                deltas = []
+                for i in range(0, len(content), size):
+                    deltas += [delta for _, delta in parser.feed(content[i:i + size])]
+                self.assertGreater(len(deltas), 1)
+                self.assertEqual(''.join(deltas), text)
+
+    def test_repair(self):
+        schema = _features_schema(['a', 'b'])
+        self.assertEqual(schema['properties']['features']['items']['properties']['feature_name']['enum'], ['a', 'b'])
+        features = [{'feature_name': 'a', 'description': '', 'explanation': 'x'},
+                    {'feature_name': 'b', 'description': '', 'explanation': 'y'}]
+        content = 'Here it is:\n```json\n' + json.dumps({'summary': 's', 'features': features}) + '\n```'
+        self.assertEqual(json.loads(_repair(content, schema)), {'summary': 's', 'features': features})
+
+        # A truncated response keeps its complete features, the others can be requested again
+        content = json.dumps({'summary': 's', 'features': features})[:-30]
+        self.assertEqual(json.loads(_repair(content, schema)), {'summary': 's', 'features': features[:1]})
+        self.assertEqual(json.loads(_repair('{"summary": "cut', schema)), {'summary': 'cut', 'features': []})
+        self.assertIsNone(_repair('{"features": []}', schema))
+        self.assertIsNone(_repair('not json', None))
@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+
+import matplotlib.pyplot as plt
+import numpy as np
+import shap
+from src.contextualshap import backends, session
+from src.contextualshap.encoding import ImageEncoding
+from tests.helpers import FakeOpenAI
+
+
+
+class EncodingTestCase(unittest.TestCase):
+    def test_encode(self):
+        plt.figure(figsize=(8, 4))
+        plt.plot(np.arange(100), np.sin(np.arange(100)))
+        png = ImageEncoding()
+        jpeg = ImageEncoding('jpeg', max_size=400, quality=50, detail='low')
+        image = png.encode()
+        small = jpeg.encode()
+        plt.close()
+
+        self.assertTrue(image['url'].startswith('data:image/png;base64,'))
+        self.assertNotIn('detail', image)
+        self.assertTrue(small['url'].startswith('data:image/jpeg;base64,'))
+        self.assertEqual(small['detail'], 'low')
+        self.assertEqual((jpeg.payloads[0]['width'], jpeg.payloads[0]['height']), (400, 200))
+        self.assertEqual(jpeg.payloads[0]['payload_bytes'], len(small['url']))
+        self.assertLess(jpeg.payload_bytes, png.payload_bytes)
+
+        # Only the last payloads are kept, the total counts every image
+        recent = ImageEncoding(history=2)
+        for _ in range(3):
+            plt.figure(figsize=(2, 2))
+            recent.encode()
+            plt.close()
+        self.assertEqual(len(recent.payloads), 2)
+        self.assertEqual(recent.payload_bytes, 3 * recent.payloads[-1]['payload_bytes'])
+
+        with self.assertRaises(ValueError):
+            ImageEncoding('gif')
+        with self.assertRaises(ValueError):
+            ImageEncoding(quality=80)
+
+    def test_waterfall_encoding(self):
+        rng = np.random.default_rng(0)
+        shap_values = shap.Explanation(values=rng.normal(size=(3, 4)), base_values=np.zeros(3),
+                                       data=rng.normal(size=(3, 4)), feature_names=['a', 'b', 'c', 'd'])
+        encoding = ImageEncoding('webp', dpi=50, quality=60, detail='low')
+        client = FakeOpenAI()
+        with mock.patch.object(backends, 'OpenAI', return_value=client), \
+                session.Session(image_encoding=encoding) as s:
+            self.assertEqual(s.waterfall(shap_values[0], show=False), 'explanation')
+            plt.close()
+
+        image = client.messages[0][0]['content'][1]['image_url']
+        self.assertTrue(image['url'].startswith('data:image/webp;base64,'))
+        self.assertEqual(image['detail'], 'low')
+        self.assertEqual(len(encoding.payloads), 1)
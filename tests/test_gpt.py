@@ -0,0 +1,166 @@
+import asyncio
+import json
+import re
+import unittest
+from unittest import mock
+
+import numpy as np
+import shap
+from src.contextualshap import backends, gpt, session
+from src.contextualshap.cache import MemoryCache
+from src.contextualshap.prompts import prompt_template
+from tests.helpers import FakeOpenAI, random_shap_values
+
+_feature_names = ('f0', 'f1', 'f2')
+
+
+class FakeAsyncOpenAI(FakeOpenAI):
+    # Counts the requests in flight, and answers with the number of samples in the prompt as the summary
+    def __init__(self, api_key=None, **kwargs):
+        super().__init__(api_key, **kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def content(self, messages, schema):
+        text = messages[0]['content']
+        if 'partial explanations' in text:
+            return json.dumps({'summary': 'merged', 'features': [{'feature_name': 'f0', 'description': '',
+                                                                  'explanation': 'merged'}]})
+        if '| 0 | f0 | fail |' in text:
+            raise RuntimeError('failed sample')
+        response = json.loads(super().content(messages, schema))
+        response['summary'] = len(set(re.findall(r'^\| (\d+) \| f0 \|', text, re.M)))
+        return json.dumps(response)
+
+    async def create(self, model, messages, response_format=None):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return super().create(model, messages, response_format=response_format)
+
+    async def close(self):
+        pass
+
+
+class GptTestCase(unittest.TestCase):
+    def test_explain_many(self):
+        shap_values = random_shap_values(feature_names=_feature_names)
+        batch = [shap_values[:1], shap_values[:3], shap_values[:2]]
+        failing = shap.Explanation(values=np.ones((1, 1)), data=np.array([['fail']], dtype=object),
+                                   feature_names=['f0'])
+        batch.insert(1, failing)
+
+        client = FakeAsyncOpenAI()
+        with mock.patch.object(backends, 'AsyncOpenAI', return_value=client), \
+                mock.patch.dict(session._sessions, clear=True):
+            results = gpt.explain_many(batch, {}, {}, concurrency=2)
+            session.get_session().close()
+
+        self.assertEqual(len(results), 4)
+        self.assertIsInstance(results[1], RuntimeError)
+        # The fake summary is the number of samples in the prompt, so it shows the results are in input order
+        self.assertEqual(results[0][0], 1)
+        self.assertEqual(results[2][0], 3)
+        self.assertEqual(results[3][0], 2)
+        self.assertEqual(list(results[0][1]['feature_name']), ['f0', 'f1', 'f2'])
+        self.assertLessEqual(client.max_in_flight, 2)
+
+    def test_explain_many_concurrency(self):
+        with mock.patch.object(backends, 'AsyncOpenAI', FakeAsyncOpenAI), session.Session() as s:
+            with self.assertRaises(ValueError):
+                s.explain_many([random_shap_values(feature_names=_feature_names)], concurrency=0)
+
+    def test_session_reuses_client(self):
+        with mock.patch.object(backends, 'AsyncOpenAI') as async_openai, session.Session(language='id') as s:
+            async_openai.side_effect = FakeAsyncOpenAI
+            s.explain_many([random_shap_values(feature_names=_feature_names)[:1]])
+            s.explain_many([random_shap_values(feature_names=_feature_names)[:2]])
+            self.assertEqual(async_openai.call_count, 1)
+        self.assertIs(session.get_session('key'), session.get_session('key'))
+
+    def test_explain_token_budget(self):
+        shap_values = random_shap_values(40, _feature_names)
+        client = FakeAsyncOpenAI()
+        with mock.patch.object(backends, 'AsyncOpenAI', return_value=client), session.Session() as s:
+            summary, features = s.explain(shap_values, token_budget=1000)
+            self.assertEqual(summary, 'merged')
+            self.assertEqual(list(features['explanation']), ['merged'])
+            self.assertTrue(all(len(p) // 4 + 1 <= 1000 for p in client.prompts))
+            chunks = [p for p in client.prompts if 'partial explanations' not in p]
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(sum(len(re.findall(r'^\| (\d+) \| f0 \|', p, re.M)) for p in chunks), 40)
+
+            with self.assertRaises(ValueError):
+                s.explain(shap_values, token_budget=10)
+
+    def test_explain_stream(self):
+        class FakeStreamOpenAI(FakeOpenAI):
+            def content(self, messages, schema):
+                return json.dumps({'summary': 'summary', 'features': [
+                    {'feature_name': 'f0', 'description': '', 'explanation': 'first'},
+                    {'feature_name': 'f1', 'description': '', 'explanation': 'second'}]})
+
+        client = FakeStreamOpenAI()
+        cache = MemoryCache()
+        with mock.patch.object(backends, 'OpenAI', return_value=client), session.Session(cache=cache) as s:
+            stream = s.explain_stream(random_shap_values(feature_names=_feature_names))
+            self.assertEqual(next(stream), ('summary', 'summary'))
+            self.assertEqual(next(stream)[1]['explanation'], 'first')
+            self.assertEqual(list(stream), [('features', {'feature_name': 'f1', 'description': '',
+                                                          'explanation': 'second'})])
+            # The whole response is cached once the stream ends, and replayed by later streams
+            self.assertEqual(len(list(s.explain_stream(random_shap_values(feature_names=_feature_names)))), 3)
+        self.assertEqual(client.calls, 1)
+
+    def test_explain_follow_up(self):
+        class FakeTruncatingOpenAI(FakeOpenAI):
+            # Explains the features of the prompt table, with the number of the request
+            def content(self, messages, schema):
+                names = sorted(set(re.findall(r'^\| \d+ \| (f\d+) \|', messages[0]['content'], re.M)))
+                features = [{'feature_name': n, 'description': '', 'explanation': f'{n} {self.calls}'}
+                            for n in names]
+                content = json.dumps({'summary': f'summary {self.calls}', 'features': features})
+                if self.calls == 1:
+                    # The first response is wrapped in markdown and truncated after its first feature
+                    content = '```json\n' + content[:content.index('}') + 1]
+                return content
+
+        client = FakeTruncatingOpenAI()
+        with mock.patch.object(backends, 'OpenAI', return_value=client), session.Session() as s:
+            summary, features = s.explain(random_shap_values(feature_names=_feature_names))
+
+        self.assertEqual(summary, 'summary 1')
+        self.assertEqual(list(features['explanation']), ['f0 1', 'f1 2', 'f2 2'])
+        self.assertEqual(client.calls, 2)
+        # The follow-up reuses the prefix of the first request and sends only the rows of the missing features
+        prefix = prompt_template('explain', list(_feature_names), {}, {}).prefix
+        self.assertTrue(client.prompts[0].startswith(prefix))
+        self.assertTrue(client.prompts[1].startswith(prefix))
+        self.assertNotIn('| f0 |', client.prompts[1][len(prefix):])
+        self.assertIn('| f1 |', client.prompts[1][len(prefix):])
+        response_format = client.response_formats[0]
+        self.assertEqual(response_format['type'], 'json_schema')
+        self.assertEqual(response_format['json_schema']['schema']['properties']['features']['items']['properties']
+                         ['feature_name']['enum'], ['f0', 'f1', 'f2'])
+
+    def test_explain_multi_output(self):
+        class FakeOutputsOpenAI(FakeOpenAI):
+            def content(self, messages, schema):
+                return json.dumps({'outputs': [
+                    {'summary': f'class {c}', 'features': [{'feature_name': 'f0', 'description': '',
+                                                            'explanation': c}]} for c in 'xyz']})
+
+        shap_values = random_shap_values(2, _feature_names, 3, ['x', 'y', 'z'])
+        client = FakeOutputsOpenAI()
+        with mock.patch.object(backends, 'OpenAI', return_value=client), session.Session() as s:
+            results = s.explain(shap_values)
+            with self.assertRaises(ValueError):
+                s.explain(shap_values, token_budget=10000)
+
+        self.assertEqual(list(results), ['x', 'y', 'z'])
+        self.assertEqual(results['y'][0], 'class y')
+        self.assertEqual(results['z'][1]['explanation'][0], 'z')
+        self.assertEqual(len(client.prompts), 1)
+        self.assertIn('| SHAP Value (x) | SHAP Value (y) | SHAP Value (z) |', client.prompts[0])
+        self.assertIn(f'| 1 | f2 | {shap_values.data[1, 2]} | {shap_values.values[1, 2, 0]} |', client.prompts[0])
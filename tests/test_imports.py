@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+import unittest
+
+# The import of the package, as measured by `python -X importtime`, must stay under this many microseconds
+budget = 100_000
+heavy_modules = ['shap', 'pandas', 'matplotlib', 'openai']
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _python(*args):
+    return subprocess.run([sys.executable, *args], cwd=root, capture_output=True, text=True, check=True)
+
+
+class ImportsTestCase(unittest.TestCase):
+    def test_import_time(self):
+        stderr = _python('-X', 'importtime', '-c', 'import src.contextualshap').stderr
+        line = [line for line in stderr.splitlines() if line.endswith('| src.contextualshap')][0]
+        cumulative = int(line.split('|')[1])
+        self.assertLess(cumulative, budget, f"import src.contextualshap took {cumulative} us")
+
+    def test_lazy_dependencies(self):
+        # The modules of the text narration path do not load the heavy dependencies until they are used
+        script = ('import sys; import src.contextualshap.gpt, src.contextualshap.plots, src.contextualshap.batch; '
+                  f'print(",".join(m for m in {heavy_modules!r} if m in sys.modules))')
+        self.assertEqual(_python('-c', script).stdout.strip(), '')
+
+        script = 'import src.contextualshap as c; print(c.Session.__module__, c.gpt.explain.__module__)'
+        self.assertEqual(_python('-c', script).stdout.split(), ['src.contextualshap.session', 'src.contextualshap.gpt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import warnings
+
+import matplotlib.pyplot as plt
+from src.contextualshap import instrument, session
+from src.contextualshap.backends import StubBackend
+from src.contextualshap.cache import MemoryCache
+from tests.helpers import random_shap_values
+
+
+class InstrumentTestCase(unittest.TestCase):
+    def test_no_hook(self):
+        self.assertFalse(instrument.span('request').enabled)
+        with instrument.span('request') as s:
+            s.set(prompt_tokens=1)
+
+    def test_explain_spans(self):
+        with session.Session(backend=StubBackend(), cache=MemoryCache()) as s, instrument.Recorder() as recorder:
+            s.explain(random_shap_values())
+            s.explain(random_shap_values())
+            s.explain_many([random_shap_values()[:2], random_shap_values()[:3]])
+
+        summary = recorder.summary()
+        self.assertEqual(summary['explain']['count'], 2)
+        self.assertEqual(summary['explain_many']['count'], 1)
+        self.assertEqual(summary['cache']['count'], 4)
+        self.assertEqual(summary['cache']['hit'], 1)
+        self.assertEqual(summary['request']['count'], 3)
+        self.assertGreater(summary['request']['prompt_tokens'], 0)
+        self.assertGreater(summary['request']['payload_bytes'], 0)
+        self.assertEqual(summary['parse']['count'], 4)
+        # The stages of the batch requests belong to the batch, even though they run on the session event loop
+        requests = [r for r in recorder.spans if r.name == 'request']
+        self.assertEqual([r.root.name for r in requests], ['explain', 'explain_many', 'explain_many'])
+
+    def test_waterfall_spans(self):
+        with session.Session(backend=StubBackend()) as s, instrument.Recorder() as recorder:
+            s.waterfall(random_shap_values()[0], show=False)
+            plt.close()
+
+        names = [r.name for r in recorder.spans]
+        self.assertEqual(names, ['draw', 'render', 'encode', 'validate', 'prompt', 'request', 'parse', 'waterfall'])
+        encode = recorder.spans[2]
+        self.assertGreater(encode.attributes['payload_bytes'], recorder.spans[1].attributes['image_bytes'])
+        self.assertTrue(all(r.root is recorder.spans[-1] for r in recorder.spans))
+
+    def test_failing_hook(self):
+        def hook(span):
+            raise RuntimeError('hook')
+
+        instrument.add_hook(hook)
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                with instrument.span('request'):
+                    pass
+            self.assertEqual(len(caught), 1)
+        finally:
+            instrument.remove_hook(hook)
+        self.assertFalse(instrument.span('request').enabled)
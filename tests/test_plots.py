@@ -1,7 +1,18 @@
+import json
+import os
+import tempfile
 import unittest
+from unittest import mock
+
+import matplotlib.pyplot as plt
+import numpy as np
 import shap
 import sklearn
-from src.contextualshap import plots
+from src.contextualshap import backends, plots, session
+from src.contextualshap.backends import StubBackend
+from tests.helpers import FakeOpenAI
+
+
 
 class PlotsTestCase(unittest.TestCase):
     def test_waterfall(self):
@@ -19,8 +30,10 @@ class PlotsTestCase(unittest.TestCase):
         shap_values = explainer(x)
 
         sample_ind = 0
-        # This will fail without a valid OpenAI API key
-        # print(plots.waterfall(shap_values[sample_ind], feature_descriptions={'MedInc': 'Median income for households within a block of houses (measured in tens of thousands of US Dollars)'}, max_display=14, openai_api_key=''))
+        # The stub backend answers without an OpenAI API key
+        with session.Session(backend=StubBackend()) as s:
+            print(s.waterfall(shap_values[sample_ind], feature_descriptions={'MedInc': 'Median income for households within a block of houses (measured in tens of thousands of US Dollars)'}, max_display=14, show=False))
+        plt.close()
 
     def test_bar(self):
         # a classic housing price dataset
@@ -40,5 +53,171 @@ class PlotsTestCase(unittest.TestCase):
             'MedInc': 'Median Income'
         }
 
-        # This will fail without a valid OpenAI API key
-        # print(plots.bar(shap_values, max_display=14, feature_aliases=feature_aliases, openai_api_key=''))
\ No newline at end of file
+        # The stub backend answers without an OpenAI API key
+        with session.Session(backend=StubBackend()) as s:
+            print(s.bar(shap_values, max_display=14, feature_aliases=feature_aliases, show=False))
+        plt.close()
+
+    def test_alias_view(self):
+        rng = np.random.default_rng(0)
+        shap_values = shap.Explanation(values=rng.normal(size=(20, 3)), base_values=np.zeros(20),
+                                       data=rng.normal(size=(20, 3)), feature_names=['MedInc', 'HouseAge', 'AveRooms'])
+        feature_aliases = {
+            'MedInc': 'Median Income'
+        }
+
+        cohorts = {'a': shap_values[:10], 'b': shap_values[10:]}
+        nsv, original_feature_names = plots._bar_alias(cohorts, feature_aliases)
+        self.assertEqual(list(original_feature_names), ['MedInc', 'HouseAge', 'AveRooms'])
+        for exp in nsv.values():
+            self.assertEqual(list(exp.feature_names), ['Median Income', 'HouseAge', 'AveRooms'])
+        self.assertTrue(np.shares_memory(nsv['a'].values, cohorts['a'].values))
+        self.assertEqual(list(cohorts['a'].feature_names), ['MedInc', 'HouseAge', 'AveRooms'])
+
+        nsv, _ = plots._bar_alias(shap_values, feature_aliases)
+        self.assertTrue(np.shares_memory(nsv.values, shap_values.values))
+        self.assertEqual(list(shap_values.feature_names), ['MedInc', 'HouseAge', 'AveRooms'])
+
+        plots.bar(shap.Cohorts(a=shap_values[:10], b=shap_values[10:]), feature_aliases=feature_aliases, explain=False,
+                  show=False)
+        plt.close()
+
+    def test_numeric_mode(self):
+        rng = np.random.default_rng(0)
+        shap_values = shap.Explanation(values=rng.normal(size=(20, 12)), base_values=np.full(20, 2.0),
+                                       data=rng.normal(size=(20, 12)), feature_names=[f'f{i}' for i in range(12)])
+        client = FakeOpenAI()
+        plt.close('all')
+        with mock.patch.object(backends, 'OpenAI', return_value=client), session.Session() as s:
+            self.assertEqual(s.waterfall(shap_values[0], show=False, mode='numeric', max_display=5), 'explanation')
+            self.assertEqual(s.bar(shap_values, show=False, mode='numeric'), 'explanation')
+            self.assertEqual(s.bar(shap_values[0], show=False, mode='numeric'), 'explanation')
+        # Nothing is drawn when the plots are not shown
+        self.assertEqual(plt.get_fignums(), [])
+
+        waterfall_prompt, bar_prompt, sample_bar_prompt = [messages[0]['content'] for messages in client.messages]
+        # Only text is sent, and it contains the numbers of the plots
+        self.assertIsInstance(waterfall_prompt, str)
+        top = np.argmax(np.abs(shap_values.values[0]))
+        self.assertIn(f'| f{top} |', waterfall_prompt)
+        self.assertEqual(waterfall_prompt.count('\n| f'), 5)
+        self.assertIn('The other 7 features', waterfall_prompt)
+        self.assertIn(str(2.0 + shap_values.values[0].sum()), waterfall_prompt)
+        self.assertIn(str(np.abs(shap_values.values).mean(axis=0)[0]), bar_prompt)
+        # The values of a single sample are made absolute, like the mean absolute values of many samples
+        self.assertIn(str(np.abs(shap_values.values[0, 0])), sample_bar_prompt)
+        self.assertNotIn('| -', sample_bar_prompt)
+
+        with self.assertRaises(ValueError):
+            plots._render_waterfalls([shap_values[0]], {}, mode='svg')
+
+    def test_render_waterfalls_processes(self):
+        rng = np.random.default_rng(0)
+        shap_values = shap.Explanation(values=rng.normal(size=(6, 4)), base_values=np.zeros(6),
+                                       data=rng.normal(size=(6, 4)), feature_names=['a', 'b', 'c', 'd'])
+        explanations = [shap_values[i] for i in range(6)]
+        explanations.insert(2, shap_values)  # many samples fail in the waterfall plot
+
+        serial = plots.render_waterfalls(explanations, {'a': 'A'})
+        parallel = plots.render_waterfalls(explanations, {'a': 'A'}, processes=2)
+        self.assertEqual(len(parallel), 7)
+        self.assertIsInstance(parallel[2], Exception)
+        for i in [0, 1, 3, 4, 5, 6]:
+            self.assertTrue(parallel[i].startswith(b'\x89PNG'))
+            self.assertEqual(parallel[i], serial[i])
+        self.assertEqual(plt.get_fignums(), [])
+
+        # Without aliases, the feature names are drawn unchanged
+        for images in [plots.render_waterfalls(explanations[:2]), plots.render_waterfalls(explanations[:2], processes=2)]:
+            self.assertTrue(all(image.startswith(b'\x89PNG') for image in images))
+
+    def test_waterfall_stream(self):
+        content = json.dumps({'explanation': 'The prediction is high.'})
+
+        class FakeStreamOpenAI(FakeOpenAI):
+            def content(self, messages, schema):
+                return content
+
+        rng = np.random.default_rng(0)
+        shap_values = shap.Explanation(values=rng.normal(size=(2, 3)), base_values=np.zeros(2),
+                                       data=rng.normal(size=(2, 3)), feature_names=['a', 'b', 'c'])
+        with mock.patch.object(backends, 'OpenAI', FakeStreamOpenAI), session.Session() as s:
+            texts = list(s.waterfall_stream(shap_values[0], show=False, mode='numeric'))
+            plt.close()
+        self.assertGreater(len(texts), 1)
+        self.assertEqual(''.join(texts), 'The prediction is high.')
+
+    def test_multi_output(self):
+        class FakeOutputsOpenAI(FakeOpenAI):
+            def content(self, messages, schema):
+                return json.dumps({'outputs': ['setosa', 'versicolor', 'virginica']})
+
+        rng = np.random.default_rng(0)
+        shap_values = shap.Explanation(values=rng.normal(size=(20, 6, 3)), base_values=rng.normal(size=(20, 3)),
+                                       data=rng.normal(size=(20, 6)), feature_names=[f'f{i}' for i in range(6)],
+                                       output_names=['a', 'b', 'c'])
+        expected = {'a': 'setosa', 'b': 'versicolor', 'c': 'virginica'}
+        client = FakeOutputsOpenAI()
+        with mock.patch.object(backends, 'OpenAI', return_value=client), session.Session() as s:
+            self.assertEqual(s.waterfall(shap_values[0], show=False, mode='numeric', max_display=4), expected)
+            self.assertEqual(s.waterfall(shap_values[0], show=False), expected)
+            # One figure per output, and none in the numeric mode
+            self.assertEqual(len(plt.get_fignums()), 3)
+            plt.close('all')
+            self.assertEqual(s.bar(shap_values, show=False, mode='numeric'), expected)
+            self.assertEqual(s.bar(shap_values, show=False), expected)
+            plt.close('all')
+            with self.assertRaises(ValueError):
+                s.waterfall_stream(shap_values[0], show=False)
+
+        # Every output is narrated in a single request
+        self.assertEqual(len(client.messages), 4)
+        numeric_waterfall, image_waterfall, numeric_bar, image_bar = [m[0]['content'] for m in client.messages]
+        self.assertIn('| SHAP Value (a) | SHAP Value (b) | SHAP Value (c) |', numeric_waterfall)
+        self.assertIn('The other 2 features', numeric_waterfall)
+        prediction = shap_values.base_values[0] + shap_values.values[0].sum(axis=0)
+        self.assertIn(str(prediction[2]), numeric_waterfall)
+        self.assertEqual(len(image_waterfall), 4)
+        self.assertIn('| Feature Name | Mean Absolute SHAP Value (a) | Mean Absolute SHAP Value (b) |', numeric_bar)
+        self.assertIn(str(np.abs(shap_values.values[..., 1]).mean(axis=0)[0]), numeric_bar)
+        self.assertEqual(len(image_bar), 2)
+        self.assertIn('a, b, c', image_bar[0]['text'])
+
+    def test_mean_abs_shap(self):
+        rng = np.random.default_rng(0)
+        values = rng.normal(size=(1000, 4))
+        labels = rng.choice(['a', 'b'], size=1000)
+        feature_names = ['w', 'x', 'y', 'z']
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'shap.npy')
+            np.save(path, values)
+            mapped = np.load(path, mmap_mode='r')
+            aggregated = plots.mean_abs_shap(mapped, feature_names, chunk_size=128)
+            cohorts = plots.mean_abs_shap(mapped, feature_names, cohorts=labels, chunk_size=128)
+            del mapped
+
+        np.testing.assert_allclose(aggregated.values, np.abs(values).mean(axis=0))
+        self.assertEqual(aggregated.feature_names, feature_names)
+        self.assertEqual(sorted(cohorts), ['a', 'b'])
+        for label in 'ab':
+            np.testing.assert_allclose(cohorts[label].values, np.abs(values[labels == label]).mean(axis=0))
+
+        # An iterable of chunks, e.g. shards, gives the same result
+        chunks = plots.mean_abs_shap((values[i:i + 300] for i in range(0, 1000, 300)), feature_names,
+                                     cohorts=(labels[i:i + 300] for i in range(0, 1000, 300)))
+        np.testing.assert_allclose(chunks['b'].values, cohorts['b'].values)
+        # Labels and values with a different number of rows or chunks are not silently truncated
+        with self.assertRaises(ValueError):
+            plots.mean_abs_shap((values[i:i + 300] for i in range(0, 1000, 300)), feature_names,
+                                cohorts=(labels[i:i + 300] for i in range(0, 900, 300)))
+        with self.assertRaises(ValueError):
+            plots.mean_abs_shap(values, feature_names, cohorts=np.concatenate([labels, labels]), chunk_size=500)
+        with self.assertRaises(ValueError):
+            plots.mean_abs_shap([values[:, :3]], feature_names)
+
+        client = FakeOpenAI()
+        with mock.patch.object(backends, 'OpenAI', return_value=client), session.Session() as s:
+            self.assertEqual(s.bar(cohorts, show=False, mode='numeric'), 'explanation')
+            plt.close()
+        self.assertIn(str(cohorts['a'].values[0]), client.messages[0][0]['content'])
@@ -0,0 +1,57 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from src.contextualshap import backends, gpt, instrument, plots, prompts, session
+from tests.helpers import FakeOpenAI, random_shap_values
+
+
+class CachingOpenAI(FakeOpenAI):
+    # Every response reports a cached prompt prefix
+    usage = SimpleNamespace(prompt_tokens=1200, completion_tokens=50,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=1024))
+
+
+class PromptsTestCase(unittest.TestCase):
+    def test_template(self):
+        aliases, descriptions = {'a': 'Alpha'}, {'b': 'Bee'}
+        template = prompts.prompt_template('explain', ['a', 'b', 'c'], aliases, descriptions, 'Houses', 'id')
+        self.assertIs(template, prompts.prompt_template('explain', ['a', 'b', 'c'], dict(aliases), descriptions,
+                                                        'Houses', 'id'))
+        self.assertIsNot(template, prompts.prompt_template('explain', ['a', 'b', 'c'], aliases, descriptions,
+                                                           'Houses', 'en'))
+        for text in ['| a | Alpha |  |', '| b | b | Bee |', 'Houses', 'Indonesian']:
+            self.assertIn(text, template.prefix)
+        self.assertGreater(template.prefix_tokens, 100)
+
+        with self.assertRaises(ValueError):
+            prompts.prompt_template('summary', ['a'])
+
+    def test_static_prefix(self):
+        shap_values = random_shap_values()
+        first, second = [gpt._messages(shap_values[i:i + 2], {'a': 'Alpha'}, {}, None, 'en', 'general')[0]['content']
+                         for i in [0, 2]]
+        template = prompts.prompt_template('explain', ['a', 'b', 'c'], {'a': 'Alpha'}, {})
+        # Only the SHAP values table follows the shared prefix
+        self.assertTrue(first.startswith(template.prefix) and second.startswith(template.prefix))
+        self.assertTrue(first[len(template.prefix):].startswith('| Sample Number |'))
+        self.assertNotEqual(first, second)
+
+        image = {'url': 'data:image/png;base64,'}
+        waterfalls = [plots._waterfall_messages(image, shap_values[i], {'a': 'Alpha'})[0]['content'] for i in [0, 1]]
+        prefix = prompts.prompt_template('waterfall', ['a', 'b', 'c'], {'a': 'Alpha'}).prefix
+        self.assertTrue(all(w[0]['text'].startswith(prefix) for w in waterfalls))
+        self.assertEqual(waterfalls[0][1]['image_url'], image)
+        self.assertEqual(plots._bar_messages(image, ['a', 'b', 'c'])[0]['content'][0]['text'],
+                         prompts.prompt_template('bar', ['a', 'b', 'c']).prefix)
+
+    def test_cached_tokens(self):
+        with mock.patch.object(backends, 'OpenAI', CachingOpenAI), session.Session() as s, \
+                instrument.Recorder() as recorder:
+            s.explain(random_shap_values())
+            s.explain(random_shap_values())
+        self.assertEqual(recorder.summary()['request']['cached_tokens'], 2048)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import asyncio
+import time
+import unittest
+from types import SimpleNamespace
+
+from src.contextualshap import instrument, ratelimit, session
+from src.contextualshap.backends import Backend, ChatResult, StubBackend
+from tests.helpers import random_shap_values
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after_ms):
+        super().__init__('Rate limit reached')
+        self.response = SimpleNamespace(headers={'retry-after-ms': str(retry_after_ms)})
+
+
+class BadRequestError(Exception):
+    status_code = 400
+
+
+class FlakyBackend(Backend):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def complete(self, gpt_model, messages, schema=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return ChatResult('{"explanation": "explanation"}',
+                          {'prompt_tokens': 10, 'completion_tokens': 5, 'cached_tokens': 0})
+
+
+_messages = [{'role': 'user', 'content': 'x' * 396}]
+
+
+class RateLimitTestCase(unittest.TestCase):
+    def test_estimate_tokens(self):
+        messages = [{'role': 'user', 'content': [{'type': 'text', 'text': 'x' * 396},
+                                                 {'type': 'image_url', 'image_url': {'url': '', 'detail': 'low'}},
+                                                 {'type': 'image_url', 'image_url': {'url': ''}}]}]
+        self.assertEqual(ratelimit.estimate_tokens(messages, 500), 100 + 85 + 765 + 500)
+        self.assertEqual(ratelimit.estimate_tokens(_messages), 100)
+
+    def test_token_bucket(self):
+        bucket = ratelimit._TokenBucket(60)
+        self.assertEqual(bucket.take(60, bucket._updated), 0)
+        # Empty: one token per second, and the reservations queue up
+        self.assertAlmostEqual(bucket.take(1, bucket._updated), 1)
+        self.assertAlmostEqual(bucket.take(2, bucket._updated), 3)
+        self.assertAlmostEqual(bucket.take(1, bucket._updated + 3), 1)
+        # A request larger than the bucket waits for a whole bucket
+        bucket = ratelimit._TokenBucket(60)
+        self.assertAlmostEqual(bucket.take(1000, bucket._updated), 0)
+        self.assertAlmostEqual(bucket.take(1, bucket._updated), 1)
+
+    def test_requests_per_minute(self):
+        backend = ratelimit.RateLimitedBackend(StubBackend(), requests_per_minute=240)
+
+        async def burst():
+            return await asyncio.gather(*(backend.acomplete('gpt-4o', _messages) for _ in range(244)))
+
+        start = time.monotonic()
+        asyncio.run(burst())
+        # The bucket holds 240 requests and is refilled at 4 requests per second
+        self.assertGreater(time.monotonic() - start, 0.9)
+        self.assertGreater(backend.throttled, 0)
+
+    def test_tokens_per_minute(self):
+        backend = ratelimit.RateLimitedBackend(FlakyBackend([]), tokens_per_minute=6000, completion_tokens=0)
+        for _ in range(10):
+            backend.complete('gpt-4o', _messages)
+        # 100 tokens are estimated and 15 are used, the difference is given back
+        self.assertAlmostEqual(backend._tokens._tokens, 6000 - 10 * 15, delta=5)
+        self.assertEqual(backend.throttled, 0)
+
+    def test_retries(self):
+        flaky = FlakyBackend([RateLimitError(100), RateLimitError(50)])
+        backend = ratelimit.RateLimitedBackend(flaky, seed=0)
+        start = time.monotonic()
+        self.assertEqual(backend.complete('gpt-4o', _messages).content, '{"explanation": "explanation"}')
+        self.assertGreater(time.monotonic() - start, 0.15)
+        self.assertEqual((flaky.calls, backend.retries), (3, 2))
+
+        flaky = FlakyBackend([BadRequestError()])
+        with self.assertRaises(BadRequestError):
+            ratelimit.RateLimitedBackend(flaky).complete('gpt-4o', _messages)
+        self.assertEqual(flaky.calls, 1)
+
+        flaky = FlakyBackend([RateLimitError(1)] * 3)
+        with self.assertRaises(RateLimitError):
+            ratelimit.RateLimitedBackend(flaky, max_retries=2).complete('gpt-4o', _messages)
+        self.assertEqual(flaky.calls, 3)
+
+    def test_stream(self):
+        flaky = FlakyBackend([RateLimitError(1)])
+        backend = ratelimit.RateLimitedBackend(flaky, tokens_per_minute=6000, seed=0)
+        with instrument.Recorder() as recorder:
+            with instrument.span('request'):
+                self.assertEqual(''.join(backend.stream('gpt-4o', _messages)), '{"explanation": "explanation"}')
+        self.assertEqual((flaky.calls, backend.retries), (2, 1))
+        self.assertEqual(recorder.spans[0].attributes['retries'], 1)
+        # The 500 expected completion tokens are settled against the 8 tokens of the streamed text, the failed attempt
+        # keeps its reservation
+        self.assertAlmostEqual(backend._tokens._tokens, 6000 - 600 - 108, delta=5)
+
+        async def stream():
+            return [chunk async for chunk in backend.astream('gpt-4o', _messages)]
+
+        asyncio.run(stream())
+        self.assertAlmostEqual(backend._tokens._tokens, 6000 - 600 - 2 * 108, delta=5)
+
+    def test_session(self):
+        shap_values = random_shap_values(20)
+        stub = StubBackend(failure_rate=0.3, seed=0)
+        backend = ratelimit.RateLimitedBackend(stub, requests_per_minute=6000, max_retries=20, base_delay=0.001,
+                                               seed=0)
+        with session.Session(backend=backend) as s:
+            results = s.explain_many([shap_values[i:i + 1] for i in range(20)])
+        self.assertFalse(any(isinstance(r, Exception) for r in results))
+        self.assertEqual(stub.calls, 20 + backend.retries)
+        self.assertGreater(backend.retries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
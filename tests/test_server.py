@@ -0,0 +1,142 @@
+import json
+import re
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import numpy as np
+from src.contextualshap import server, session
+from src.contextualshap.backends import Backend, ChatResult, StubBackend
+from src.contextualshap.cache import MemoryCache
+
+
+class BatchBackend(Backend):
+    """Answers every request of a batch with the first input value of its samples."""
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def complete(self, gpt_model, messages, schema=None):
+        with self._lock:
+            self.calls += 1
+        content = messages[0]['content']
+        text = content if isinstance(content, str) else content[0]['text']
+        if 'requests' in schema['properties']:
+            first = {}
+            for request, value in re.findall(r'^\| (\d+) \| \d+ \| \w+ \| (\S+) \|', text, re.M):
+                first.setdefault(int(request), value)
+            answer = {'requests': [{'summary': first[i], 'features': []} for i in range(len(first))]}
+        elif 'explanations' in schema['properties']:
+            answer = {'explanations': re.findall(r'^\| a \| (\S+) \|', text, re.M)}
+        elif 'summary' in schema['properties']:
+            answer = {'summary': re.search(r'^\| 0 \| \w+ \| (\S+) \|', text, re.M).group(1), 'features': []}
+        else:
+            answer = {'explanation': re.search(r'^\| a \| (\S+) \|', text, re.M).group(1)}
+        return ChatResult(json.dumps(answer))
+
+
+def _post(url, body):
+    request = urllib.request.Request(url, json.dumps(body).encode(), {'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def _burst(url, bodies):
+    results = [None] * len(bodies)
+
+    def post(i):
+        results[i] = _post(url, bodies[i])
+
+    threads = [threading.Thread(target=post, args=(i,)) for i in range(len(bodies))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _explain_body(seed):
+    rng = np.random.default_rng(seed)
+    return {'values': rng.normal(size=(2, 3)).tolist(), 'data': rng.normal(size=(2, 3)).round(6).tolist(),
+            'feature_names': ['a', 'b', 'c']}
+
+
+class ServerTestCase(unittest.TestCase):
+    def test_micro_batching(self):
+        backend = BatchBackend()
+        with session.Session(backend=backend) as s, server.NarrationServer(s, port=0, window=0.3).start() as srv:
+            bodies = [_explain_body(i) for i in range(6)]
+            results = _burst(srv.url + '/explain', bodies)
+            self.assertEqual(backend.calls, 1)
+            for body, (status, result) in zip(bodies, results):
+                self.assertEqual(status, 200)
+                self.assertEqual(float(result['summary']), body['data'][0][0])
+
+            rng = np.random.default_rng(0)
+            bodies = [{'values': rng.normal(size=3).tolist(), 'data': rng.normal(size=3).round(6).tolist(),
+                       'base_values': 0.5, 'feature_names': ['a', 'b', 'c'], 'mode': 'numeric'} for _ in range(3)]
+            results = _burst(srv.url + '/waterfall', bodies)
+            self.assertEqual(backend.calls, 2)
+            for body, (status, result) in zip(bodies, results):
+                self.assertEqual(float(result['explanation']), body['data'][0])
+
+            with urllib.request.urlopen(srv.url + '/health') as response:
+                stats = json.loads(response.read())
+            self.assertEqual(stats['requests'], 9)
+            self.assertEqual(stats['batched'], 9)
+
+    def test_coalescing(self):
+        backend = BatchBackend()
+        with session.Session(backend=backend, cache=MemoryCache()) as s, \
+                server.NarrationServer(s, port=0, window=0.3).start() as srv:
+            results = _burst(srv.url + '/explain', [_explain_body(0)] * 4)
+            self.assertEqual(backend.calls, 1)
+            self.assertEqual(len({json.dumps(r) for r in results}), 1)
+            self.assertEqual(srv.narrator.stats['coalesced'], 3)
+
+            # Batched narrations are cached per request
+            results = _burst(srv.url + '/explain', [_explain_body(1), _explain_body(2)])
+            self.assertEqual(backend.calls, 2)
+            self.assertEqual(_post(srv.url + '/explain', _explain_body(2)), results[1])
+            self.assertEqual(backend.calls, 2)
+
+    def test_fallback(self):
+        # The stub answers a batch with a single narration, so each request is sent on its own
+        backend = StubBackend()
+        cache = MemoryCache()
+        with session.Session(backend=backend, cache=cache) as s, \
+                server.NarrationServer(s, port=0, window=0.3).start() as srv:
+            results = _burst(srv.url + '/explain', [_explain_body(i) for i in range(3)])
+            self.assertEqual([status for status, _ in results], [200] * 3)
+            self.assertEqual(backend.calls, 4)
+            # Each request is looked up once, and its narration is cached
+            self.assertEqual((cache.hits, cache.misses), (0, 3))
+            self.assertEqual(_post(srv.url + '/explain', _explain_body(0)), results[0])
+            self.assertEqual((cache.hits, cache.misses, backend.calls), (1, 3, 4))
+
+            self.assertEqual(_post(srv.url + '/explain', {'values': [[1.0]]})[0], 400)
+            self.assertEqual(_post(srv.url + '/explain', {**_explain_body(0), 'language': 'xx'})[0], 400)
+            self.assertEqual(_post(srv.url + '/bar', _explain_body(0))[0], 404)
+
+        backend = StubBackend(failure_rate=1.0)
+        with session.Session(backend=backend) as s, server.NarrationServer(s, port=0, window=0).start() as srv:
+            status, result = _post(srv.url + '/explain', _explain_body(0))
+            self.assertEqual(status, 502)
+            self.assertIn('StubError', result['error'])
+
+    def test_main(self):
+        # The command line server selects a non-interactive matplotlib backend before serving
+        with mock.patch('matplotlib.use') as use, \
+                mock.patch.object(server.NarrationServer, 'serve_forever', side_effect=KeyboardInterrupt):
+            server.main(['--port', '0'])
+        use.assert_called_once_with('Agg')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import json
+import os
+import re
+import tempfile
+import unittest
+
+import matplotlib.pyplot as plt
+import numpy as np
+import shap
+from src.contextualshap import session, store
+from src.contextualshap.backends import Backend, ChatResult
+
+
+class FeaturesBackend(Backend):
+    # Explains every feature of the prompt table with the number of the request
+    def __init__(self):
+        self.prompts = []
+
+    def complete(self, gpt_model, messages, schema=None):
+        content = messages[0]['content']
+        text = content if isinstance(content, str) else content[0]['text']
+        self.prompts.append(text)
+        if 'features' not in schema['properties']:
+            return ChatResult(json.dumps({'explanation': f'bar {len(self.prompts)}'}))
+        names = sorted(set(re.findall(r'^\| \d+ \| (\w+) \|', text, re.M)))
+        return ChatResult(json.dumps({'summary': f'summary {len(self.prompts)}', 'features': [
+            {'feature_name': n, 'description': '', 'explanation': f'{n} {len(self.prompts)}'} for n in names]}))
+
+
+def _shap_values(values):
+    return shap.Explanation(values=values, base_values=np.zeros(len(values)), data=np.ones_like(values),
+                            feature_names=['a', 'b', 'c'])
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'narrations.db')
+        self.values = np.random.default_rng(0).normal(size=(50, 3))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_statistics(self):
+        stats = store.statistics(self.values)
+        self.assertEqual(stats.shape, (3, 2 + len(store.quantiles)))
+        np.testing.assert_allclose(stats[:, 1], np.abs(self.values).mean(axis=0))
+        np.testing.assert_allclose(store.shift(stats, stats), 0)
+
+    def test_explain_changed_features(self):
+        backend = FeaturesBackend()
+        shifted = self.values.copy()
+        shifted[:, 1] += 1
+        with session.Session(backend=backend) as s, store.NarrationStore(self.path) as narrations:
+            summary, features = narrations.explain(_shap_values(self.values), 'v1', session=s)
+            self.assertEqual(list(features['explanation']), ['a 1', 'b 1', 'c 1'])
+            self.assertEqual(narrations.changed, ['a', 'b', 'c'])
+
+            # Nothing moved, so nothing is sent
+            self.assertEqual(narrations.explain(_shap_values(self.values), 'v2', session=s)[0], 'summary 1')
+            self.assertEqual(len(backend.prompts), 1)
+
+            summary, features = narrations.explain(_shap_values(shifted), 'v3', session=s)
+            self.assertEqual(narrations.changed, ['b'])
+            self.assertEqual(summary, 'summary 2')
+            self.assertEqual(list(features['explanation']), ['a 1', 'b 2', 'c 1'])
+            # Only the shifted feature is in the table, with the previous summary as context
+            self.assertNotIn('| a |', backend.prompts[1])
+            self.assertIn('summary 1', backend.prompts[1])
+
+            # Another language has no stored narration yet
+            narrations.explain(_shap_values(shifted), 'v3', session=s, language='fr')
+            self.assertEqual(narrations.changed, ['a', 'b', 'c'])
+            self.assertEqual(narrations.versions(), ['v1', 'v2', 'v3'])
+
+        # The store persists, and compares with the latest version
+        with session.Session(backend=backend) as s, store.NarrationStore(self.path) as narrations:
+            self.assertEqual(narrations.explain(_shap_values(shifted), 'v4', session=s)[0], 'summary 2')
+            self.assertEqual(narrations.features('v4')['a'][2], 'a 1')
+            narrations.explain(_shap_values(self.values), 'v5', previous='v1', session=s)
+            self.assertEqual(narrations.changed, [])
+        self.assertEqual(len(backend.prompts), 3)
+
+    def test_bar(self):
+        backend = FeaturesBackend()
+        with session.Session(backend=backend) as s, store.NarrationStore(self.path) as narrations:
+            self.assertEqual(narrations.bar(_shap_values(self.values), 'v1', session=s, show=False, mode='numeric'),
+                             'bar 1')
+            plt.close()
+            self.assertEqual(narrations.bar(_shap_values(self.values * 1.01), 'v2', session=s, show=False), 'bar 1')
+            plt.close()
+            self.assertEqual(narrations.bar(_shap_values(self.values * 2), 'v3', session=s, show=False,
+                                            mode='numeric'), 'bar 2')
+            plt.close()
+        self.assertEqual(len(backend.prompts), 2)
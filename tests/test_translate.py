@@ -0,0 +1,83 @@
+import asyncio
+import json
+import re
+import unittest
+
+import matplotlib.pyplot as plt
+from src.contextualshap import session
+from src.contextualshap.backends import Backend, ChatResult
+from tests.helpers import random_shap_values
+
+
+class EchoBackend(Backend):
+    # Narrates in the language of the prompt, and rewrites a narration by prefixing its strings with the language
+    def __init__(self):
+        self.messages = []
+
+    def complete(self, gpt_model, messages, schema=None):
+        self.messages.append(messages)
+        content = messages[0]['content']
+        text = content if isinstance(content, str) else content[0]['text']
+        language = re.search(r'Reply in (\w+) language', text).group(1)
+        if 'This is the narration.\n' in text:
+            response = json.loads(text.split('This is the narration.\n')[1])
+            if 'explanation' in response:
+                response['explanation'] = f'{language}: {response["explanation"]}'
+            elif 'summary' in response:
+                response['summary'] = f'{language}: {response["summary"]}'
+            else:
+                response = {'outputs': [{**o, 'summary': f'{language}: {o["summary"]}'} for o in response['outputs']]}
+        elif 'summary' in schema['properties'] or 'outputs' in schema['properties']:
+            features = [{'feature_name': f, 'description': '', 'explanation': f} for f in ['a', 'b', 'c']]
+            if 'outputs' in schema['properties']:
+                response = {'outputs': [{'summary': 'x', 'features': features}, {'summary': 'y', 'features': features}]}
+            else:
+                response = {'summary': language, 'features': features}
+        else:
+            response = {'explanation': language}
+        return ChatResult(json.dumps(response))
+
+    async def acomplete(self, gpt_model, messages, schema=None):
+        return self.complete(gpt_model, messages, schema)
+
+
+class TranslateTestCase(unittest.TestCase):
+    def test_waterfall_languages(self):
+        backend = EchoBackend()
+        with session.Session(backend=backend) as s:
+            narrations = s.waterfall(random_shap_values()[0], language=['en', 'fr', 'de'], show=False)
+            plt.close()
+
+        self.assertEqual(narrations, {'en': 'English', 'fr': 'French: English', 'de': 'German: English'})
+        self.assertEqual(len(backend.messages), 3)
+        # Only the first request sends the image and the SHAP values
+        first, *rewrites = [m[0]['content'] for m in backend.messages]
+        self.assertIsInstance(first, list)
+        for rewrite in rewrites:
+            self.assertIsInstance(rewrite, str)
+            self.assertNotIn('SHAP Value |', rewrite)
+
+    def test_explain_languages_and_readers(self):
+        backend = EchoBackend()
+        with session.Session(backend=backend) as s:
+            results = s.explain(random_shap_values(), language=['en', 'id'], reader=['general', 'expert'])
+            outputs = asyncio.run(s.aexplain(random_shap_values(outputs=2), language=['en', 'fr']))
+
+        self.assertEqual(list(results), [('en', 'general'), ('en', 'expert'), ('id', 'general'), ('id', 'expert')])
+        self.assertEqual(results[('en', 'general')][0], 'English')
+        self.assertEqual(results[('id', 'expert')][0], 'Indonesian: English')
+        self.assertEqual(results[('id', 'expert')][1]['feature_name'][0], 'a')
+        self.assertEqual(outputs['fr']['Output 1'][0], 'French: y')
+        self.assertEqual(len(backend.messages), 6)
+
+    def test_invalid_language(self):
+        backend = EchoBackend()
+        with session.Session(backend=backend) as s:
+            with self.assertRaises(ValueError):
+                s.explain(random_shap_values(), language=['en', 'xx'])
+            # The batch methods narrate in a single language, lists are rejected before any request
+            with self.assertRaises(ValueError):
+                s.explain_many([random_shap_values()], language=['en', 'fr'])
+            with self.assertRaises(ValueError):
+                s.waterfall_many([random_shap_values()[0]], reader=['general', 'expert'])
+        self.assertEqual(backend.messages, [])